@@ -1,5 +1,11 @@
 from . import data
 from . import outfiles
+from . import cutouts
+from . import catalog
+from . import segindex
 
-from .data import Data
-from .outfiles import *
\ No newline at end of file
+from .data import Data, get_data, clear_data_cache
+from .outfiles import *
+from .cutouts import *
+from .catalog import *
+from .segindex import *
\ No newline at end of file
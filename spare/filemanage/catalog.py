@@ -0,0 +1,176 @@
+import os
+import json
+
+import numpy as np
+from astropy.io import fits
+
+
+__all__ = ['CatalogIndex']
+
+
+def _file_stamp(path:str) -> dict:
+    """Identify the version of a file by its size and modification time"""
+    stat = os.stat(path)
+    return {'path': os.path.realpath(path), 'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+
+def _read_meta(folder:str) -> dict|None:
+    meta_file = f'{folder}/meta.json'
+    if not os.path.isfile(meta_file):
+        return None
+    with open(meta_file) as f:
+        return json.load(f)
+
+def _write_meta(folder:str, meta:dict) -> None:
+    tmp_file = f'{folder}/meta.json.{os.getpid()}.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(meta, f)
+    os.replace(tmp_file, f'{folder}/meta.json')
+
+def _save_npy(filepath:str, array:np.ndarray) -> None:
+    """
+    Save an array atomically, through a temporary file renamed into place,
+    so that other processes never memory-map a half-written file
+    """
+
+    tmp_file = f'{filepath}.{os.getpid()}.tmp'
+    with open(tmp_file, 'wb') as f:
+        np.save(f, array)
+    os.replace(tmp_file, filepath)
+
+
+class CatalogIndex():
+    """
+    Columnar sidecar of the photometric catalog, holding the columns needed to extract galaxies.
+
+    The columns are saved as `.npy` files sorted by ID, and memory-mapped when loaded.
+    The sidecar is only rebuilt when the catalog file changes (by size or modification time).
+
+    Parameters
+    ----------
+    phot_cat : str
+        Path to the photometric catalog
+    folder : str
+        Cache folder to keep the sidecar in
+
+    Attributes
+    ----------
+    ids : ndarray[int]
+        Sorted IDs of the catalog
+    columns : dict[str, ndarray]
+        Memory-mapped columns, in the same order as `ids`.
+        Includes ID, X, Y and BBOX_* from SIZE, and any EAZY_z* columns from PHOTOZ
+    """
+
+    SIZE_COLUMNS = ['ID', 'X', 'Y', 'BBOX_XMIN', 'BBOX_XMAX', 'BBOX_YMIN', 'BBOX_YMAX']
+    PHOTOZ_PREFIX = 'EAZY_z'
+
+    def __init__(self, phot_cat:str, folder:str) -> None:
+        self.phot_cat = phot_cat
+        name = os.path.splitext(os.path.basename(phot_cat))[0]
+        self.folder = f'{folder}/catalog_{name}'
+
+        if not self._is_current():
+            self._build()
+        self._load()
+
+    def _is_current(self) -> bool:
+        meta = _read_meta(self.folder)
+        return (meta is not None) and (meta['stamp'] == _file_stamp(self.phot_cat))
+
+    def _build(self) -> None:
+        """Decode the catalog once and save the sorted columns"""
+
+        os.makedirs(self.folder, exist_ok=True)
+
+        columns:dict[str, np.ndarray] = dict()
+        with fits.open(self.phot_cat, memmap=True) as hdul:
+            size = hdul['SIZE'].data
+            order = np.argsort(size['ID'], kind='stable')
+            for name in self.SIZE_COLUMNS:
+                columns[name] = np.asarray(size[name])[order]
+
+            try:
+                photoz = hdul['PHOTOZ'].data
+            except KeyError:
+                photoz = None
+
+            if (photoz is not None) and (len(photoz) > 0):
+                # align PHOTOZ rows to the sorted SIZE ids
+                photoz_order = np.argsort(photoz['ID'], kind='stable')
+                positions = np.searchsorted(photoz['ID'], columns['ID'], sorter=photoz_order)
+                rows = photoz_order[np.minimum(positions, len(photoz_order) - 1)]
+                found = (np.asarray(photoz['ID'])[rows] == columns['ID'])
+                if not np.all(found):
+                    print(f'Warning: {np.sum(~found)} IDs not in the PHOTOZ table, their EAZY_z* values are set to NaN')
+
+                for name in photoz.columns.names:
+                    if name.startswith(self.PHOTOZ_PREFIX):
+                        column = np.asarray(photoz[name])[rows].astype(np.float64)
+                        column[~found] = np.nan
+                        columns[name] = column
+
+        for name, column in columns.items():
+            # store native byte order so columns can be used directly
+            _save_npy(f'{self.folder}/{name}.npy', column.astype(column.dtype.newbyteorder('=')))
+
+        # meta written last, so an interrupted build is redone
+        _write_meta(self.folder, {'stamp': _file_stamp(self.phot_cat), 'columns': list(columns)})
+
+    def _load(self) -> None:
+        meta = _read_meta(self.folder)
+
+        self.columns:dict[str, np.ndarray] = {
+            name: np.load(f'{self.folder}/{name}.npy', mmap_mode='r') for name in meta['columns']
+        }
+        self.ids:np.ndarray = self.columns['ID']
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __getitem__(self, name:str) -> np.ndarray:
+        return self.columns[name]
+
+    def rows(self, ids:np.ndarray|list[int]) -> np.ndarray:
+        """
+        Return the rows of the given ids, with a single vectorised search.
+
+        Parameters
+        ----------
+        ids : array | list[int]
+            IDs to find
+
+        Returns
+        -------
+        rows : ndarray[int]
+            Row of each id within `columns`
+        """
+
+        ids = np.asarray(ids)
+        rows = np.searchsorted(self.ids, ids)
+        rows_clipped = np.minimum(rows, len(self.ids) - 1)
+        missing = self.ids[rows_clipped] != ids
+        if np.any(missing):
+            raise KeyError(f'IDs not in catalog: {ids[missing]}')
+        return rows
+
+    def lookup(self, ids:np.ndarray|list[int], columns:list[str]|None=None) -> dict[str, np.ndarray]:
+        """
+        Return the values of columns for many ids at once.
+
+        Parameters
+        ----------
+        ids : array | list[int]
+            IDs to look up
+        columns : list[str] | None, default None
+            Columns to return, all columns if not set
+
+        Returns
+        -------
+        values : dict[str, ndarray]
+            Column name and values, in the order of `ids`
+        """
+
+        rows = self.rows(ids)
+        if columns is None:
+            columns = list(self.columns)
+        return {name: self.columns[name][rows] for name in columns}
@@ -0,0 +1,177 @@
+import numpy as np
+from astropy.io import fits
+
+
+__all__ = ['CutoutReader']
+
+
+class CutoutReader():
+    """
+    Reads cutouts directly from the FITS files using HDU sections,
+    so only the rows and columns covering the cutouts are read from disk,
+    and the full mosaics are never loaded.
+
+    Nearby cutouts are coalesced, with each group read as a single section of each file.
+
+    Parameters
+    ----------
+    filters : list[str]
+        The different filters to read
+    image_paths : dict[str, str]
+        Keys are the filter names, with each image path within
+    segmap_path : str
+        Path to the segmentation map
+    gap : int, default 64
+        Cutouts closer than this many pixels (in both x and y) are read together in one section
+    max_section : int, default 4194304
+        Largest number of pixels of a section read for a group, beyond which a new group is started
+
+    Methods
+    -------
+    read
+        Return the values, errors and segmap cutouts for a list of boxes
+    """
+
+    def __init__(
+            self, filters:list[str], image_paths:dict[str, str], segmap_path:str, gap:int=64,
+            max_section:int=2048*2048
+        ) -> None:
+        self.filters = filters
+        self.image_paths = image_paths
+        self.segmap_path = segmap_path
+        self.gap = gap
+        self.max_section = max_section
+
+        self._hduls:dict[str, fits.HDUList] = dict()
+        self._shape:tuple[int, int]|None = None
+
+    def _open(self, path:str) -> fits.HDUList:
+        if path not in self._hduls:
+            self._hduls[path] = fits.open(path)
+        return self._hduls[path]
+
+    def close(self) -> None:
+        """Close any open file handles"""
+        for hdul in self._hduls.values():
+            hdul.close()
+        self._hduls = dict()
+
+    @property
+    def shape(self) -> tuple[int, int]:
+        """Shape of the mosaics, read from the segmap header"""
+        if self._shape is None:
+            self._shape = tuple(self._open(self.segmap_path)[0].shape)
+        return self._shape
+
+    def clip(self, boxes:np.ndarray) -> np.ndarray:
+        """
+        Clip boxes to lie within the mosaics.
+
+        Parameters
+        ----------
+        boxes : array
+            Shape (N, 4) of `(ymin, ymax, xmin, xmax)`, with the max exclusive
+
+        Returns
+        -------
+        clipped : array
+            Boxes clipped to the edges of the mosaic
+        """
+
+        boxes = np.array(boxes, dtype=int).reshape(-1, 4)
+        ny, nx = self.shape
+        boxes[:, 0:2] = np.clip(boxes[:, 0:2], 0, ny)
+        boxes[:, 2:4] = np.clip(boxes[:, 2:4], 0, nx)
+        return boxes
+
+    @staticmethod
+    def group_boxes(boxes:np.ndarray, gap:int, max_section:int|None=None) -> list[np.ndarray]:
+        """
+        Coalesce boxes into groups that are read as one section.
+
+        Boxes are swept in order of `ymin`, with a box joining the current group
+        if it lies within `gap` pixels of the group's union in both x and y,
+        and the union would not then cover more than `max_section` pixels
+        (so chains of neighbours in dense fields do not grow into the whole mosaic).
+
+        Parameters
+        ----------
+        boxes : array
+            Shape (N, 4) of `(ymin, ymax, xmin, xmax)`, with the max exclusive
+        gap : int
+            Maximum separation in pixels to coalesce over
+        max_section : int | None, default None
+            Maximum pixels in the union of a group, unlimited if not set.
+            A single box larger than this is still read as its own group
+
+        Returns
+        -------
+        groups : list[array]
+            Indices into `boxes` of each group
+        """
+
+        order = np.argsort(boxes[:, 0], kind='stable')
+
+        groups:list[list[int]] = []
+        union = None
+        for i in order:
+            ymin, ymax, xmin, xmax = boxes[i]
+            near = (union is not None
+                    and ymin - union[1] <= gap
+                    and xmin - union[3] <= gap
+                    and union[2] - xmax <= gap)
+            if near:
+                joined = [min(union[0], ymin), max(union[1], ymax), min(union[2], xmin), max(union[3], xmax)]
+                near = (max_section is None) or ((joined[1] - joined[0]) * (joined[3] - joined[2]) <= max_section)
+            if near:
+                groups[-1].append(i)
+                union = joined
+            else:
+                groups.append([i])
+                union = [ymin, ymax, xmin, xmax]
+
+        return [np.array(group, dtype=int) for group in groups]
+
+    def _read_group(self, boxes:np.ndarray) -> list[tuple[dict[str, np.ndarray], dict[str, np.ndarray], np.ndarray]]:
+        y0, x0 = np.min(boxes[:, 0]), np.min(boxes[:, 2])
+        y1, x1 = np.max(boxes[:, 1]), np.max(boxes[:, 3])
+
+        values = {filt: self._open(self.image_paths[filt])['SCI'].section[y0:y1, x0:x1] for filt in self.filters}
+        errors = {filt: self._open(self.image_paths[filt])['ERR'].section[y0:y1, x0:x1] for filt in self.filters}
+        segmap = self._open(self.segmap_path)[0].section[y0:y1, x0:x1]
+
+        cutouts = []
+        for ymin, ymax, xmin, xmax in boxes:
+            sl = (slice(ymin - y0, ymax - y0), slice(xmin - x0, xmax - x0))
+            cutouts.append((
+                {filt: np.array(im[sl]) for (filt, im) in values.items()},
+                {filt: np.array(im[sl]) for (filt, im) in errors.items()},
+                np.array(segmap[sl])
+            ))
+
+        return cutouts
+
+    def read(self, boxes:np.ndarray) -> list[tuple[dict[str, np.ndarray], dict[str, np.ndarray], np.ndarray]]:
+        """
+        Read the cutouts for each box from the files.
+
+        Parameters
+        ----------
+        boxes : array
+            Shape (N, 4) of `(ymin, ymax, xmin, xmax)`, with the max exclusive.
+            Boxes are clipped to the edges of the mosaic.
+
+        Returns
+        -------
+        cutouts : list[tuple[dict[str, ndarray], dict[str, ndarray], ndarray]]
+            values, errors and segmap for each box, in the order given
+        """
+
+        boxes = self.clip(boxes)
+
+        cutouts:list = [None] * len(boxes)
+        for group in self.group_boxes(boxes, self.gap, self.max_section):
+            for i, cutout in zip(group, self._read_group(boxes[group])):
+                cutouts[i] = cutout
+
+        return cutouts
@@ -1,10 +1,19 @@
+from collections.abc import Mapping, Iterator
+from concurrent.futures import ThreadPoolExecutor
+import os
+import time
+
 import yaml
 import numpy as np
 from astropy.io import fits
 from astropy.table import Table
 
+from .cutouts import CutoutReader
+from .catalog import CatalogIndex
+from .segindex import SegmapIndex
+
 
-__all__ = ['Data', 'Paths', 'Images']
+__all__ = ['Data', 'Paths', 'Images', 'LazyImages', 'get_data', 'clear_data_cache']
 
 
 class Paths():
@@ -44,24 +53,114 @@ class Images():
     """
     Holds the arrays of the various images
 
+    Parameters
+    ----------
+    filters : list[str]
+        The different filters to load
+    image_paths : dict[str, str]
+        Keys are the filter names, with each image path within
+    lazy : bool, default False
+        If set, images are opened memory-mapped on first access rather than read into memory.
+        Only the pages of the mosaic that are actually sliced (e.g. for a cutout) are then read from disk.
+    workers : int, default 1
+        Number of threads used to read the filters concurrently, when not lazy
+    verbose : bool, default False
+        Print the time taken to read each filter
+
     Attributes
     ----------
     values : dict[str, np.ndarray]
         The values of flux in each filter
     errors : dict[str, np.ndarray]
         The errors in flux in each filter
+    load_times : dict[str, float]
+        Time in seconds taken to read the SCI and ERR of each filter (empty if lazy)
     """
 
-    def __init__(self, filters:list[str], image_paths:dict[str, str]) -> None:
+    def __init__(self, filters:list[str], image_paths:dict[str, str], lazy:bool=False, workers:int=1, verbose:bool=False) -> None:
+        self.filters = filters
+        self.paths = image_paths
+        self.lazy = lazy
+
+        self._hduls:dict[str, fits.HDUList] = dict()
+        self.load_times:dict[str, float] = dict()
+
+        if lazy:
+            self.values:Mapping[str, np.ndarray] = LazyImages(self, 'SCI')
+            self.errors:Mapping[str, np.ndarray] = LazyImages(self, 'ERR')
+            return
+
         self.values:dict[str, np.ndarray] = dict()
         self.errors:dict[str, np.ndarray] = dict()
 
-        for filt in filters:
-            path = image_paths[filt]
+        with ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+            loaded = pool.map(self._read_filter, filters)
+
+            for filt, (values, errors, load_time) in zip(filters, loaded):
+                self.values[filt] = values
+                self.errors[filt] = errors
+                self.load_times[filt] = load_time
+                if verbose:
+                    print(f'{filt}: {load_time:.2f}s')
+
+    def _read_filter(self, filt:str) -> tuple[np.ndarray, np.ndarray, float]:
+        """Read the SCI and ERR of a filter into memory, returning them with the time taken"""
+        start = time.perf_counter()
+        # not memory-mapped, so the read happens here (in the worker) rather than on first access
+        with fits.open(self.paths[filt], memmap=False) as hdul:
+            values = hdul['SCI'].data
+            errors = hdul['ERR'].data
+        return values, errors, time.perf_counter() - start
+
+    def open_hdul(self, filt:str) -> fits.HDUList:
+        """
+        Return the (memory-mapped) open file for the filter, opening it if needed.
+        Handles are kept open until `close` is called.
+        """
+
+        if filt not in self._hduls:
+            self._hduls[filt] = fits.open(self.paths[filt], memmap=True)
+        return self._hduls[filt]
+
+    def close(self) -> None:
+        """Close any open file handles"""
+        for hdul in self._hduls.values():
+            hdul.close()
+        self._hduls = dict()
+
 
-            with fits.open(path) as hdul:
-                self.values[filt] = hdul['SCI'].data
-                self.errors[filt] = hdul['ERR'].data
+class LazyImages(Mapping):
+    """
+    Read-only mapping of filter to memory-mapped image, in place of the dicts of `Images`.
+    The file for a filter is only opened when that filter is first accessed.
+
+    Note: scaled (BSCALE/BZERO) images cannot be memory-mapped by astropy, and will be read in full on access.
+
+    Parameters
+    ----------
+    images : Images
+        Parent `Images`, holding the paths and open handles
+    extname : str
+        Which HDU to take the data from, `SCI` or `ERR`
+    """
+
+    def __init__(self, images:Images, extname:str) -> None:
+        self.images = images
+        self.extname = extname
+        self._arrays:dict[str, np.ndarray] = dict()
+
+    def __getitem__(self, filt:str) -> np.ndarray:
+        if filt not in self.images.filters:
+            raise KeyError(filt)
+        if filt not in self._arrays:
+            self._arrays[filt] = self.images.open_hdul(filt)[self.extname].data
+        return self._arrays[filt]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.images.filters)
+
+    def __len__(self) -> int:
+        return len(self.images.filters)
         
 
 class Data():
@@ -73,16 +172,41 @@ class Data():
     filters : list[str]
         The different filters used in the image
     size_cat : Table
-        The SIZE table from the photometric catalog
+        The SIZE table from the photometric catalog, decoded on first access
+    photoz_cat : Table | None
+        The PHOTOZ table from the photometric catalog, decoded on first access
+    catalog : CatalogIndex
+        Memory-mapped sidecar of the catalog columns needed for extraction, sorted by ID
     segmap : ndarray[int]
         Segmentation map of objects by ID
+    segmap_index : SegmapIndex
+        Exact bounding boxes and pixels of each object in the segmap, built (or loaded from cache) on first access
     images : Images
         Contains the values and errors for each filter of image
     paths : Paths
         Contains the various filepaths
+    cutouts : CutoutReader
+        Reads cutouts directly from file sections, without needing the images loaded
+
+    Parameters
+    ----------
+    config_file : str, default config.yml
+        Config file to be used
+    lazy : bool, default False
+        If set, the images and segmap are memory-mapped and only read from disk where sliced,
+        so memory grows with the cutouts taken rather than the size of the mosaics.
+    verbose : bool, default False
+        Print the time taken to read each filter
+
+    Config
+    ------
+    images: workers : int, default 1
+        Number of threads used to read the filter images concurrently
     """
 
-    def __init__(self, config_file:str='config.yml') -> None:
+    def __init__(self, config_file:str='config.yml', lazy:bool=False, verbose:bool=False) -> None:
+        self.lazy = lazy
+
         with open(config_file) as f:
             self.config = yaml.safe_load(f)
 
@@ -90,17 +214,121 @@ class Data():
 
         self.paths = Paths(self.config['images'], self.config['catalogs'], self.filters)
 
+        self.catalog = CatalogIndex(self.paths.phot_cat, f"{self.config['output']['folder']}/cache")
+        self._size_cat:Table|None = None
+        self._photoz_cat:Table|None = None
+        self._segmap_index:SegmapIndex|None = None
+
+        workers = self.config['images'].get('workers', 1)
+
+        if lazy:
+            self._segmap_hdul = fits.open(self.paths.segmap, memmap=True)
+            self.segmap:np.ndarray = self._segmap_hdul[0].data
+            self.images = Images(self.filters, self.paths.images, lazy, workers, verbose)
+        else:
+            # segmap read alongside the images
+            with ThreadPoolExecutor(max_workers=1) as pool:
+                segmap = pool.submit(self._read_segmap)
+                self.images = Images(self.filters, self.paths.images, lazy, workers, verbose)
+                self.segmap:np.ndarray = segmap.result()
+        self.cutouts = CutoutReader(self.filters, self.paths.images, self.paths.segmap)
+
+    def _read_segmap(self) -> np.ndarray:
+        with fits.open(self.paths.segmap) as hdul:
+            return hdul[0].data
+
+    def _load_catalog_tables(self) -> None:
         with fits.open(self.paths.phot_cat) as hdul:
-            self.size_cat = Table(hdul['SIZE'].data)
-            self.size_cat.add_index('ID')
+            self._size_cat = Table(hdul['SIZE'].data)
+            self._size_cat.add_index('ID')
             try:
-                self.photoz_cat = Table(hdul['PHOTOZ'].data)
-                self.photoz_cat.add_index('ID')
+                self._photoz_cat = Table(hdul['PHOTOZ'].data)
+                self._photoz_cat.add_index('ID')
             except:
                 print('Warning: No PHOTOZ table found in catalog')
-                
-        with fits.open(self.paths.segmap) as hdul:
-            self.segmap:np.ndarray = hdul[0].data
 
-        self.images = Images(self.filters, self.paths.images)
-        
+    @property
+    def size_cat(self) -> Table:
+        if self._size_cat is None:
+            self._load_catalog_tables()
+        return self._size_cat
+
+    @property
+    def photoz_cat(self) -> Table|None:
+        if self._size_cat is None:
+            self._load_catalog_tables()
+        return self._photoz_cat
+
+    @property
+    def segmap_index(self) -> SegmapIndex:
+        if self._segmap_index is None:
+            self._segmap_index = SegmapIndex(self.paths.segmap, f"{self.config['output']['folder']}/cache", self.segmap)
+        return self._segmap_index
+
+    def close(self) -> None:
+        """Close any file handles kept open in lazy mode or by the cutout reader"""
+        self.images.close()
+        self.cutouts.close()
+        if self.lazy:
+            self._segmap_hdul.close()
+
+
+_data_cache:dict[tuple[str, bool], tuple[tuple, Data]] = dict()
+
+def _mtime(path:str) -> int|None:
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+def _data_signature(config_file:str) -> tuple:
+    """Modification times of the config and every file it points to"""
+
+    with open(config_file) as f:
+        config = yaml.safe_load(f)
+    paths = Paths(config['images'], config['catalogs'], config['filters'])
+
+    files = [config_file, paths.phot_cat, paths.segmap, *paths.images.values()]
+    return tuple((os.path.realpath(file), _mtime(file)) for file in files)
+
+def get_data(config_file:str='config.yml', lazy:bool=False) -> Data:
+    """
+    Return a shared `Data` object for the config file, only creating it on first call.
+
+    The instance is cached per resolved config path (and `lazy`),
+    and is recreated if the config or any of the catalog, segmap or image files have been modified since.
+    Galaxies extracted from it (`extract_galaxy`) hold copies, so changing them leaves the shared images untouched.
+
+    Parameters
+    ----------
+    config_file : str, default config.yml
+        Config file to be used
+    lazy : bool, default False
+        Passed to `Data`
+
+    Returns
+    -------
+    data : Data
+        Shared `Data` object
+    """
+
+    key = (os.path.realpath(config_file), lazy)
+    signature = _data_signature(config_file)
+
+    if key in _data_cache:
+        cached_signature, data = _data_cache[key]
+        if cached_signature == signature:
+            return data
+        # not closed, as callers may still hold it, handles are released once it is garbage collected
+        del _data_cache[key]
+
+    data = Data(config_file, lazy)
+    _data_cache[key] = (signature, data)
+
+    return data
+
+def clear_data_cache() -> None:
+    """Close and remove all cached `Data` objects"""
+    for _, data in _data_cache.values():
+        data.close()
+    _data_cache.clear()
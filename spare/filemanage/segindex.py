@@ -0,0 +1,178 @@
+import os
+
+import numpy as np
+from astropy.io import fits
+
+from .catalog import _file_stamp, _read_meta, _write_meta, _save_npy
+
+
+__all__ = ['SegmapIndex']
+
+
+class SegmapIndex():
+    """
+    Index of the objects in the segmentation map, built in a single pass over the map.
+
+    For each ID, holds the exact bounding box, the pixel count and the flattened pixel indices.
+    Saved as `.npy` files in the cache folder and memory-mapped when loaded,
+    only being rebuilt when the segmap file changes.
+
+    Parameters
+    ----------
+    segmap_path : str
+        Path to the segmentation map
+    folder : str
+        Cache folder to keep the index in
+    segmap : array | None, default None
+        Already loaded segmap to build from, if the index needs (re)building.
+        Read from `segmap_path` if not given.
+
+    Attributes
+    ----------
+    ids : ndarray[int]
+        Sorted IDs of the objects in the segmap
+    bboxes : ndarray[int]
+        Shape (N, 4) of `(ymin, ymax, xmin, xmax)` for each id, with the max inclusive (as the catalog BBOX)
+    counts : ndarray[int]
+        Number of pixels of each id
+    offsets : ndarray[int]
+        Start of each id within `pixels`, with a final entry of the total
+    pixels : ndarray[int]
+        Flattened pixel indices of all objects, grouped by id
+    shape : tuple[int, int]
+        Shape of the segmap
+    """
+
+    def __init__(self, segmap_path:str, folder:str, segmap:np.ndarray|None=None) -> None:
+        self.segmap_path = segmap_path
+        name = os.path.splitext(os.path.basename(segmap_path))[0]
+        self.folder = f'{folder}/segmap_{name}'
+
+        meta = _read_meta(self.folder)
+        if (meta is None) or (meta['stamp'] != _file_stamp(segmap_path)):
+            self._build(segmap)
+        self._load()
+
+    def _build(self, segmap:np.ndarray|None) -> None:
+        if segmap is None:
+            with fits.open(self.segmap_path) as hdul:
+                segmap = hdul[0].data
+
+        shape = segmap.shape
+        flat = segmap.ravel()
+
+        pixels = np.flatnonzero(flat)
+        labels = flat[pixels]
+        order = np.argsort(labels, kind='stable')
+        pixels = pixels[order]
+        labels = labels[order]
+
+        ids, starts, counts = np.unique(labels, return_index=True, return_counts=True)
+        offsets = np.append(starts, len(pixels))
+
+        bboxes = np.zeros((len(ids), 4), dtype=int)
+        if len(ids) > 0:
+            rows, cols = np.divmod(pixels, shape[1])
+            bboxes[:, 0] = np.minimum.reduceat(rows, starts)
+            bboxes[:, 1] = np.maximum.reduceat(rows, starts)
+            bboxes[:, 2] = np.minimum.reduceat(cols, starts)
+            bboxes[:, 3] = np.maximum.reduceat(cols, starts)
+
+        os.makedirs(self.folder, exist_ok=True)
+        _save_npy(f'{self.folder}/ids.npy', ids.astype(int))
+        _save_npy(f'{self.folder}/bboxes.npy', bboxes)
+        _save_npy(f'{self.folder}/counts.npy', counts)
+        _save_npy(f'{self.folder}/offsets.npy', offsets)
+        _save_npy(f'{self.folder}/pixels.npy', pixels)
+
+        # meta written last, so an interrupted build is redone
+        _write_meta(self.folder, {'stamp': _file_stamp(self.segmap_path), 'shape': list(shape)})
+
+    def _load(self) -> None:
+        meta = _read_meta(self.folder)
+        self.shape:tuple[int, int] = tuple(meta['shape'])
+
+        self.ids:np.ndarray = np.load(f'{self.folder}/ids.npy')
+        self.bboxes:np.ndarray = np.load(f'{self.folder}/bboxes.npy')
+        self.counts:np.ndarray = np.load(f'{self.folder}/counts.npy')
+        self.offsets:np.ndarray = np.load(f'{self.folder}/offsets.npy')
+        self.pixels:np.ndarray = np.load(f'{self.folder}/pixels.npy', mmap_mode='r')
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __contains__(self, id:int) -> bool:
+        i = np.searchsorted(self.ids, id)
+        return (i < len(self.ids)) and (self.ids[i] == id)
+
+    def rows(self, ids:np.ndarray|list[int]) -> np.ndarray:
+        """Return the rows of the given ids within the index arrays, with a single vectorised search"""
+        ids = np.asarray(ids)
+        rows = np.searchsorted(self.ids, ids)
+        missing = self.ids[np.minimum(rows, len(self.ids) - 1)] != ids
+        if np.any(missing):
+            raise KeyError(f'IDs not in segmap: {ids[missing]}')
+        return rows
+
+    def _row(self, id:int) -> int:
+        return int(self.rows([id])[0])
+
+    def bbox(self, id:int) -> np.ndarray:
+        """Exact bounding box `(ymin, ymax, xmin, xmax)` of the object, max inclusive"""
+        return self.bboxes[self._row(id)]
+
+    def count(self, id:int) -> int:
+        """Number of pixels of the object"""
+        return int(self.counts[self._row(id)])
+
+    def pixels_of(self, id:int) -> np.ndarray:
+        """Flattened indices of the object's pixels within the segmap"""
+        row = self._row(id)
+        return np.asarray(self.pixels[self.offsets[row]:self.offsets[row+1]])
+
+    def coords_of(self, id:int) -> tuple[np.ndarray, np.ndarray]:
+        """(Y, X) coordinates of the object's pixels"""
+        return np.divmod(self.pixels_of(id), self.shape[1])
+
+    def mask(self, id:int, box:np.ndarray|list[int]) -> np.ndarray:
+        """
+        Boolean mask of the object's pixels within a cutout box, without reading the segmap.
+
+        Parameters
+        ----------
+        id : int
+            ID of the object
+        box : array | list[int]
+            Cutout `(ymin, ymax, xmin, xmax)`, with the max exclusive
+
+        Returns
+        -------
+        mask : ndarray[bool]
+            True on the pixels of the object
+        """
+
+        ymin, ymax, xmin, xmax = box
+        y, x = self.coords_of(id)
+        inside = (y >= ymin) & (y < ymax) & (x >= xmin) & (x < xmax)
+
+        mask = np.zeros((ymax - ymin, xmax - xmin), dtype=bool)
+        mask[y[inside] - ymin, x[inside] - xmin] = True
+        return mask
+
+    def in_region(self, ymin:int, ymax:int, xmin:int, xmax:int) -> np.ndarray:
+        """
+        IDs of all objects whose bounding box overlaps the region (max inclusive).
+        """
+
+        b = self.bboxes
+        overlap = (b[:, 0] <= ymax) & (b[:, 1] >= ymin) & (b[:, 2] <= xmax) & (b[:, 3] >= xmin)
+        return self.ids[overlap]
+
+    def neighbours(self, id:int, distance:int=0) -> np.ndarray:
+        """
+        IDs of other objects whose bounding box lies within `distance` pixels of the object's bounding box.
+        """
+
+        ymin, ymax, xmin, xmax = self.bbox(id)
+        ids = self.in_region(ymin - distance, ymax + distance, xmin - distance, xmax + distance)
+        return ids[ids != id]
@@ -1,13 +1,15 @@
-from typing import Literal
+from typing import Literal, Iterator
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, Future
 
 import numpy as np
 
-from .filemanage import Data
-from .galaxy import Galaxy
-from .photometry import SelectionGalaxies, FileEAZY, WrapperEAZY
+from .filemanage import Data, RunManager, get_data
+from .galaxy import Galaxy, RunStore, store_path
+from .photometry import SelectionGalaxies, FileEAZY, StreamEAZYWriter, WrapperEAZY
 
 
-__all__ = ['random_id', 'extract_galaxy', 'get_catalog_z_phot', 'prep_for_EAZY', 'run_on_galaxies']
+__all__ = ['random_id', 'extract_galaxy', 'extract_galaxies', 'iter_galaxies', 'get_catalog_z_phot', 'prep_for_EAZY', 'run_on_galaxies']
 
 
 def random_id(data:Data) -> int:
@@ -25,10 +27,32 @@ def random_id(data:Data) -> int:
         Randomly chosen id from the dataset
     """
 
-    id = data.size_cat.iloc[np.random.randint(len(data.size_cat))]['ID']
+    id = data.catalog.ids[np.random.randint(len(data.catalog))]
     return int(id)
 
-def extract_galaxy(id: int, data:Data, border:int=0) -> Galaxy:
+def _galaxy_bboxes(ids:list[int], data:Data, border:int=0, exact:bool=False) -> list[tuple[tuple[float, float], np.ndarray, np.ndarray]]:
+    """
+    Return the centroid, bbox and bordered cutout box of each galaxy, from a single lookup in the catalog sidecar.
+    The cutout box is in the form `(ymin, ymax, xmin, xmax)`, with the max exclusive.
+    If `exact`, the bbox is instead taken from the segmap index.
+    """
+
+    # get relevant data from size_cat
+    cols = data.catalog.lookup(ids, ['X', 'Y', 'BBOX_XMIN', 'BBOX_XMAX', 'BBOX_YMIN', 'BBOX_YMAX'])
+    if exact:
+        index = data.segmap_index
+        ymin, ymax, xmin, xmax = index.bboxes[index.rows(ids)].T
+    else:
+        ymin, ymax = cols['BBOX_YMIN'].astype(int), cols['BBOX_YMAX'].astype(int)
+        xmin, xmax = cols['BBOX_XMIN'].astype(int), cols['BBOX_XMAX'].astype(int)
+
+    centroids = [(float(y), float(x)) for (y, x) in zip(cols['Y'], cols['X'])]
+    bboxes = np.stack([np.stack([ymin, ymax], axis=-1), np.stack([xmin, xmax], axis=-1)], axis=1)
+    boxes = np.stack([ymin - border, ymax + border + 1, xmin - border, xmax + border + 1], axis=-1)
+
+    return list(zip(centroids, bboxes, boxes))
+
+def extract_galaxy(id: int, data:Data, border:int=0, exact:bool=False) -> Galaxy:
     """
     Return the galaxy object specified, with border specifying extra pixels around the segmap
 
@@ -40,6 +64,9 @@ def extract_galaxy(id: int, data:Data, border:int=0) -> Galaxy:
         `Data` object with relevant images
     border : int, default 0
         Number of extra pixels around the segmap to include
+    exact : bool, default False
+        If set, the bbox is taken exactly from the segmap index (`data.segmap_index`),
+        rather than from the catalog BBOX columns
 
     Returns
     -------
@@ -47,37 +74,96 @@ def extract_galaxy(id: int, data:Data, border:int=0) -> Galaxy:
         Created `Galaxy` object
     """
 
-    # get relevant data from size_cat
-    x = data.size_cat.loc[id]['X']
-    y = data.size_cat.loc[id]['Y']
-    xmin = data.size_cat.loc[id]['BBOX_XMIN']
-    xmax = data.size_cat.loc[id]['BBOX_XMAX']
-    ymin = data.size_cat.loc[id]['BBOX_YMIN']
-    ymax = data.size_cat.loc[id]['BBOX_YMAX']
-
-    centroid = (y, x)
-    bbox = np.array([[ymin, ymax], [xmin, xmax]])
-
-    # extract images
-    xmin_b = xmin - border
-    xmax_b = xmax + border + 1
-    ymin_b = ymin - border
-    ymax_b = ymax + border + 1
-    values = {filt:im[ymin_b:ymax_b, xmin_b:xmax_b] for (filt, im) in data.images.values.items()}
-    errors = {filt:im[ymin_b:ymax_b, xmin_b:xmax_b] for (filt, im) in data.images.errors.items()}
-    segmap = data.segmap[ymin_b:ymax_b, xmin_b:xmax_b]
+    centroid, bbox, box = _galaxy_bboxes([id], data, border, exact)[0]
+
+    # extract images, copied so that changes to the galaxy never reach the (possibly shared) mosaics
+    ymin_b, ymax_b, xmin_b, xmax_b = box
+    values = {filt:np.array(im[ymin_b:ymax_b, xmin_b:xmax_b]) for (filt, im) in data.images.values.items()}
+    errors = {filt:np.array(im[ymin_b:ymax_b, xmin_b:xmax_b]) for (filt, im) in data.images.errors.items()}
+    segmap = np.array(data.segmap[ymin_b:ymax_b, xmin_b:xmax_b])
 
     return Galaxy(id, centroid, bbox, values, errors, segmap)
 
+def extract_galaxies(ids:list[int], data:Data, border:int=0, sections:bool=True, exact:bool=False) -> list[Galaxy]:
+    """
+    Return the galaxy objects specified, with border specifying extra pixels around the segmap
+
+    Parameters
+    ----------
+    ids : list[int]
+        JADES IDs of the objects
+    data : Data
+        `Data` object with relevant images
+    border : int, default 0
+        Number of extra pixels around the segmap to include
+    sections : bool, default True
+        If set, cutouts are read directly from file sections with `data.cutouts`,
+        coalescing nearby galaxies, so the mosaics need not be loaded (use with `Data(lazy=True)`).
+        Otherwise each galaxy is sliced from the loaded images with `extract_galaxy`.
+        Note: with sections, cutouts are clipped at the mosaic edges.
+    exact : bool, default False
+        If set, the bbox is taken exactly from the segmap index (`data.segmap_index`),
+        rather than from the catalog BBOX columns
+
+    Returns
+    -------
+    galaxies : list[Galaxy]
+        Created `Galaxy` objects, in the order of `ids`
+    """
+
+    if not sections:
+        return [extract_galaxy(id, data, border, exact) for id in ids]
+
+    bboxes = _galaxy_bboxes(ids, data, border, exact)
+    cutouts = data.cutouts.read(np.array([box for (_, _, box) in bboxes]))
+
+    galaxies = []
+    for id, (centroid, bbox, _), (values, errors, segmap) in zip(ids, bboxes, cutouts):
+        galaxies.append(Galaxy(id, centroid, bbox, values, errors, segmap))
+
+    return galaxies
+
+
+def iter_galaxies(ids:list[int], data:Data, border:int=0, batch:int=256, exact:bool=False) -> Iterator[Galaxy]:
+    """
+    Generator of the galaxy objects specified, extracted from file sections `batch` galaxies at a time,
+    so only one batch of cutouts is held in memory at once.
+
+    Parameters
+    ----------
+    ids : list[int]
+        JADES IDs of the objects
+    data : Data
+        `Data` object with relevant images
+    border : int, default 0
+        Number of extra pixels around the segmap to include
+    batch : int, default 256
+        Number of galaxies read together (coalescing nearby cutouts)
+    exact : bool, default False
+        If set, the bbox is taken exactly from the segmap index
+
+    Yields
+    ------
+    galaxy : Galaxy
+        Created `Galaxy` objects, in the order of `ids`
+    """
+
+    for start in range(0, len(ids), batch):
+        yield from extract_galaxies(ids[start:start+batch], data, border, exact=exact)
+
 
 def get_catalog_z_phot(id:int, data:Data) -> float:
-    return data.photoz_cat.loc[id]['EAZY_z_a']
+    return float(data.catalog.lookup([id], ['EAZY_z_a'])['EAZY_z_a'][0])
 
 
 def prep_for_EAZY(
         name:str, ids:list[int], border:int=0,
         replace_unused:bool=False, unused:float|None=None, replace:float|None=None, using:Literal['values', 'errors']='errors', verbose_replace:bool=False,
-        description:str|None=None, config_file:str='config.yml'
+        description:str|None=None, config_file:str='config.yml',
+        stacked:bool=False, pixels:Literal['bbox', 'segmap']='bbox', dilate:int=0,
+        bin_sn:float|None=None, bin_band:str|None=None,
+        store:Literal['folders', 'hdf5']='folders', catalog_format:Literal['csv', 'fits']='csv',
+        streaming:bool=False, workers:int=1, min_valid_bands:int=1
     ) -> int:
     """
     Create and save all data for an EAZY run.
@@ -105,6 +191,31 @@ def prep_for_EAZY(
         Optional description to add to the run
     config_file : str, default config.yml
         Config file to be used
+    stacked : bool, default False
+        If set, each galaxy's values and errors are held as float32 cubes (see `Galaxy.stack`),
+        so replacement, saving and building the EAZY file are vectorised over filters
+    pixels : Literal['bbox', 'segmap'], default bbox
+        Which pixels of each galaxy are fit by EAZY, every pixel of the bbox (plus border) or only the segmap
+    dilate : int, default 0
+        For `segmap`, grow the selection by this many pixels
+    bin_sn : float | None, default None
+        If set, the selected pixels of each galaxy are grouped into bins reaching this S/N,
+        with only the bins fit by EAZY. `bin_band` must also then be set
+    bin_band : str | None, default None
+        Filter in which to measure the S/N for binning
+    store : Literal['folders', 'hdf5'], default folders
+        Save galaxies to a folder each, or to a single HDF5 run store
+    catalog_format : Literal['csv', 'fits'], default csv
+        Format of the EAZY input file, a csv or a FITS binary table
+    streaming : bool, default False
+        If set, galaxies are extracted, saved and written to the EAZY input file a batch at a time,
+        so memory stays bounded however many galaxies are selected
+    workers : int, default 1
+        If more than 1, galaxies are extracted and prepared across this many processes (streaming),
+        each reading the mosaics memory-mapped. Results keep the order of `ids`
+    min_valid_bands : int, default 1
+        Pixels (or bins) with data in fewer filters than this are not written to the EAZY input,
+        and are treated as not fit when extracted. The default drops only pixels with no data at all
 
     Returns
     -------
@@ -112,30 +223,124 @@ def prep_for_EAZY(
         id to identify the run created
     """
 
-    # create galaxy selection
-    data = Data(config_file)
-    galaxies = [extract_galaxy(id, data, border) for id in ids]
-    selection = SelectionGalaxies(galaxies, config_file)
-
     if replace_unused:
         assert unused is not None
         assert replace is not None
-        for gal in selection.galaxies:
-            gal.replace_unused_with_constant(unused, replace, using, verbose_replace)
-
-    selection.save_selection(name)
-
-    # save csv for EAZY
-    run_folder = selection.runmanage.run_folder(selection.run_id)
-    FileEAZY(selection.galaxies).save_csv_file(f'{run_folder}/EAZY_input.csv')
+    if bin_sn is not None:
+        assert bin_band is not None
+
+    options = {
+        'stacked': stacked,
+        'replace_unused': replace_unused, 'unused': unused, 'replace': replace, 'using': using, 'verbose_replace': verbose_replace,
+        'pixels': pixels, 'dilate': dilate,
+        'bin_sn': bin_sn, 'bin_band': bin_band
+    }
+
+    if streaming or (workers > 1):
+        run_id = _prep_streaming(name, ids, border, options, config_file, store, catalog_format, min_valid_bands, workers)
+    else:
+        # create galaxy selection
+        data = get_data(config_file, lazy=True)
+        galaxies = [_prepare_galaxy(gal, options) for gal in extract_galaxies(ids, data, border)]
+        selection = SelectionGalaxies(galaxies, config_file)
+        selection.save_selection(name, store)
+
+        # save csv (or fits) for EAZY
+        run_id = selection.run_id
+        run_folder = selection.runmanage.run_folder(run_id)
+        FileEAZY(selection.galaxies, min_valid_bands).save_file(run_folder, catalog_format)
 
     # copy over config
-    selection.runmanage.make_config_copy(f'{run_folder}/config.yml')
+    runmanage = RunManager(config_file)
+    run_folder = runmanage.run_folder(run_id)
+    runmanage.make_config_copy(f'{run_folder}/config.yml')
 
     if description is not None:
-        selection.runmanage.add_run_description(selection.run_id, description)
+        runmanage.add_run_description(run_id, description)
     
-    return selection.run_id
+    return run_id
+
+
+def _prepare_galaxy(gal:Galaxy, options:dict) -> Galaxy:
+    """Apply the prep steps chosen in `prep_for_EAZY` to a galaxy"""
+
+    if options['stacked']:
+        gal.stack()
+    if options['replace_unused']:
+        gal.replace_unused_with_constant(options['unused'], options['replace'], options['using'], options['verbose_replace'])
+    gal.select_pixels(options['pixels'], options['dilate'])
+    if options['bin_sn'] is not None:
+        gal.bin_pixels(options['bin_sn'], options['bin_band'])
+    return gal
+
+
+_worker_data:Data|None = None
+
+def _init_prep_worker(config_file:str) -> None:
+    # each worker opens the mosaics lazily, sharing pages through the OS cache rather than pickling
+    global _worker_data
+    _worker_data = get_data(config_file, lazy=True)
+
+def _prep_worker_batch(ids:list[int], border:int, options:dict) -> list[Galaxy]:
+    return [_prepare_galaxy(gal, options) for gal in extract_galaxies(ids, _worker_data, border)]
+
+
+def _prep_streaming(
+        name:str, ids:list[int], border:int, options:dict,
+        config_file:str, store:Literal['folders', 'hdf5'], catalog_format:Literal['csv', 'fits'],
+        min_valid_bands:int=1, workers:int=1, batch:int=256
+    ) -> int:
+    """
+    Extract, prepare and save galaxies one batch at a time, streaming rows to the EAZY input file.
+    With `workers` > 1, batches are extracted and prepared across a process pool,
+    with results taken in order so `galaxy_idx` is the same as a serial run,
+    and only a few batches per worker submitted ahead of the one being written.
+    Returns the run id.
+    """
+
+    runmanage = RunManager(config_file)
+    run_id = runmanage.add_run(name, len(ids))
+    run_folder = runmanage.run_folder(run_id)
+    run_store = RunStore(store_path(run_folder)) if (store == 'hdf5') else None
+
+    batches = [ids[start:start+batch] for start in range(0, len(ids), batch)]
+
+    # opening the data builds the catalog sidecar here, so workers only ever load it
+    data = get_data(config_file, lazy=True)
+
+    def prepared_batches(pool:ProcessPoolExecutor|None) -> Iterator[list[Galaxy]]:
+        if pool is None:
+            for batch_ids in batches:
+                yield [_prepare_galaxy(gal, options) for gal in extract_galaxies(batch_ids, data, border)]
+        else:
+            # at most two batches per worker in flight, so finished batches never pile up waiting to be written
+            pending:deque[Future] = deque()
+            for batch_ids in batches:
+                pending.append(pool.submit(_prep_worker_batch, batch_ids, border, options))
+                if len(pending) >= 2 * workers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+    pool = ProcessPoolExecutor(workers, initializer=_init_prep_worker, initargs=(config_file,)) if (workers > 1) else None
+
+    try:
+        with StreamEAZYWriter(run_folder, catalog_format, min_valid_bands=min_valid_bands) as writer:
+            idx = 0
+            for galaxies in prepared_batches(pool):
+                for gal in galaxies:
+                    writer.add(idx, gal)
+                    if run_store is None:
+                        gal.save_data(f'{run_folder}/galaxies/{idx}')
+                    idx += 1
+
+                if run_store is not None:
+                    run_store.append(galaxies)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    return run_id
 
 
 def run_on_galaxies(
@@ -144,7 +349,13 @@ def run_on_galaxies(
         replace_unused:bool=False, unused:float|None=None, replace:float|None=None, using:Literal['values', 'errors']='errors', verbose_replace:bool=False,
         add_params:dict|None=None, param_file:str|None=None, translate_file:str='eazy_files/z_phot.translate',
         save_output:bool=True,
-        description:str|None=None, config_file:str='config.yml'
+        description:str|None=None, config_file:str='config.yml',
+        stacked:bool=False, pixels:Literal['bbox', 'segmap']='bbox', dilate:int=0,
+        bin_sn:float|None=None, bin_band:str|None=None,
+        store:Literal['folders', 'hdf5']='folders', catalog_format:Literal['csv', 'fits']='csv',
+        streaming:bool=False, workers:int=1, min_valid_bands:int=1,
+        fit_workers:int=1, checkpoint:bool=False, coarse_step:int|None=None,
+        chi2_storage:Literal['float64', 'float32', 'compressed', 'topk', 'percentiles']='float64'
     ) -> tuple[int, WrapperEAZY]:
     """
     Will perform a full run with EAZY on the given galaxies.
@@ -186,6 +397,34 @@ def run_on_galaxies(
         Optional description to add to the run
     config_file : str, default config.yml
         Config file to be used
+    stacked : bool, default False
+        If set, galaxies are held as float32 cubes during prep
+    pixels : Literal['bbox', 'segmap'], default bbox
+        Which pixels of each galaxy are fit by EAZY, every pixel of the bbox (plus border) or only the segmap
+    dilate : int, default 0
+        For `segmap`, grow the selection by this many pixels
+    bin_sn : float | None, default None
+        If set, pixels are grouped into bins reaching this S/N in `bin_band`, and only the bins are fit
+    bin_band : str | None, default None
+        Filter in which to measure the S/N for binning
+    store : Literal['folders', 'hdf5'], default folders
+        Save galaxies to a folder each, or to a single HDF5 run store
+    catalog_format : Literal['csv', 'fits'], default csv
+        Format of the EAZY input file, a csv or a FITS binary table
+    streaming : bool, default False
+        If set, prep is done a batch of galaxies at a time, in bounded memory
+    workers : int, default 1
+        Number of processes used for prep
+    min_valid_bands : int, default 1
+        Pixels with data in fewer filters than this are not fit
+    fit_workers : int, default 1
+        Number of processes the EAZY fit is split across (see `WrapperEAZY.run_EAZY_fit_parallel`)
+    checkpoint : bool, default False
+        If set, the fit is saved a chunk at a time, so that if interrupted it can be finished with `photometry.resume`
+    coarse_step : int | None, default None
+        If set, EAZY fits every `coarse_step`-th redshift first, then finely only around the best coarse minima
+    chi2_storage : Literal['float64', 'float32', 'compressed', 'topk', 'percentiles'], default float64
+        How chi2 is saved, dense at some precision or a reduced form (see `photometry.encode_chi2`)
 
     Returns
     -------
@@ -195,10 +434,17 @@ def run_on_galaxies(
         The `WrapperEAZY` object created in process
     """
 
-    run_id = prep_for_EAZY(name, ids, border, replace_unused, unused, replace, using, verbose_replace, description, config_file)
+    run_id = prep_for_EAZY(
+        name, ids, border, replace_unused, unused, replace, using, verbose_replace, description, config_file,
+        stacked=stacked, pixels=pixels, dilate=dilate, bin_sn=bin_sn, bin_band=bin_band,
+        store=store, catalog_format=catalog_format, streaming=streaming, workers=workers,
+        min_valid_bands=min_valid_bands
+    )
 
     runner = WrapperEAZY(run_id, config_file)
-    runner.init_and_run_EAZY(save_output, add_params, param_file, translate_file)
+    runner.init_and_run_EAZY(save_output, add_params, param_file, translate_file, workers=fit_workers, checkpoint=checkpoint,
+        coarse_step=coarse_step, chi2_storage=chi2_storage
+    )
 
 
     return run_id, runner
@@ -1,2 +1,5 @@
 from .galaxy import *
-from .phot_galaxy import *
\ No newline at end of file
+from .phot_galaxy import *
+from .binning import *
+from .store import *
+from .posterior import *
@@ -0,0 +1,170 @@
+import numpy as np
+
+
+__all__ = ['accrete_bins', 'combine_bins']
+
+
+def _add_neighbours(frontier:set[tuple[int, int]], y:int, x:int, unbinned:np.ndarray) -> None:
+    """Add the unbinned pixels next to (y, x) to the frontier of a bin"""
+    for ny, nx in ((y-1, x), (y+1, x), (y, x-1), (y, x+1)):
+        if 0 <= ny < unbinned.shape[0] and 0 <= nx < unbinned.shape[1] and unbinned[ny, nx]:
+            frontier.add((ny, nx))
+
+
+def accrete_bins(signal:np.ndarray, noise:np.ndarray, mask:np.ndarray, target_sn:float) -> np.ndarray:
+    """
+    Group pixels into spatially connected bins that reach a target S/N,
+    following the bin-accretion stage of Cappellari & Copin (2003).
+
+    Bins are started from the highest S/N pixel not yet binned, and grown by adding the
+    neighbouring pixel closest to the bin centroid until the target is reached.
+    Pixels left in bins that cannot reach the target are taken by the successful bins they touch,
+    or by the nearest successful bin if not connected to one.
+
+    Parameters
+    ----------
+    signal, noise : array
+        2D images of the signal and its error, in the band used to bin
+    mask : array[bool]
+        Pixels that may be binned, all others are left out
+    target_sn : float
+        S/N each bin should reach
+
+    Returns
+    -------
+    bin_map : ndarray[int]
+        Bin of each pixel, numbered from 0, with -1 for pixels not in any bin
+    """
+
+    shape = signal.shape
+    bin_map = np.full(shape, -1, dtype=int)
+
+    ys, xs = np.nonzero(mask)
+    if ys.size == 0:
+        return bin_map
+
+    variance = noise**2
+    pixel_sn = signal[ys, xs] / noise[ys, xs]
+    unbinned = np.zeros(shape, dtype=bool)
+    unbinned[ys, xs] = True
+
+    good_bins:list[int] = []
+    n_bins = 0
+    for start in np.argsort(-pixel_sn):
+        y0, x0 = ys[start], xs[start]
+        if not unbinned[y0, x0]:
+            continue
+
+        members_y, members_x = [y0], [x0]
+        unbinned[y0, x0] = False
+        sum_signal, sum_variance = signal[y0, x0], variance[y0, x0]
+
+        # unbinned pixels adjacent to the bin, kept up to date as pixels are added
+        frontier:set[tuple[int, int]] = set()
+        _add_neighbours(frontier, y0, x0, unbinned)
+
+        while sum_signal / np.sqrt(sum_variance) < target_sn and frontier:
+            cy, cx = np.mean(members_y), np.mean(members_x)
+            ny, nx = min(frontier, key=lambda p: (p[0] - cy)**2 + (p[1] - cx)**2)
+            frontier.remove((ny, nx))
+
+            members_y.append(ny)
+            members_x.append(nx)
+            unbinned[ny, nx] = False
+            sum_signal += signal[ny, nx]
+            sum_variance += variance[ny, nx]
+            _add_neighbours(frontier, ny, nx, unbinned)
+
+        bin_map[members_y, members_x] = n_bins
+        if sum_signal / np.sqrt(sum_variance) >= target_sn:
+            good_bins.append(n_bins)
+        n_bins += 1
+
+    good_bins_arr = np.array(good_bins, dtype=int)
+    if good_bins_arr.size == 0:
+        # nothing reaches the target, so fit everything as a single bin
+        bin_map[ys, xs] = 0
+        return bin_map
+
+    # reassign pixels of failed bins to the good bins they touch, growing the good bins outwards
+    # (taking the bin with the nearest centroid where several touch), so bins stay connected
+    flat = bin_map[ys, xs]
+    counts = np.bincount(flat, minlength=n_bins)
+    cy = np.bincount(flat, weights=ys, minlength=n_bins) / counts
+    cx = np.bincount(flat, weights=xs, minlength=n_bins) / counts
+
+    good = np.isin(bin_map, good_bins_arr)
+    pending = (bin_map >= 0) & ~good
+    assigned = np.where(good, bin_map, -1)
+    while np.any(pending):
+        py, px = np.nonzero(pending)
+        padded = np.pad(assigned, 1, constant_values=-1)
+        touching = np.stack([padded[py, px+1], padded[py+2, px+1], padded[py+1, px], padded[py+1, px+2]])
+        d2 = np.where(touching >= 0, (py - cy[touching])**2 + (px - cx[touching])**2, np.inf)
+        reached = np.isfinite(np.min(d2, axis=0))
+        if not np.any(reached):
+            break
+        nearest = touching[np.argmin(d2, axis=0), np.arange(py.size)]
+        assigned[py[reached], px[reached]] = nearest[reached]
+        pending[py[reached], px[reached]] = False
+
+    # any not connected to a good bin go to the nearest good bin centroid
+    py, px = np.nonzero(pending)
+    if py.size:
+        d2 = (py[:, None] - cy[good_bins_arr])**2 + (px[:, None] - cx[good_bins_arr])**2
+        assigned[py, px] = good_bins_arr[np.argmin(d2, axis=1)]
+    flat = assigned[ys, xs]
+
+    # renumber to consecutive bins
+    renumber = np.full(n_bins, -1, dtype=int)
+    renumber[good_bins_arr] = np.arange(good_bins_arr.size)
+    bin_map[ys, xs] = renumber[flat]
+
+    return bin_map
+
+
+def combine_bins(
+        values:np.ndarray, errors:np.ndarray, bin_map:np.ndarray, missing:float|None=None
+    ) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Combine the photometry of the pixels in each bin, summing fluxes and adding errors in quadrature.
+
+    Parameters
+    ----------
+    values, errors : array
+        Shape (n_filters, H, W) of the values and errors
+    bin_map : array[int]
+        Bin of each pixel, -1 for pixels not binned
+    missing : float | None, default None
+        Value marking missing data. A bin with any missing pixel in a filter is set to this value in that filter
+
+    Returns
+    -------
+    bin_values, bin_errors : ndarray
+        Shape (n_filters, n_bins) of the combined values and errors
+    """
+
+    flat = bin_map.ravel()
+    binned = flat >= 0
+    bins = flat[binned]
+    n_bins = int(bins.max()) + 1 if bins.size else 0
+    n_filters = values.shape[0]
+
+    values = values.reshape(n_filters, -1)[:, binned]
+    errors = errors.reshape(n_filters, -1)[:, binned]
+
+    # offset each filter so a single bincount covers them all
+    offsets = (np.arange(n_filters) * n_bins)[:, np.newaxis]
+    index = (bins[np.newaxis, :] + offsets).ravel()
+    size = n_filters * n_bins
+
+    bin_values = np.bincount(index, weights=values.ravel(), minlength=size).reshape(n_filters, n_bins)
+    bin_errors = np.sqrt(np.bincount(index, weights=(errors**2).ravel(), minlength=size)).reshape(n_filters, n_bins)
+
+    if missing is not None:
+        is_missing = (values == missing) | (errors == missing)
+        bin_missing = np.bincount(index, weights=is_missing.ravel(), minlength=size).reshape(n_filters, n_bins) > 0
+        bin_values[bin_missing] = missing
+        bin_errors[bin_missing] = missing
+
+    return bin_values, bin_errors
@@ -4,8 +4,24 @@ import os
 import json
 import numpy as np
 
+from .binning import accrete_bins, combine_bins
 
-__all__ = ['Galaxy', 'load_galaxy_from_folder']
+
+__all__ = ['Galaxy', 'load_galaxy_data', 'load_galaxy_from_folder']
+
+
+def _dilate_mask(mask:np.ndarray, n:int) -> np.ndarray:
+    """Binary dilation of a mask by a disk of radius `n` pixels"""
+
+    dilated = mask.copy()
+    H, W = mask.shape
+    for dy in range(-n, n+1):
+        for dx in range(-n, n+1):
+            if (dy == 0 and dx == 0) or (dy*dy + dx*dx > n*n):
+                continue
+            dilated[max(dy, 0):H+min(dy, 0), max(dx, 0):W+min(dx, 0)] |= \
+                mask[max(-dy, 0):H+min(-dy, 0), max(-dx, 0):W+min(-dx, 0)]
+    return dilated
 
 
 class Galaxy():
@@ -25,6 +41,8 @@ class Galaxy():
         Value and error images for each of the filters
     segmap : array
         Segmentation image
+    stacked : bool, default False
+        If set, values and errors are backed by contiguous float32 cubes (see `stack`)
 
     Attributes (additional)
     ----------
@@ -32,11 +50,24 @@ class Galaxy():
         Shape and size of all images in the object
     pixel_ids : ndarray
         ids map of the different pixels in the galaxy, increasing first in x (`pixel_ids[0,1]=1` etc)
+    segmap_mask : ndarray[bool]
+        True on the pixels belonging to the object in the segmap, computed once on first access
+    filters : list[str]
+        Filter names, in the order of the cube axis
+    value_cube, error_cube : ndarray | None
+        Shape (n_filters, H, W) float32 cubes backing `values` and `errors`, `None` if not stacked
+    selected : ndarray[bool] | None
+        Pixels selected to be fit, `None` if all pixels of the bbox are used (see `select_pixels`)
+    unused_value : float | None
+        Value marking pixels without data, once set by `replace_unused_with_constant`
+    bin_map : ndarray[int] | None
+        Bin of each pixel when binned (see `bin_pixels`), -1 for pixels not fit, `None` if not binned
     """
 
     def __init__(
             self, id:int, centroid:tuple[float], bbox:np.ndarray,
-            values:dict[str, np.ndarray], errors:dict[str, np.ndarray], segmap:np.ndarray
+            values:dict[str, np.ndarray], errors:dict[str, np.ndarray], segmap:np.ndarray,
+            stacked:bool=False
         ) -> None:
         
         self.id = id
@@ -58,7 +89,135 @@ class Galaxy():
         self.pixel_ids_flat = np.arange(self.size, dtype=int)
         self.pixel_ids = self.pixel_ids_flat.reshape(self.shape)
 
+        self._segmap_mask:np.ndarray|None = None
+
+        self.selected:np.ndarray|None = None
+        self.selection:dict = {'pixels': 'bbox', 'dilate': 0}
+        self.unused_value:float|None = None
+        self.bin_map:np.ndarray|None = None
+        self.binning:dict|None = None
+
+        self.filters:list[str] = list(values.keys())
+        self.value_cube:np.ndarray|None = None
+        self.error_cube:np.ndarray|None = None
+        if stacked:
+            self.stack()
+
+    @property
+    def segmap_mask(self) -> np.ndarray:
+        if self._segmap_mask is None:
+            self._segmap_mask = (self.segmap == self.id)
+        return self._segmap_mask
+
     
+    def stack(self) -> None:
+        """
+        Copy values and errors into contiguous (n_filters, H, W) float32 cubes.
+        The `values` and `errors` dicts are replaced with views into the cubes,
+        so per-filter access still works, while whole-galaxy operations act on the cubes at once.
+        """
+
+        if self.stacked:
+            return
+
+        value_cube = np.stack([self.values[filt] for filt in self.filters]).astype(np.float32, copy=False)
+        error_cube = np.stack([self.errors[filt] for filt in self.filters]).astype(np.float32, copy=False)
+        self.use_cubes(self.filters, value_cube, error_cube)
+
+    def use_cubes(self, filters:list[str], value_cube:np.ndarray, error_cube:np.ndarray) -> None:
+        """
+        Back values and errors with the given cubes, without copying.
+
+        Parameters
+        ----------
+        filters : list[str]
+            Filter names, in the order of the first axis of the cubes
+        value_cube, error_cube : array
+            Shape (n_filters, H, W) value and error cubes
+        """
+
+        self.filters = list(filters)
+        self.value_cube = value_cube
+        self.error_cube = error_cube
+        self.values = {filt: value_cube[i] for (i, filt) in enumerate(self.filters)}
+        self.errors = {filt: error_cube[i] for (i, filt) in enumerate(self.filters)}
+
+    @property
+    def stacked(self) -> bool:
+        return self.value_cube is not None
+
+    def select_pixels(self, pixels:Literal['bbox', 'segmap']='bbox', dilate:int=0) -> None:
+        """
+        Choose which pixels of the galaxy are to be fit.
+
+        Parameters
+        ----------
+        pixels : Literal['bbox', 'segmap'], default bbox
+            `bbox` uses every pixel of the image, `segmap` only those of the object in the segmap
+        dilate : int, default 0
+            For `segmap`, grow the selection by this many pixels (within a disk)
+        """
+
+        self.selection = {'pixels': pixels, 'dilate': int(dilate)}
+
+        if pixels == 'bbox':
+            self.selected = None
+        elif pixels == 'segmap':
+            self.selected = _dilate_mask(self.segmap_mask, dilate)
+        else:
+            raise ValueError(f'Unknown pixel selection {pixels}')
+
+    def bin_pixels(self, target_sn:float, band:str) -> None:
+        """
+        Group the selected pixels into spatial bins reaching a target S/N in the given band,
+        so that each bin is fit as one row rather than each pixel (see `binning.accrete_bins`).
+        Pixels with no data in the band are left out of the bins.
+
+        Parameters
+        ----------
+        target_sn : float
+            S/N each bin should reach
+        band : str
+            Filter in which to measure the S/N
+        """
+
+        signal = self.values[band]
+        noise = self.errors[band]
+
+        mask = (noise > 0)
+        if self.selected is not None:
+            mask &= self.selected
+        if self.unused_value is not None:
+            mask &= (signal != self.unused_value) & (noise != self.unused_value)
+
+        self.bin_map = accrete_bins(signal, noise, mask, target_sn)
+        self.binning = {'target_sn': float(target_sn), 'band': band}
+
+    @property
+    def n_bins(self) -> int:
+        return 0 if self.bin_map is None else int(self.bin_map.max()) + 1
+
+    def binned_pixel_data(self) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Combined values and errors of each bin, each shape (n_filters, n_bins).
+        Fluxes are summed and errors added in quadrature, with a bin missing in a filter if any of its pixels are.
+        """
+
+        if self.stacked:
+            value_cube, error_cube = self.value_cube, self.error_cube
+        else:
+            value_cube = np.stack([self.values[filt] for filt in self.filters])
+            error_cube = np.stack([self.errors[filt] for filt in self.filters])
+
+        return combine_bins(value_cube, error_cube, self.bin_map, self.unused_value)
+
+    @property
+    def selected_pixel_ids(self) -> np.ndarray:
+        """Flat ids of the pixels selected to be fit"""
+        if self.selected is None:
+            return self.pixel_ids_flat
+        return self.pixel_ids_flat[self.selected.ravel()]
+
     def __repr__(self) -> str:
         string = f'Galaxy: {self.id}, (X,Y)({self.X}, {self.Y}), shape{self.shape}'
         return string
@@ -71,7 +230,10 @@ class Galaxy():
             'xmax': int(self.xmax),
             'ymin': int(self.ymin),
             'ymax': int(self.ymax),
-            'shape': self.shape
+            'shape': self.shape,
+            'selection': self.selection,
+            'unused_value': self.unused_value,
+            'binning': self.binning
         }
     
 
@@ -94,6 +256,18 @@ class Galaxy():
             Control verbosity as executing
         """
         
+        self.unused_value = replace
+
+        if self.stacked:
+            # single vectorised replacement over all filters, in place so the dict views stay valid
+            using_cube = self.value_cube if (using == 'values') else self.error_cube
+            condition = (using_cube == unused)
+            self.value_cube[condition] = replace
+            self.error_cube[condition] = replace
+            if verbose:
+                print(f'Replaced {np.count_nonzero(condition)} values')
+            return
+
         using_images:dict[str, np.ndarray] = getattr(self, using)
 
         if verbose:
@@ -124,9 +298,27 @@ class Galaxy():
         with open(f'{folder}/info.txt', 'w') as f:
                 json.dump(self.info_dict(), f)
 
-        np.savez(f'{folder}/values.npz', **self.values)
-        np.savez(f'{folder}/errors.npz', **self.errors)
+        if self.stacked:
+            np.savez(f'{folder}/cubes.npz', filters=self.filters, values=self.value_cube, errors=self.error_cube)
+        else:
+            np.savez(f'{folder}/values.npz', **self.values)
+            np.savez(f'{folder}/errors.npz', **self.errors)
         np.save(f'{folder}/segmap.npy', self.segmap)
+        if self.bin_map is not None:
+            np.save(f'{folder}/bins.npy', self.bin_map)
+
+    def save_to_store(self, filepath:str) -> None:
+        """
+        Append galaxy to the end of a run store (see `store.RunStore`), in place of a folder.
+
+        Parameters
+        ----------
+        filepath : str
+            HDF5 file of the store
+        """
+
+        from .store import RunStore
+        RunStore(filepath).append([self])
 
 
     def __key(self) -> tuple:
@@ -142,26 +334,68 @@ class Galaxy():
             return False
 
 
-def load_galaxy_from_folder(folder:str) -> Galaxy:
+def load_galaxy_data(folder:str) -> tuple[dict, dict[str, np.ndarray], dict[str, np.ndarray], np.ndarray, tuple[tuple], tuple|None]:
     """
-    Load galaxy from from given folder path
+    Loads basic galaxy data from given folder path
 
     Returns
     -------
-    galaxy : Galaxy
-        Loaded object
+    info : dict
+    values : dict[str, ndarray]
+    errors : dict[str, ndarray]
+    segmap : ndarray
+    bbox : tuple[tuple]
+    cubes : tuple | None
+        (filters, value_cube, error_cube) if the galaxy was saved stacked, else `None`
     """
 
     with open(f'{folder}/info.txt') as f:
         info = json.load(f)
-    
-    values = np.load(f'{folder}/values.npz')
-    errors = np.load(f'{folder}/errors.npz')
+
+    if os.path.isfile(f'{folder}/cubes.npz'):
+        with np.load(f'{folder}/cubes.npz') as saved:
+            filters = [str(filt) for filt in saved['filters']]
+            cubes = (filters, saved['values'], saved['errors'])
+        values = {filt: cubes[1][i] for (i, filt) in enumerate(filters)}
+        errors = {filt: cubes[2][i] for (i, filt) in enumerate(filters)}
+    else:
+        cubes = None
+        values = np.load(f'{folder}/values.npz')
+        errors = np.load(f'{folder}/errors.npz')
     segmap = np.load(f'{folder}/segmap.npy')
 
     bbox = ((info['ymin'], info['ymax']), (info['xmin'], info['xmax']))
 
+    return info, values, errors, segmap, bbox, cubes
+
+def load_galaxy_from_folder(folder:str) -> Galaxy:
+    """
+    Load galaxy from from given folder path
+
+    If the folder does not exist, but is within a run saved to a store (`<run>/galaxies/<idx>`),
+    the galaxy is instead read from the store (`<run>/galaxies.h5`).
+
+    Returns
+    -------
+    galaxy : Galaxy
+        Loaded object
+    """
+
+    store_file = f'{os.path.dirname(os.path.normpath(folder))}.h5'
+    if (not os.path.isdir(folder)) and os.path.isfile(store_file):
+        from .store import RunStore
+        return RunStore(store_file).read(int(os.path.basename(os.path.normpath(folder))))
+
+    info, values, errors, segmap, bbox, cubes = load_galaxy_data(folder)
+
     galaxy = Galaxy(info['id'], info['centroid'], bbox, values, errors, segmap)
+    if cubes is not None:
+        galaxy.use_cubes(*cubes)
+    if 'selection' in info:
+        galaxy.select_pixels(**info['selection'])
+    galaxy.unused_value = info.get('unused_value')
+    if os.path.isfile(f'{folder}/bins.npy'):
+        galaxy.bin_map = np.load(f'{folder}/bins.npy')
+        galaxy.binning = info.get('binning')
 
     return galaxy
-
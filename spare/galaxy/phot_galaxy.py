@@ -1,50 +1,159 @@
 import numpy as np
 
 from .galaxy import Galaxy
+from .posterior import log_pz, pz_stats
 
 
 class PhotGalaxy(Galaxy):
     """
     zbest and chi2 should be passed as 1D and 2D arrays respective
     Later have functions to produced reshaped
+
+    If `pixel_ids` is given, zbest and chi2 are only for those (flat) pixels,
+    and are scattered back into the full image, with the other pixels treated as not fit.
+    If `bin_map` is also given, the rows are instead bins with ids `pixel_ids`,
+    and each pixel takes the zbest and chi2 of its bin.
+
+    Only the chi2 of the rows fit is kept (`fit_chi2`), with the row of each fitted pixel,
+    so pixels not fit take no memory and a bin's chi2 is held once for all its pixels.
+    Reductions over pixels are then weighted sums of these rows (see `pixel_weights`).
+
+    Attributes (additional)
+    ----------
+    zbest : ndarray
+        Best redshift of each (flat) pixel, NaN where not fit
+    no_fit_mask : ndarray[bool]
+        True on the (flat) pixels not fit
+    fit_pixels : ndarray[int]
+        Flat index of each pixel fit
+    fit_rows : ndarray[int]
+        Row of `fit_chi2` of each pixel in `fit_pixels`
+    fit_chi2 : ndarray
+        Shape (n_rows, NZ) chi2 of the rows fit
+    chi2_integral : ndarray | None
+        Summed-area table of chi2, kept by `build_chi2_integral` until `clear_chi2_integral`
     """
 
     def __init__(
         self, id:int, centroid:tuple[float], bbox:np.ndarray,
         values:dict[str,np.ndarray], errors:dict[str, np.ndarray], segmap:np.ndarray,
         zgrid:np.ndarray, zbest:np.ndarray, chi2:np.ndarray,
-        no_fit_value:float=-1
+        no_fit_value:float=-1, pixel_ids:np.ndarray|None=None, bin_map:np.ndarray|None=None
     ) -> None:
         super().__init__(id, centroid, bbox, values, errors, segmap)
 
         self.zgrid = zgrid
 
-        self.no_fit_mask = (zbest == no_fit_value)
+        if bin_map is not None:
+            # map each binned pixel to the row of its bin
+            self.bin_map = bin_map
+            if pixel_ids is None:
+                pixel_ids = np.arange(len(zbest))
+            bins = bin_map.ravel()
+            row_of_bin = np.full(max(bins.max(), np.max(pixel_ids, initial=-1)) + 1, -1, dtype=int)
+            row_of_bin[pixel_ids] = np.arange(len(pixel_ids))
+            rows = np.where(bins >= 0, row_of_bin[bins], -1)
+        elif pixel_ids is not None:
+            rows = np.full(self.size, -1, dtype=int)
+            rows[pixel_ids] = np.arange(len(pixel_ids))
+        else:
+            rows = np.arange(self.size)
 
-        self.zbest = np.ma.masked_array(zbest, mask=self.no_fit_mask)
-        self.chi2 = np.ma.masked_array(
-            chi2, mask=np.repeat(
-                self.no_fit_mask[:, np.newaxis], chi2.shape[1], axis=1
-            )
-        )
+        # rows whose fit failed are treated as not fit
+        rows[rows >= 0] = np.where(zbest[rows[rows >= 0]] == no_fit_value, -1, rows[rows >= 0])
+
+        self.fit_pixels = np.flatnonzero(rows >= 0)
+        self.no_fit_mask = (rows < 0)
 
+        # keep only the rows used by some pixel
+        used, self.fit_rows = np.unique(rows[self.fit_pixels], return_inverse=True)
+        self.fit_chi2 = np.asarray(chi2)[used]
+
+        self.zbest = np.full(self.size, np.nan)
+        self.zbest[self.fit_pixels] = zbest[used][self.fit_rows]
 
         self.total_chi2:np.ndarray|None = None
         self.zchi2:float|None = None
 
+        self.chi2_integral:np.ndarray|None = None
+
+    @classmethod
+    def from_galaxy(
+        cls, galaxy:Galaxy,
+        zgrid:np.ndarray, zbest:np.ndarray, chi2:np.ndarray,
+        no_fit_value:float=-1, pixel_ids:np.ndarray|None=None
+    ) -> 'PhotGalaxy':
+        """
+        Create from a `Galaxy` and its fit results, keeping its cubes, pixel selection and bins.
+        """
+
+        phot_galaxy = cls(
+            galaxy.id, galaxy.centroid, galaxy.bbox,
+            galaxy.values, galaxy.errors, galaxy.segmap,
+            zgrid, zbest, chi2,
+            no_fit_value, pixel_ids, galaxy.bin_map
+        )
+        if galaxy.stacked:
+            phot_galaxy.use_cubes(galaxy.filters, galaxy.value_cube, galaxy.error_cube)
+        phot_galaxy.selected = galaxy.selected
+        phot_galaxy.selection = galaxy.selection
+        phot_galaxy.unused_value = galaxy.unused_value
+        phot_galaxy.binning = galaxy.binning
+
+        return phot_galaxy
+
     def __repr__(self) -> str:
         string =  super().__repr__()
         return f'Phot{string}'
     
     def zbest_reshaped(self) -> np.ndarray:
         return self.zbest.reshape(self.shape)
-    
+
+    @property
+    def chi2(self) -> np.ndarray:
+        """Shape (size, NZ) chi2 of every (flat) pixel, NaN where not fit. Built on each access"""
+        chi2 = np.full((self.size, len(self.zgrid)), np.nan, dtype=np.result_type(self.fit_chi2, np.float32))
+        chi2[self.fit_pixels] = self.fit_chi2[self.fit_rows]
+        return chi2
+
     def chi2_reshaped(self) -> np.ndarray:
-        return self.chi2.reshape([*self.shape, self.chi2.shape[-1]])
-    
+        return self.chi2.reshape([*self.shape, len(self.zgrid)])
+
+    def pixel_chi2(self, y_idx:int, x_idx:int) -> np.ndarray:
+        """chi2 of a single pixel, NaN if not fit"""
+
+        flat = np.ravel_multi_index((y_idx, x_idx), self.shape)
+        if self.no_fit_mask[flat]:
+            return np.full(len(self.zgrid), np.nan)
+        return self.fit_chi2[self.fit_rows[np.searchsorted(self.fit_pixels, flat)]]
+
+    def max_chi2_map(self) -> np.ndarray:
+        """Image of the maximum chi2 over the zgrid of each pixel, NaN where not fit"""
+
+        max_chi2 = np.full(self.size, np.nan)
+        max_chi2[self.fit_pixels] = np.max(self.fit_chi2, axis=1)[self.fit_rows]
+        return max_chi2.reshape(self.shape)
+
+    def pixel_weights(self, pixels:np.ndarray|None=None) -> np.ndarray:
+        """
+        Number of the given pixels fit by each row of `fit_chi2`,
+        so that the chi2 summed over the pixels is `pixel_weights(pixels) @ fit_chi2`
+
+        Parameters
+        ----------
+        pixels : array | None, default None
+            Image of the pixels to include (nonzero), all pixels fit if not set
+        """
+
+        if pixels is None:
+            fit_rows = self.fit_rows
+        else:
+            fit_rows = self.fit_rows[np.ravel(pixels)[self.fit_pixels] != 0]
+        return np.bincount(fit_rows, minlength=len(self.fit_chi2))
+
 
     def calc_zchi2(self) -> None:
-        self.total_chi2 = np.sum(self.chi2, axis=0)
+        self.total_chi2 = self.pixel_weights() @ self.fit_chi2
         self.zchi2 = self.zgrid[np.argmin(self.total_chi2)]
 
     
@@ -69,12 +178,272 @@ class PhotGalaxy(Galaxy):
         """
 
         if pixels is None:
-            pixels = (self.segmap == self.id)
+            pixels = self.segmap_mask
 
-        chi2_pixels = self.chi2_reshaped()[np.nonzero(pixels)]
-
-        total_chi2 = np.sum(chi2_pixels, axis=0)
+        total_chi2 = self.pixel_weights(pixels) @ self.fit_chi2
         zchi2 = self.zgrid[np.argmin(total_chi2)]
 
         return zchi2, total_chi2
 
+    def _build_integral(self) -> np.ndarray:
+        """Summed-area table of chi2, shape (H+1, W+1, NZ)"""
+
+        integral = np.zeros((self.shape[0] + 1, self.shape[1] + 1, len(self.zgrid)))
+        y, x = np.unravel_index(self.fit_pixels, self.shape)
+        integral[y + 1, x + 1] = self.fit_chi2[self.fit_rows]
+        np.cumsum(integral, axis=0, out=integral)
+        np.cumsum(integral, axis=1, out=integral)
+        return integral
+
+    def build_chi2_integral(self) -> None:
+        """
+        Build the summed-area table of chi2 into `chi2_integral`, of shape (H+1, W+1, NZ),
+        where `chi2_integral[y, x]` is the chi2 summed over pixels `[:y, :x]` (pixels not fit add zero).
+        The total over any rectangle is then 4 lookups, and over any mask 4 per run of pixels in a row.
+
+        Takes 8 bytes per pixel per redshift, so is only kept when built here, until `clear_chi2_integral`.
+        Otherwise `calc_zchi2_rects` and `calc_zchi2_regions` build it for each call and drop it after,
+        so galaxies held (e.g. in the cache of `Extract`) do not hold it.
+        """
+
+        self.chi2_integral = self._build_integral()
+
+    def clear_chi2_integral(self) -> None:
+        """Drop the summed-area table kept by `build_chi2_integral`"""
+        self.chi2_integral = None
+
+    def _integral_sums(self, y0:np.ndarray, y1:np.ndarray, x0:np.ndarray, x1:np.ndarray) -> np.ndarray:
+        """chi2 summed over rectangles `[y0:y1, x0:x1]`, shape (n, NZ)"""
+
+        S = self.chi2_integral if (self.chi2_integral is not None) else self._build_integral()
+        return S[y1, x1] - S[y0, x1] - S[y1, x0] + S[y0, x0]
+
+    def _fit_counts(self, y0:np.ndarray, y1:np.ndarray, x0:np.ndarray, x1:np.ndarray) -> np.ndarray:
+        """Number of pixels fit in rectangles `[y0:y1, x0:x1]`, shape (n,)"""
+
+        S = np.zeros((self.shape[0] + 1, self.shape[1] + 1), dtype=int)
+        S[1:, 1:] = ~self.no_fit_mask.reshape(self.shape)
+        np.cumsum(S, axis=0, out=S)
+        np.cumsum(S, axis=1, out=S)
+        return S[y1, x1] - S[y0, x1] - S[y1, x0] + S[y0, x0]
+
+    def calc_zchi2_rects(self, rects:np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Estimate redshift using chi2 method over many rectangular regions at once,
+        from the summed-area table (see `build_chi2_integral`)
+
+        Parameters
+        ----------
+        rects : array
+            Shape (n, 4) of (ymin, ymax, xmin, xmax) of each region, with max exclusive.
+            Clipped to the image
+
+        Returns
+        -------
+        zchi2 : ndarray
+            Shape (n,) of the value that minimises the total chi2 of each region, NaN where no pixel was fit
+        total_chi2 : ndarray
+            Shape (n, NZ) of the summed chi2 of each region
+        """
+
+        rects = np.atleast_2d(np.asarray(rects, dtype=int))
+        y0, y1 = (np.clip(rects[:, i], 0, self.shape[0]) for i in [0, 1])
+        x0, x1 = (np.clip(rects[:, i], 0, self.shape[1]) for i in [2, 3])
+        y1, x1 = np.maximum(y1, y0), np.maximum(x1, x0)
+
+        total_chi2 = self._integral_sums(y0, y1, x0, x1)
+        n_fit = self._fit_counts(y0, y1, x0, x1)
+        zchi2 = np.where(n_fit > 0, self.zgrid[np.argmin(total_chi2, axis=1)], np.nan)
+
+        return zchi2, total_chi2
+
+    def calc_zchi2_regions(self, regions:np.ndarray|list[np.ndarray]) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Estimate redshift using chi2 method over many regions of any shape at once
+        (apertures, annuli, sub-regions), from the summed-area table (see `build_chi2_integral`).
+        Each region is split into runs of pixels along rows, with each run a single lookup,
+        so the chi2 summed goes with the number of runs rather than pixels.
+        Finding the runs still passes once over every pixel of the (n, H, W) stack of masks.
+
+        Parameters
+        ----------
+        regions : array | list[array]
+            Shape (n, H, W) stack of masks, nonzero on the pixels of each region
+
+        Returns
+        -------
+        zchi2 : ndarray
+            Shape (n,) of the value that minimises the total chi2 of each region, NaN where no pixel was fit
+        total_chi2 : ndarray
+            Shape (n, NZ) of the summed chi2 of each region
+        """
+
+        regions = np.asarray(regions) != 0
+        if regions.ndim == 2:
+            regions = regions[np.newaxis]
+        if regions.shape[1:] != self.shape:
+            raise ValueError(f'Regions of shape {regions.shape[1:]} do not match galaxy of shape {self.shape}')
+
+        # starts and stops of each run along x, in the same (region, row) order
+        edges = np.diff(np.pad(regions, ((0, 0), (0, 0), (1, 1))).astype(np.int8), axis=2)
+        region, y, x0 = np.nonzero(edges == 1)
+        x1 = np.nonzero(edges == -1)[2]
+
+        run_chi2 = self._integral_sums(y, y + 1, x0, x1)
+
+        # sum the runs of each region, with empty regions left at zero
+        total_chi2 = np.zeros((len(regions), len(self.zgrid)))
+        n_runs = np.bincount(region, minlength=len(regions))
+        if run_chi2.size:
+            starts = np.concatenate([[0], np.cumsum(n_runs)[:-1]])
+            total_chi2[n_runs > 0] = np.add.reduceat(run_chi2, starts[n_runs > 0], axis=0)
+
+        n_fit = np.count_nonzero(regions.reshape(len(regions), -1)[:, self.fit_pixels], axis=1)
+        zchi2 = np.where(n_fit > 0, self.zgrid[np.argmin(total_chi2, axis=1)], np.nan)
+
+        return zchi2, total_chi2
+
+    def region_weights(self, regions:np.ndarray|list[np.ndarray]) -> np.ndarray:
+        """
+        `pixel_weights` of many regions at once, so that their summed chi2 is `region_weights(regions) @ fit_chi2`
+
+        Parameters
+        ----------
+        regions : array | list[array]
+            Shape (n, H, W) stack of masks, nonzero on the pixels of each region
+
+        Returns
+        -------
+        weights : ndarray
+            Shape (n, n_rows)
+        """
+
+        regions = np.asarray(regions).reshape(-1, self.size)
+        selected = (regions[:, self.fit_pixels] != 0)
+        n, n_rows = len(regions), len(self.fit_chi2)
+
+        index = np.arange(n)[:, np.newaxis] * n_rows + self.fit_rows
+        weights = np.bincount(index.ravel(), weights=selected.ravel(), minlength=n*n_rows)
+        return weights.reshape(n, n_rows)
+
+    def pixel_pz_stats(self, peak_threshold:float=0.05) -> dict[str, np.ndarray]:
+        """
+        Statistics of the p(z) of every pixel (see `pz_stats`), computed once per row fit
+
+        Parameters
+        ----------
+        peak_threshold : float, default 0.05
+            Height relative to the maximum for a local maximum of p(z) to count as a peak
+
+        Returns
+        -------
+        stats : dict[str, ndarray]
+            Image of each of `PZ_STATS`, NaN where not fit
+        """
+
+        row_stats = pz_stats(self.fit_chi2, self.zgrid, peak_threshold)
+
+        stats = {}
+        for name, values in row_stats.items():
+            image = np.full(self.size, np.nan)
+            image[self.fit_pixels] = values[self.fit_rows]
+            stats[name] = image.reshape(self.shape)
+        return stats
+
+    def region_log_pz(self, regions:np.ndarray|list[np.ndarray]|None=None) -> np.ndarray:
+        """
+        Normalised log p(z) of the pixels of each region combined, from their summed chi2
+
+        Parameters
+        ----------
+        regions : array | list[array] | None, default None
+            Shape (n, H, W) stack of masks, nonzero on the pixels of each region.
+            If not set, the single region of the segmap
+
+        Returns
+        -------
+        log_pz : ndarray
+            Shape (n, NZ)
+        """
+
+        if regions is None:
+            regions = self.segmap_mask[np.newaxis]
+        return log_pz(self.region_weights(regions) @ self.fit_chi2, self.zgrid)
+
+    def region_pz_stats(
+            self, regions:np.ndarray|list[np.ndarray]|None=None, peak_threshold:float=0.05
+        ) -> dict[str, np.ndarray]:
+        """
+        Statistics of the combined p(z) of each region (see `pz_stats`), from their summed chi2
+
+        Parameters
+        ----------
+        regions : array | list[array] | None, default None
+            Shape (n, H, W) stack of masks, nonzero on the pixels of each region.
+            If not set, the single region of the segmap
+        peak_threshold : float, default 0.05
+            Height relative to the maximum for a local maximum of p(z) to count as a peak
+
+        Returns
+        -------
+        stats : dict[str, ndarray]
+            Each of `PZ_STATS`, shape (n,)
+        """
+
+        if regions is None:
+            regions = self.segmap_mask[np.newaxis]
+        return pz_stats(self.region_weights(regions) @ self.fit_chi2, self.zgrid, peak_threshold)
+
+    def bootstrap_zchi2(
+            self, n_boot:int=1000, pixels:np.ndarray|None=None, seed:int|np.random.Generator|None=None,
+            block:int=100
+        ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Bootstrap the chi2 method redshift over pixels: each of `n_boot` resamples draws as many pixels
+        as are fit, with replacement. The draws are taken as multinomial counts of each row fit,
+        and applied to `fit_chi2` as a weight matrix of `block` resamples at a time.
+
+        Parameters
+        ----------
+        n_boot : int, default 1000
+            Number of resamples
+        pixels : array | None, default None
+            Image of the pixels to resample (nonzero), all pixels fit if not set
+            (as `calc_zchi2`, or pass `segmap_mask` as `calc_zchi2_pixels`)
+        seed : int | Generator | None, default None
+            Seed or generator of the random draws
+        block : int, default 100
+            Number of resamples drawn and summed at once, bounding the weights held
+
+        Returns
+        -------
+        zchi2 : ndarray
+            Shape (n_boot,) of the value that minimises the total chi2 of each resample,
+            NaN if there are no pixels fit
+        total_chi2 : ndarray
+            Shape (n_boot, NZ) of the summed chi2 of each resample
+        """
+
+        rng = np.random.default_rng(seed)
+
+        if pixels is None:
+            fit_rows = self.fit_rows
+        else:
+            fit_rows = self.fit_rows[np.ravel(pixels)[self.fit_pixels] != 0]
+        n_pix = len(fit_rows)
+
+        if n_pix == 0:
+            return np.full(n_boot, np.nan), np.full((n_boot, len(self.zgrid)), np.nan)
+
+        # drawing pixels uniformly is drawing each row with the share of the pixels it fits
+        rows, counts = np.unique(fit_rows, return_counts=True)
+        chi2 = self.fit_chi2[rows]
+
+        total_chi2 = np.empty((n_boot, len(self.zgrid)), dtype=chi2.dtype)
+        for start in range(0, n_boot, block):
+            n = min(block, n_boot - start)
+            weights = rng.multinomial(n_pix, counts / n_pix, size=n).astype(chi2.dtype)
+            total_chi2[start:start+n] = weights @ chi2
+        zchi2 = self.zgrid[np.argmin(total_chi2, axis=1)]
+
+        return zchi2, total_chi2
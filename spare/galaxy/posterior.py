@@ -0,0 +1,148 @@
+import numpy as np
+
+
+__all__ = ['PZ_STATS', 'log_pz', 'pz_percentiles', 'pz_stats']
+
+
+# statistics of p(z) given by `pz_stats`
+PZ_STATS = ['z16', 'z50', 'z84', 'z_peak', 'n_peaks']
+
+
+def _logsumexp(a:np.ndarray, axis:int=-1) -> np.ndarray:
+    """log(sum(exp(a))) along an axis, without overflow or underflow"""
+
+    a_max = np.max(a, axis=axis, keepdims=True)
+    a_max = np.where(np.isfinite(a_max), a_max, 0)
+    return np.log(np.sum(np.exp(a - a_max), axis=axis)) + np.squeeze(a_max, axis=axis)
+
+def _trapezoid_weights(zgrid:np.ndarray) -> np.ndarray:
+    """Weight of each point of zgrid in the trapezoid rule"""
+
+    dz = np.diff(zgrid)
+    weights = np.zeros(len(zgrid))
+    weights[:-1] += dz / 2
+    weights[1:] += dz / 2
+    return weights
+
+
+def _has_minimum(chi2:np.ndarray) -> np.ndarray:
+    """Rows of chi2 with a finite minimum, the only rows with a p(z)"""
+    return np.isfinite(np.min(chi2, axis=1)) if chi2.shape[1] else np.zeros(len(chi2), dtype=bool)
+
+
+def log_pz(chi2:np.ndarray, zgrid:np.ndarray) -> np.ndarray:
+    """
+    Normalised log p(z) of each row of chi2, with p(z) ~ exp(-chi2/2) integrating to 1 over `zgrid`.
+    Normalised with log-sum-exp, so stays finite for chi2 of any size (e.g. summed over many pixels).
+
+    Parameters
+    ----------
+    chi2 : array
+        Shape (n, NZ) chi2 of each row, or (NZ,) of one
+    zgrid : array
+        Redshift grid
+
+    Returns
+    -------
+    log_pz : ndarray
+        Same shape as chi2, NaN for rows with no finite minimum
+    """
+
+    chi2 = np.asarray(chi2, dtype=np.float64)
+    rows = np.atleast_2d(chi2)
+    valid = _has_minimum(rows)
+
+    log_like = -0.5 * rows[valid]
+    log_norm = _logsumexp(log_like + np.log(_trapezoid_weights(zgrid)), axis=-1)
+
+    result = np.full(rows.shape, np.nan)
+    result[valid] = log_like - log_norm[..., np.newaxis]
+    return result.reshape(chi2.shape)
+
+def _pz_cdf(chi2:np.ndarray, zgrid:np.ndarray) -> np.ndarray:
+    """Cumulative distribution of p(z) of each row at each point of zgrid (trapezoid rule), rows need a finite minimum"""
+
+    pz = np.exp(-0.5 * (chi2 - chi2.min(axis=1, keepdims=True)))
+    cdf = np.cumsum(0.5 * (pz[:, 1:] + pz[:, :-1]) * np.diff(zgrid), axis=1)
+    cdf = np.concatenate([np.zeros((len(chi2), 1)), cdf], axis=1)
+    return cdf / cdf[:, -1:]
+
+def pz_percentiles(chi2:np.ndarray, zgrid:np.ndarray, percentiles:list[float]|np.ndarray) -> np.ndarray:
+    """
+    Redshifts at percentiles of the p(z) of each row of chi2,
+    interpolated within the step of zgrid where the cumulative distribution passes each.
+
+    Parameters
+    ----------
+    chi2 : array
+        Shape (n, NZ) chi2 of each row
+    zgrid : array
+        Redshift grid
+    percentiles : list[float] | array
+        Percentiles, from 0 to 100
+
+    Returns
+    -------
+    z : ndarray
+        Shape (n, n_percentiles), NaN for rows with no finite minimum
+    """
+
+    chi2 = np.atleast_2d(np.asarray(chi2, dtype=np.float64))
+    valid = _has_minimum(chi2)
+    z = np.full((len(chi2), len(percentiles)), np.nan)
+
+    cdf = _pz_cdf(chi2[valid], zgrid)
+    rows = np.arange(len(cdf))
+    for i, q in enumerate(np.asarray(percentiles) / 100):
+        upper = np.clip(np.argmax(cdf >= q, axis=1), 1, len(zgrid) - 1)
+        lower = upper - 1
+        step = cdf[rows, upper] - cdf[rows, lower]
+        frac = np.divide(q - cdf[rows, lower], step, out=np.zeros(len(cdf)), where=(step > 0))
+        z[valid, i] = zgrid[lower] + frac * (zgrid[upper] - zgrid[lower])
+
+    return z
+
+def pz_stats(chi2:np.ndarray, zgrid:np.ndarray, peak_threshold:float=0.05) -> dict[str, np.ndarray]:
+    """
+    Statistics of the p(z) of each row of chi2 (see `PZ_STATS`), for all rows at once.
+    Rows with no finite minimum (e.g. failed fits) have NaN redshifts and no peaks.
+
+    z16, z50, z84
+        Redshifts at the 16th, 50th (median) and 84th percentiles
+    z_peak
+        Redshift of the maximum p(z) (minimum chi2)
+    n_peaks
+        Number of local maxima of p(z) higher than `peak_threshold` times the maximum
+
+    Parameters
+    ----------
+    chi2 : array
+        Shape (n, NZ) chi2 of each row
+    zgrid : array
+        Redshift grid
+    peak_threshold : float, default 0.05
+        Height relative to the maximum for a local maximum to count as a peak
+
+    Returns
+    -------
+    stats : dict[str, ndarray]
+        Each of shape (n,)
+    """
+
+    chi2 = np.atleast_2d(np.asarray(chi2, dtype=np.float64))
+    valid = _has_minimum(chi2)
+
+    z16, z50, z84 = pz_percentiles(chi2, zgrid, [16, 50, 84]).T
+
+    # relative to the maximum of each row
+    valid_chi2 = chi2[valid]
+    pz = np.exp(-0.5 * (valid_chi2 - valid_chi2.min(axis=1, keepdims=True)))
+    padded = np.pad(pz, ((0, 0), (1, 1)), constant_values=-np.inf)
+    is_peak = (pz > padded[:, :-2]) & (pz >= padded[:, 2:]) & (pz >= peak_threshold)
+
+    z_peak = np.full(len(chi2), np.nan)
+    z_peak[valid] = zgrid[np.argmin(valid_chi2, axis=1)]
+    n_peaks = np.zeros(len(chi2), dtype=int)
+    n_peaks[valid] = np.sum(is_peak, axis=1)
+
+    return {'z16': z16, 'z50': z50, 'z84': z84, 'z_peak': z_peak, 'n_peaks': n_peaks}
@@ -0,0 +1,228 @@
+import os
+from typing import Iterator
+
+import json
+import numpy as np
+import h5py
+
+from .galaxy import Galaxy
+
+
+__all__ = ['RunStore', 'store_path']
+
+
+def store_path(run_folder:str) -> str:
+    """Path of the galaxy store within a run folder"""
+    return f'{run_folder}/galaxies.h5'
+
+
+class RunStore():
+    """
+    Single HDF5 file holding every galaxy of a run, in place of a folder per galaxy.
+
+    Images of all galaxies are concatenated along one flattened pixel axis,
+    with an index table giving the offset and shape of each galaxy, so that
+    whole selections are written and read with a few bulk operations.
+
+    Layout
+    ------
+    index : (n_gal,) table
+        idx, id, offset, ny, nx of each galaxy
+    info : (n_gal,) str
+        JSON of `Galaxy.info_dict` for each galaxy
+    values, errors : (n_filters, n_pix) float32
+        Flattened images of all galaxies
+    segmap, bins : (n_pix,) int
+        Flattened segmaps and bin maps (-1 where a galaxy is not binned)
+
+    Parameters
+    ----------
+    filepath : str
+        Path to the HDF5 file
+    chunk : int, default 65536
+        Chunk length along the pixel axis
+    """
+
+    INDEX_DTYPE = np.dtype([('idx', 'i8'), ('id', 'i8'), ('offset', 'i8'), ('ny', 'i8'), ('nx', 'i8')])
+
+    def __init__(self, filepath:str, chunk:int=65536) -> None:
+        self.filepath = filepath
+        self.chunk = chunk
+
+        self._file:h5py.File|None = None
+        self._filters:list[str]|None = None
+
+    def open(self) -> None:
+        """Keep the file open for reading until `close`, so that each `read` does not reopen it"""
+        if self._file is None:
+            self._file = h5py.File(self.filepath, 'r')
+            self._filters = json.loads(self._file.attrs['filters'])
+
+    def close(self) -> None:
+        """Close the file if kept open by `open`"""
+        if self._file is not None:
+            self._file.close()
+        self._file = None
+        self._filters = None
+
+    def __len__(self) -> int:
+        if not os.path.isfile(self.filepath):
+            return 0
+        with h5py.File(self.filepath, 'r') as f:
+            return len(f['index'])
+
+    def _create(self, f:h5py.File, filters:list[str]) -> None:
+        n = len(filters)
+        f.attrs['filters'] = json.dumps(filters)
+        f.create_dataset('index', shape=(0,), maxshape=(None,), dtype=self.INDEX_DTYPE, chunks=True)
+        f.create_dataset('info', shape=(0,), maxshape=(None,), dtype=h5py.string_dtype(), chunks=True)
+        for name in ['values', 'errors']:
+            f.create_dataset(name, shape=(n, 0), maxshape=(n, None), dtype='f4', chunks=(n, self.chunk))
+        for name in ['segmap', 'bins']:
+            f.create_dataset(name, shape=(0,), maxshape=(None,), dtype='i8', chunks=(self.chunk,))
+
+    @staticmethod
+    def _append(dataset:h5py.Dataset, data:np.ndarray, axis:int=0) -> None:
+        start = dataset.shape[axis]
+        dataset.resize(start + data.shape[axis], axis=axis)
+        if axis == 0:
+            dataset[start:] = data
+        else:
+            dataset[:, start:] = data
+
+    def append(self, galaxies:list[Galaxy]) -> None:
+        """
+        Add galaxies to the end of the store in one write, creating the file if needed.
+        The `idx` of each galaxy is its position within the store.
+
+        Parameters
+        ----------
+        galaxies : list[Galaxy]
+            Galaxies to add
+        """
+
+        if len(galaxies) == 0:
+            return
+
+        with h5py.File(self.filepath, 'a') as f:
+            if 'index' not in f:
+                self._create(f, galaxies[0].filters)
+            filters = json.loads(f.attrs['filters'])
+
+            n_gal = len(f['index'])
+            offset = f['segmap'].shape[0]
+
+            index = np.zeros(len(galaxies), dtype=self.INDEX_DTYPE)
+            for i, galaxy in enumerate(galaxies):
+                index[i] = (n_gal + i, galaxy.id, offset, *galaxy.shape)
+                offset += galaxy.size
+
+            def flat_images(galaxy:Galaxy, cube:str, images:str) -> np.ndarray:
+                if galaxy.stacked:
+                    return getattr(galaxy, cube).reshape(len(filters), -1)
+                return np.stack([getattr(galaxy, images)[filt].ravel() for filt in filters])
+
+            values = np.concatenate([flat_images(gal, 'value_cube', 'values') for gal in galaxies], axis=1)
+            errors = np.concatenate([flat_images(gal, 'error_cube', 'errors') for gal in galaxies], axis=1)
+            segmap = np.concatenate([gal.segmap.ravel() for gal in galaxies])
+            bins = np.concatenate([
+                np.full(gal.size, -1) if (gal.bin_map is None) else gal.bin_map.ravel() for gal in galaxies
+            ])
+            info = np.array([json.dumps(gal.info_dict()) for gal in galaxies], dtype=object)
+
+            self._append(f['index'], index)
+            self._append(f['info'], info)
+            self._append(f['values'], values.astype(np.float32, copy=False), axis=1)
+            self._append(f['errors'], errors.astype(np.float32, copy=False), axis=1)
+            self._append(f['segmap'], segmap)
+            self._append(f['bins'], bins)
+
+    @staticmethod
+    def _build(
+            filters:list[str], row:np.void, info:dict,
+            values:np.ndarray, errors:np.ndarray, segmap:np.ndarray, bins:np.ndarray
+        ) -> Galaxy:
+        shape = (int(row['ny']), int(row['nx']))
+        n = len(filters)
+
+        bbox = ((info['ymin'], info['ymax']), (info['xmin'], info['xmax']))
+        galaxy = Galaxy(info['id'], info['centroid'], bbox, dict(), dict(), segmap.reshape(shape))
+        galaxy.use_cubes(filters, values.reshape(n, *shape), errors.reshape(n, *shape))
+
+        if 'selection' in info:
+            galaxy.select_pixels(**info['selection'])
+        galaxy.unused_value = info.get('unused_value')
+        if info.get('binning') is not None:
+            galaxy.bin_map = bins.reshape(shape)
+            galaxy.binning = info['binning']
+
+        return galaxy
+
+    def read(self, idx:int) -> Galaxy:
+        """
+        Read a single galaxy, touching only its own pixels.
+
+        Parameters
+        ----------
+        idx : int
+            Position of the galaxy within the store (`galaxy_idx` of the run)
+        """
+
+        if self._file is not None:
+            return self._read(self._file, self._filters, idx)
+        with h5py.File(self.filepath, 'r') as f:
+            return self._read(f, json.loads(f.attrs['filters']), idx)
+
+    def _read(self, f:h5py.File, filters:list[str], idx:int) -> Galaxy:
+        row = f['index'][idx]
+        info = json.loads(f['info'][idx])
+        sl = slice(row['offset'], row['offset'] + row['ny'] * row['nx'])
+
+        return self._build(
+            filters, row, info,
+            f['values'][:, sl], f['errors'][:, sl], f['segmap'][sl], f['bins'][sl]
+        )
+
+    def iter_read(self, idxs:list[int]|np.ndarray|None=None) -> Iterator[Galaxy]:
+        """
+        Read galaxies one at a time, keeping the file open between them,
+        so that only one galaxy is held in memory.
+
+        Parameters
+        ----------
+        idxs : list[int] | array | None, default None
+            Positions of the galaxies to read, in order. All galaxies if not set
+        """
+
+        with h5py.File(self.filepath, 'r') as f:
+            filters = json.loads(f.attrs['filters'])
+            if idxs is None:
+                idxs = range(len(f['index']))
+            for idx in idxs:
+                yield self._read(f, filters, idx)
+
+    def ids(self) -> np.ndarray:
+        """id of each galaxy, in order of position within the store"""
+        with h5py.File(self.filepath, 'r') as f:
+            return f['index']['id']
+
+    def read_all(self) -> list[Galaxy]:
+        """
+        Read every galaxy, with one read of each dataset.
+        """
+
+        with h5py.File(self.filepath, 'r') as f:
+            filters = json.loads(f.attrs['filters'])
+            index = f['index'][:]
+            infos = [json.loads(info) for info in f['info'].asstr()[:]]
+            values = f['values'][:]
+            errors = f['errors'][:]
+            segmap = f['segmap'][:]
+            bins = f['bins'][:]
+
+        galaxies = []
+        for row, info in zip(index, infos):
+            sl = slice(row['offset'], row['offset'] + row['ny'] * row['nx'])
+            galaxies.append(self._build(filters, row, info, values[:, sl], errors[:, sl], segmap[sl], bins[sl]))
+
+        return galaxies
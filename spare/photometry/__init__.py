@@ -1,7 +1,11 @@
 from .prep import *
 from .run import *
 from .extract import *
+from .chi2store import *
+from .fitstore import *
 
 from . import prep
 from . import run
-from . import extract
\ No newline at end of file
+from . import extract
+from . import chi2store
+from . import fitstore
\ No newline at end of file
@@ -0,0 +1,157 @@
+from typing import Literal
+
+import numpy as np
+
+from ..galaxy.posterior import pz_percentiles
+
+
+__all__ = ['CHI2_STORAGE', 'encode_chi2', 'decode_chi2', 'chi2_storage_of']
+
+
+CHI2_STORAGE = ['float64', 'float32', 'compressed', 'topk', 'percentiles']
+
+# percentiles of p(z) kept by the `percentiles` storage
+PERCENTILES = np.array([2.5, 16, 50, 84, 97.5])
+
+
+def chi2_storage_of(arrays) -> str:
+    """Storage policy that a set of saved fit arrays (e.g. a loaded `fit_data`) was encoded with"""
+    if 'chi2_storage' in arrays:
+        return str(arrays['chi2_storage'])
+    return 'float64'
+
+
+def _local_minima(chi2:np.ndarray, k:int) -> tuple[np.ndarray, np.ndarray]:
+    """Indices of the k lowest local minima of each row, and whether each is a minimum (rows may have fewer)"""
+
+    padded = np.pad(chi2, ((0, 0), (1, 1)), constant_values=np.inf)
+    is_minimum = (chi2 <= padded[:, :-2]) & (chi2 <= padded[:, 2:])
+    ranked_chi2 = np.where(is_minimum, chi2, np.inf)
+
+    k = min(k, chi2.shape[1])
+    lowest = np.argpartition(ranked_chi2, k - 1, axis=1)[:, :k]
+    order = np.argsort(np.take_along_axis(ranked_chi2, lowest, axis=1), axis=1)
+    lowest = np.take_along_axis(lowest, order, axis=1)
+
+    return lowest, np.take_along_axis(is_minimum, lowest, axis=1)
+
+
+def encode_chi2(
+        chi2:np.ndarray, zgrid:np.ndarray,
+        storage:Literal['float64', 'float32', 'compressed', 'topk', 'percentiles']='float64',
+        k:int=3, half_width:int=10
+    ) -> dict[str, np.ndarray]:
+    """
+    Encode the chi2 of a fit for saving, with one of the storage policies of `CHI2_STORAGE`.
+
+    float64, float32
+        Dense chi2 of that precision
+    compressed
+        Dense float32 chi2, to be saved with compression (`np.savez_compressed`)
+    topk
+        The minimum and maximum chi2 of each row, with the chi2 in a window of `2*half_width + 1` points
+        around each of its `k` lowest local minima
+    percentiles
+        The minimum and maximum chi2 of each row and the redshift of the minimum,
+        with the redshifts at the `PERCENTILES` of its p(z)
+
+    Parameters
+    ----------
+    chi2 : array
+        Shape (N, NZ) of the chi2 of each row over `zgrid`
+    zgrid : array
+        Redshift grid
+    storage : Literal['float64', 'float32', 'compressed', 'topk', 'percentiles'], default float64
+        Storage policy
+    k : int, default 3
+        Number of minima kept, for `topk`
+    half_width : int, default 10
+        Number of points of `zgrid` kept either side of each minimum, for `topk`
+
+    Returns
+    -------
+    arrays : dict[str, ndarray]
+        Arrays to save, which `decode_chi2` turns back into dense chi2
+    """
+
+    if storage not in CHI2_STORAGE:
+        raise ValueError(f'Unknown chi2 storage {storage}, should be one of {CHI2_STORAGE}')
+
+    arrays = {'chi2_storage': np.array(storage)}
+
+    if storage == 'float64':
+        arrays['chi2'] = np.asarray(chi2, dtype=np.float64)
+        return arrays
+    if storage in ['float32', 'compressed']:
+        arrays['chi2'] = np.asarray(chi2, dtype=np.float32)
+        return arrays
+
+    arrays['chi2_min'] = chi2.min(axis=1).astype(np.float32)
+    arrays['chi2_max'] = chi2.max(axis=1).astype(np.float32)
+
+    if storage == 'topk':
+        width = min(2*half_width + 1, chi2.shape[1])
+        minima, valid = _local_minima(chi2, k)
+        starts = np.clip(minima - half_width, 0, chi2.shape[1] - width)
+        windows = np.take_along_axis(
+            chi2[:, np.newaxis, :], starts[..., np.newaxis] + np.arange(width), axis=2
+        )
+        arrays['chi2_starts'] = np.where(valid, starts, -1)
+        arrays['chi2_windows'] = windows.astype(np.float32)
+    else:
+        arrays['chi2_zmin'] = zgrid[np.argmin(chi2, axis=1)].astype(np.float32)
+        arrays['chi2_percentiles'] = pz_percentiles(chi2, zgrid, PERCENTILES).astype(np.float32)
+
+    return arrays
+
+
+def decode_chi2(arrays, zgrid:np.ndarray, rows:slice|np.ndarray=slice(None)) -> np.ndarray:
+    """
+    Dense chi2 of the given rows, from arrays saved by `encode_chi2`.
+
+    For `topk`, points outside the windows are set to the maximum chi2 of the row, so the minima and maxima
+    are exact and unevaluated redshifts are never favoured. For `percentiles`, chi2 is rebuilt as a parabola
+    about the redshift of the minimum, reaching +1 at the 16th and 84th percentiles, capped at the maximum chi2.
+
+    Parameters
+    ----------
+    arrays : dict | NpzFile
+        Saved arrays, e.g. a loaded `fit_data`
+    zgrid : array
+        Redshift grid
+    rows : slice | array, default all
+        Rows to decode
+
+    Returns
+    -------
+    chi2 : ndarray
+        Shape (n_rows, NZ)
+    """
+
+    storage = chi2_storage_of(arrays)
+    if storage in ['float64', 'float32', 'compressed']:
+        # copied, as the saved arrays may be memory-mapped
+        return np.array(arrays['chi2'][rows])
+
+    chi2_min = np.asarray(arrays['chi2_min'][rows], dtype=np.float64)
+    chi2_max = np.asarray(arrays['chi2_max'][rows], dtype=np.float64)
+    chi2 = np.repeat(chi2_max[:, np.newaxis], len(zgrid), axis=1)
+
+    if storage == 'topk':
+        starts = np.asarray(arrays['chi2_starts'][rows])
+        windows = np.asarray(arrays['chi2_windows'][rows])
+        width = windows.shape[2]
+        for m in range(starts.shape[1]):
+            valid = np.flatnonzero(starts[:, m] >= 0)
+            index = starts[valid, m, np.newaxis] + np.arange(width)
+            chi2[valid[:, np.newaxis], index] = windows[valid, m]
+        return chi2
+
+    zmin = np.asarray(arrays['chi2_zmin'][rows], dtype=np.float64)[:, np.newaxis]
+    percentiles = np.asarray(arrays['chi2_percentiles'][rows], dtype=np.float64)
+    lower = percentiles[:, PERCENTILES == 16]
+    upper = percentiles[:, PERCENTILES == 84]
+
+    offset = zgrid - zmin
+    sigma = np.where(offset < 0, np.maximum(zmin - lower, 1e-6), np.maximum(upper - zmin, 1e-6))
+    return np.minimum(chi2_min[:, np.newaxis] + (offset / sigma)**2, chi2)
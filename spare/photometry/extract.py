@@ -1,35 +1,148 @@
+import os
+from typing import Literal, Iterator
+from collections import OrderedDict
 import json
+
 import numpy as np
 import pandas as pd
 
 from ..filemanage import RunManager
-from ..galaxy import PhotGalaxy
+from .prep import read_eazy_catalog
+from .chi2store import decode_chi2, chi2_storage_of
+from .fitstore import fit_folder, catalog_index, load_fit_data
+from ..galaxy import Galaxy, PhotGalaxy, RunStore, store_path, load_galaxy_data, load_galaxy_from_folder
+from ..galaxy.posterior import PZ_STATS, pz_stats
 
 __all__ = ['Extract']
 
 class Extract():
+    """
+    Results of an EAZY run, matched back to the galaxies of the run.
+
+    Fit arrays saved to the `fit` folder (see `WrapperEAZY.save_EAZY_data`) are memory-mapped,
+    so opening a run reads no chi2, and a galaxy reads only its own rows.
+    Runs saved to `fit_data.npz` (older runs, or compressed storage) are loaded whole,
+    with the pixel ids and galaxy offsets taken from the EAZY input file.
+
+    Parameters
+    ----------
+    run_id : int
+        Identifier of the run to extract from
+    config_file : str, default 'config.yml'
+        Config file to use
+    cache_size : int, default 32
+        Number of galaxies built by `get_galaxy` kept in memory, the least recently used dropped first
+
+    Attributes
+    ----------
+    fit_data : dict[str, ndarray]
+        Saved fit arrays, memory-mapped where possible
+    zgrid : ndarray
+    zbest : ndarray
+        Best redshift of each row of the catalog
+    pixel_ids : ndarray
+        pixel id (or bin id) of each row of the catalog
+    galaxy_offsets : ndarray
+        (start, stop) rows of each galaxy, by `galaxy_idx`
+    galaxy_idxs : ndarray
+        `galaxy_idx` of every galaxy of the run, including any with no rows fit
+    catalog : DataFrame
+        id columns of the EAZY input file, only read if used
+    galaxies : list[PhotGalaxy] | None
+        Set by `extract_galaxies`
+
+    Methods
+    -------
+    get_galaxy
+        A single galaxy, by `galaxy_idx` or id
+    iter_galaxies
+        Galaxies one at a time, built as they are reached
+    extract_galaxies
+        Every galaxy of the run at once, into `galaxies`
+    pz_stats
+        Statistics of the p(z) of every row of the run
+    bootstrap_zchi2
+        Bootstrap distribution of the chi2 method redshift of each galaxy
+    close
+        Close the galaxy store kept open by `get_galaxy`
+    """
 
-    def __init__(self, run_id:int, config_file:str='config.yml') -> None:
+    def __init__(self, run_id:int, config_file:str='config.yml', cache_size:int=32) -> None:
         self.run_id = run_id
         self.runmanage = RunManager(config_file)
 
         self.run_folder = self.runmanage.run_folder(run_id)
         self.eazy_out_folder = f'{self.run_folder}/eazy'
 
-        self.catalog = pd.read_csv(f'{self.run_folder}/EAZY_input.csv')
-        self.fit_data = np.load(f'{self.eazy_out_folder}/fit_data.npz')
+        if os.path.isdir(fit_folder(self.eazy_out_folder)):
+            self.fit_data = load_fit_data(fit_folder(self.eazy_out_folder))
+        else:
+            with np.load(f'{self.eazy_out_folder}/fit_data.npz') as fit_data:
+                self.fit_data = dict(fit_data)
+        if 'galaxy_offsets' not in self.fit_data:
+            self.fit_data |= catalog_index(self.run_folder)
 
-        self.zgrid = self.fit_data['zgrid']
+        self.zgrid = np.asarray(self.fit_data['zgrid'])
         self.zbest = self.fit_data['zbest']
-        self.chi2 = self.fit_data['chi2']
+        self.pixel_ids = self.fit_data['pixel_id']
+        self.galaxy_offsets = np.asarray(self.fit_data['galaxy_offsets'])
+        self.chi2_storage = chi2_storage_of(self.fit_data)
 
-        self.galaxy_ids = np.unique(self.catalog['galaxy_id'])
-        self.galaxy_idxs = np.unique(self.catalog['galaxy_idx'])
+        # includes galaxies with every pixel dropped from the EAZY input
+        self.galaxy_idxs = np.arange(len(self.galaxy_offsets))
 
+        self._catalog:pd.DataFrame|None = None
         self.galaxies:list[PhotGalaxy]|None = None
 
+        self.cache_size = cache_size
+        self._cache:OrderedDict[int, PhotGalaxy] = OrderedDict()
+        self._idx_of_id:dict[int, int]|None = None
+        self._run_store:RunStore|None = None
+
+    @property
+    def store_file(self) -> str|None:
+        """Path of the galaxy store of the run, `None` if saved as a folder per galaxy"""
+        store_file = store_path(self.run_folder)
+        return store_file if os.path.isfile(store_file) else None
+
+    def _open_store(self) -> RunStore:
+        """Galaxy store of the run, kept open between reads of single galaxies until `close`"""
+        if self._run_store is None:
+            self._run_store = RunStore(self.store_file)
+            self._run_store.open()
+        return self._run_store
+
+    def close(self) -> None:
+        """Close the galaxy store if kept open by `get_galaxy`"""
+        if self._run_store is not None:
+            self._run_store.close()
+            self._run_store = None
+
+    @property
+    def catalog(self) -> pd.DataFrame:
+        """`galaxy_idx`, `galaxy_id` and `pixel_id` columns of the EAZY input file, read on first use"""
+        if self._catalog is None:
+            self._catalog = read_eazy_catalog(self.run_folder, ['galaxy_idx', 'galaxy_id', 'pixel_id'])
+        return self._catalog
+
+    @property
+    def galaxy_ids(self) -> np.ndarray:
+        """Sorted ids of the galaxies with rows fit"""
+        return np.unique(self.catalog['galaxy_id'])
+
+    @property
+    def chi2(self) -> np.ndarray:
+        """Dense chi2 of every row, decoded from its storage if reduced"""
+        return self.chi2_rows(slice(None))
+
+    def chi2_rows(self, rows:slice|np.ndarray) -> np.ndarray:
+        """
+        Dense chi2 of the given rows of the catalog, decoded from its storage if reduced (see `decode_chi2`)
+        """
+        return decode_chi2(self.fit_data, self.zgrid, rows)
+
     
-    def _load_galaxy_data(self, folder:str) -> tuple[dict, dict[str, np.ndarray], dict[str, np.ndarray], np.ndarray, tuple[tuple]]:
+    def _load_galaxy_data(self, folder:str) -> tuple[dict, dict[str, np.ndarray], dict[str, np.ndarray], np.ndarray, tuple[tuple], tuple|None]:
         """
         Loads basic galaxy data
 
@@ -45,18 +158,11 @@ class Extract():
         errors : dict[str, ndarray]
         segmap : ndarray
         bbox : tuple[tuple]
+        cubes : tuple | None
+            (filters, value_cube, error_cube) if the galaxy was saved stacked
         """
         
-        with open(f'{folder}/info.txt') as f:
-            info = json.load(f)
-        
-        values = np.load(f'{folder}/values.npz')
-        errors = np.load(f'{folder}/errors.npz')
-        segmap = np.load(f'{folder}/segmap.npy')
-
-        bbox = ((info['ymin'], info['ymax']), (info['xmin'], info['xmax']))
-
-        return info, values, errors, segmap, bbox
+        return load_galaxy_data(folder)
     
     def get_galaxy_slice(self, idx:int) -> slice:
         """
@@ -74,35 +180,199 @@ class Extract():
             The relevant slice within the dataframe
         """
 
-        a = np.nonzero(self.catalog['galaxy_idx'] == idx)[0]
-        galaxy_slice = slice(a[0], a[-1]+1)
+        # empty if no pixels of the galaxy were fit
+        start, stop = self.galaxy_offsets[idx]
+        return slice(int(start), int(stop))
+
+    def pz_stats(self, peak_threshold:float=0.05, chunk_rows:int=100_000) -> dict[str, np.ndarray]:
+        """
+        Statistics of the p(z) of every row of the run (see `pz_stats`),
+        with chi2 read and decoded a chunk of rows at a time
+
+        Parameters
+        ----------
+        peak_threshold : float, default 0.05
+            Height relative to the maximum for a local maximum of p(z) to count as a peak
+        chunk_rows : int, default 100000
+            Number of rows held at once
+
+        Returns
+        -------
+        stats : dict[str, ndarray]
+            Each of `PZ_STATS`, shape (n_rows,) in catalog order.
+            NaN with no peaks for rows whose fit failed
+        """
 
-        return galaxy_slice
+        n_rows = len(self.zbest)
+        chunks = [
+            pz_stats(self.chi2_rows(slice(start, start + chunk_rows)), self.zgrid, peak_threshold)
+            for start in range(0, n_rows, chunk_rows)
+        ]
+        if len(chunks) == 0:
+            return {name: np.zeros(0) for name in PZ_STATS}
+        stats = {name: np.concatenate([chunk[name] for chunk in chunks]) for name in PZ_STATS}
 
-    
-    def extract_galaxies(self) -> None:
+        # failed fits (zbest of -1, as in `PhotGalaxy`), whatever their chi2
+        failed = (np.asarray(self.zbest) == -1)
+        for name in PZ_STATS:
+            stats[name][failed] = 0 if (name == 'n_peaks') else np.nan
+        return stats
+
+    def bootstrap_zchi2(
+            self, n_boot:int=1000, pixels:Literal['fit', 'segmap']='fit', seed:int|None=None,
+            idxs:list[int]|np.ndarray|None=None
+        ) -> np.ndarray:
         """
-        Extract all galaxies from the run as `PhotGalaxy` objects.
-        Placed into `galaxies` attribute
+        Bootstrap the chi2 method redshift of each galaxy of the run over its pixels
+        (see `PhotGalaxy.bootstrap_zchi2`), with galaxies built one at a time by `iter_galaxies`.
+
+        Parameters
+        ----------
+        n_boot : int, default 1000
+            Number of resamples of each galaxy
+        pixels : Literal['fit', 'segmap'], default fit
+            Resample all pixels fit (as `calc_zchi2`), or only those of the segmap (as `calc_zchi2_pixels`)
+        seed : int | None, default None
+            Seed of the random draws, shared across the galaxies in order
+        idxs : list[int] | array | None, default None
+            `galaxy_idx` of the galaxies, all galaxies of the run if not set
+
+        Returns
+        -------
+        zchi2 : ndarray
+            Shape (n_galaxies, n_boot) of the resampled redshifts, NaN for galaxies with no pixels fit
+        """
+
+        if pixels not in ['fit', 'segmap']:
+            raise ValueError(f'Unknown pixels {pixels}')
+        if idxs is None:
+            idxs = self.galaxy_idxs
+
+        rng = np.random.default_rng(seed)
+
+        zchi2 = np.full((len(idxs), n_boot), np.nan)
+        for i, galaxy in enumerate(self.iter_galaxies(idxs)):
+            mask = galaxy.segmap_mask if (pixels == 'segmap') else None
+            zchi2[i], _ = galaxy.bootstrap_zchi2(n_boot, mask, rng)
+
+        return zchi2
+
+    def galaxy_idx_of(self, id:int) -> int:
+        """
+        `galaxy_idx` of the galaxy with the given id, looked up from the ids of the run (read on first use)
+        """
+
+        if self._idx_of_id is None:
+            if self.store_file is not None:
+                ids = RunStore(self.store_file).ids()
+            else:
+                ids = []
+                for idx in self.galaxy_idxs:
+                    with open(f'{self.run_folder}/galaxies/{idx}/info.txt') as f:
+                        ids.append(json.load(f)['id'])
+            self._idx_of_id = {int(id): idx for (idx, id) in enumerate(ids)}
+
+        if id not in self._idx_of_id:
+            raise ValueError(f'Galaxy {id} is not in run {self.run_id}')
+        return self._idx_of_id[id]
+
+    def _phot_galaxy(self, idx:int, galaxy:Galaxy) -> PhotGalaxy:
+        """`PhotGalaxy` from a galaxy of the run and its rows of the fit"""
+
+        galaxy_slice = self.get_galaxy_slice(idx)
+        zbest = np.array(self.zbest[galaxy_slice])
+        chi2 = self.chi2_rows(galaxy_slice)
+        pixel_ids = np.array(self.pixel_ids[galaxy_slice])
+
+        return PhotGalaxy.from_galaxy(galaxy, self.zgrid, zbest, chi2, pixel_ids=pixel_ids)
+
+    def get_galaxy(self, key:int, by:Literal['idx', 'id']='idx') -> PhotGalaxy:
+        """
+        A single galaxy of the run as a `PhotGalaxy`, reading only its own images and rows of the fit.
+        The last `cache_size` galaxies got are kept, so are returned again without rereading.
+
+        Parameters
+        ----------
+        key : int
+            `galaxy_idx` or id of the galaxy
+        by : Literal['idx', 'id'], default idx
+            Whether `key` is the `galaxy_idx` or the id
+
+        Returns
+        -------
+        galaxy : PhotGalaxy
         """
 
-        self.galaxies = []
+        if by not in ['idx', 'id']:
+            raise ValueError(f'Unknown key type {by}')
+        idx = self.galaxy_idx_of(key) if (by == 'id') else int(key)
+        if not (0 <= idx < len(self.galaxy_idxs)):
+            raise IndexError(f'galaxy_idx {idx} out of range for run {self.run_id}')
+
+        if idx in self._cache:
+            self._cache.move_to_end(idx)
+            return self._cache[idx]
+
+        if self.store_file is not None:
+            galaxy = self._open_store().read(idx)
+        else:
+            galaxy = load_galaxy_from_folder(f'{self.run_folder}/galaxies/{idx}')
+        phot_galaxy = self._phot_galaxy(idx, galaxy)
+
+        if self.cache_size > 0:
+            self._cache[idx] = phot_galaxy
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+        return phot_galaxy
 
-        for idx in self.galaxy_idxs:
-            folder = f'{self.run_folder}/galaxies/{idx}'
+    def iter_galaxies(self, idxs:list[int]|np.ndarray|None=None) -> Iterator[PhotGalaxy]:
+        """
+        Iterate over galaxies of the run as `PhotGalaxy` objects, each built only when reached,
+        so that memory is held for one galaxy at a time (unless kept by the caller).
+        Galaxies in the cache of `get_galaxy` are reused without being read, but those built here are not added to it.
 
-            info, values, errors, segmap, bbox = self._load_galaxy_data(folder)
+        Parameters
+        ----------
+        idxs : list[int] | array | None, default None
+            `galaxy_idx` of the galaxies, in order. All galaxies of the run if not set
+
+        Yields
+        ------
+        galaxy : PhotGalaxy
+        """
+
+        if idxs is None:
+            idxs = self.galaxy_idxs
+
+        # taken now, so galaxies later dropped from the cache are still not reread
+        cached = {idx: self._cache[idx] for idx in idxs if idx in self._cache}
+        missing = [idx for idx in idxs if idx not in cached]
+
+        if self.store_file is not None:
+            galaxies = RunStore(self.store_file).iter_read(missing)
+        else:
+            galaxies = (load_galaxy_from_folder(f'{self.run_folder}/galaxies/{idx}') for idx in missing)
+
+        for idx in idxs:
+            if idx in cached:
+                yield cached[idx]
+            else:
+                yield self._phot_galaxy(idx, next(galaxies))
+
+    def extract_galaxies(self) -> None:
+        """
+        Extract all galaxies from the run as `PhotGalaxy` objects.
+        Placed into `galaxies` attribute.
+        For large runs, `iter_galaxies` or `get_galaxy` avoid holding every galaxy at once
+        """
 
-            galaxy_slice = self.get_galaxy_slice(idx)
-            zbest = self.zbest[galaxy_slice]
-            chi2 = self.chi2[galaxy_slice, :]
+        if self.store_file is not None:
+            # bulk read of the whole run store
+            stored = RunStore(self.store_file).read_all()
+        else:
+            stored = (load_galaxy_from_folder(f'{self.run_folder}/galaxies/{idx}') for idx in self.galaxy_idxs)
 
-            self.galaxies.append(
-                PhotGalaxy(
-                    info['id'], info['centroid'], bbox,
-                    values, errors, segmap,
-                    self.zgrid, zbest, chi2
-                )
-            )
+        self.galaxies = [self._phot_galaxy(idx, galaxy) for (idx, galaxy) in zip(self.galaxy_idxs, stored)]
             
             
\ No newline at end of file
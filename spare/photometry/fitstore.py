@@ -0,0 +1,95 @@
+import os
+
+import numpy as np
+
+from .prep import read_eazy_catalog, offsets_path
+
+
+__all__ = ['fit_folder', 'galaxy_offsets', 'catalog_index', 'save_fit_data', 'load_fit_data']
+
+
+def fit_folder(eazy_folder:str) -> str:
+    """Folder of the fit arrays within the eazy output folder of a run"""
+    return f'{eazy_folder}/fit'
+
+
+def galaxy_offsets(galaxy_idx:np.ndarray, n_galaxies:int|None=None) -> np.ndarray:
+    """
+    (start, stop) rows of each galaxy, from the `galaxy_idx` column of a catalog in galaxy order.
+
+    Parameters
+    ----------
+    galaxy_idx : array
+        `galaxy_idx` of each row, non-decreasing
+    n_galaxies : int | None, default None
+        Number of galaxies in the run, if some may have no rows at the end
+
+    Returns
+    -------
+    offsets : ndarray
+        Shape (n_galaxies, 2), empty (start == stop) for galaxies with no rows
+    """
+
+    galaxy_idx = np.asarray(galaxy_idx)
+    if n_galaxies is None:
+        n_galaxies = int(galaxy_idx.max()) + 1 if galaxy_idx.size else 0
+
+    idxs = np.arange(n_galaxies)
+    starts = np.searchsorted(galaxy_idx, idxs, side='left')
+    stops = np.searchsorted(galaxy_idx, idxs, side='right')
+    return np.stack([starts, stops], axis=1)
+
+
+def catalog_index(run_folder:str) -> dict[str, np.ndarray]:
+    """
+    `pixel_id` of each row of the EAZY input file of a run, and the `galaxy_offsets` of each galaxy,
+    from the offsets saved with the file if present (these include galaxies with no rows).
+    """
+
+    if os.path.isfile(offsets_path(run_folder)):
+        catalog = read_eazy_catalog(run_folder, ['pixel_id'])
+        offsets = np.load(offsets_path(run_folder))
+    else:
+        catalog = read_eazy_catalog(run_folder, ['galaxy_idx', 'pixel_id'])
+        offsets = galaxy_offsets(catalog['galaxy_idx'].to_numpy())
+
+    return {'pixel_id': catalog['pixel_id'].to_numpy(), 'galaxy_offsets': offsets}
+
+
+def save_fit_data(folder:str, fit_data:dict[str, np.ndarray]) -> None:
+    """
+    Save each fit array as its own `.npy` file in `folder`, so they can be memory-mapped on load.
+    Any arrays already in the folder from an earlier save are removed.
+    """
+
+    os.makedirs(folder, exist_ok=True)
+    for filename in os.listdir(folder):
+        if filename.endswith('.npy'):
+            os.remove(f'{folder}/{filename}')
+
+    for name, array in fit_data.items():
+        np.save(f'{folder}/{name}.npy', np.asarray(array))
+
+
+def load_fit_data(folder:str, mmap:bool=True) -> dict[str, np.ndarray]:
+    """
+    Load fit arrays saved by `save_fit_data`.
+
+    Parameters
+    ----------
+    folder : str
+        Folder of the arrays
+    mmap : bool, default True
+        If set, arrays are memory-mapped read only, so only the rows indexed are read from disk
+
+    Returns
+    -------
+    fit_data : dict[str, ndarray]
+        Arrays by name
+    """
+
+    mmap_mode = 'r' if mmap else None
+    return {
+        filename[:-len('.npy')]: np.load(f'{folder}/{filename}', mmap_mode=mmap_mode)
+        for filename in sorted(os.listdir(folder)) if filename.endswith('.npy')
+    }
@@ -1,13 +1,16 @@
 import os
+from typing import Literal
 
 import numpy as np
 import pandas as pd
+from astropy.io import fits
+from astropy.table import Table
 
 from ..filemanage import RunManager
-from ..galaxy import Galaxy
+from ..galaxy import Galaxy, RunStore, store_path
 
 
-__all__ = ['SelectionGalaxies', 'FileEAZY']
+__all__ = ['SelectionGalaxies', 'FileEAZY', 'StreamEAZYWriter', 'eazy_catalog_path', 'read_eazy_catalog', 'offsets_path']
 
 
 class SelectionGalaxies():
@@ -48,10 +51,26 @@ class SelectionGalaxies():
         """Create run for current selection, updates `run_id` attribute"""
         self.run_id = self.runmanage.add_run(name, len(self.galaxies))
 
-    def save_selection(self, name:str) -> None:
+    def save_selection(self, name:str, store:Literal['folders', 'hdf5']='folders') -> None:
+        """
+        Save the current selection under a new run
+
+        Parameters
+        ----------
+        name : str
+            Name to give the run
+        store : Literal['folders', 'hdf5'], default folders
+            Save each galaxy in its own folder `galaxies/<idx>`,
+            or all galaxies in a single `galaxies.h5` run store with one bulk write
+        """
+
         self._generate_run(name)
         run_folder = self.runmanage.run_folder(self.run_id)
 
+        if store == 'hdf5':
+            RunStore(store_path(run_folder)).append(self.galaxies)
+            return
+
         galaxies_folder = f'{run_folder}/galaxies'
         os.makedirs(galaxies_folder)
         
@@ -68,6 +87,10 @@ class FileEAZY():
     ----------
     selection : list[Galaxy]
         The selection to produce file for
+    min_valid_bands : int, default 1
+        Rows (pixels or bins) with data in fewer than this many filters are left out of the file,
+        so EAZY does not spend fits on them. They are restored as not fit in `PhotGalaxy`,
+        as their `pixel_id` is missing from the file. The default drops only rows with no data at all
     
     Attributes
     ----------
@@ -81,13 +104,16 @@ class FileEAZY():
     galaxy_id : int
         Unique to each detection by JADES, id assigned in segmap
     pixel_id : int
-        The id used to identify the pixel in the image, unique to the run, as border of `Galaxy` can vary
+        The id used to identify the pixel in the image, unique to the run, as border of `Galaxy` can vary.
+        Only the pixels selected in each galaxy (`Galaxy.select_pixels`) are included.
+        For a binned galaxy (`Galaxy.bin_pixels`), each row is instead a bin, and this holds the bin id
     filters, errors : float
         In the form F070W, E070W. Filter values and errors
     """
 
-    def __init__(self, selection:list[Galaxy]) -> None:
+    def __init__(self, selection:list[Galaxy], min_valid_bands:int=1) -> None:
         self.galaxies = selection
+        self.min_valid_bands = min_valid_bands
 
 
     @staticmethod
@@ -107,28 +133,317 @@ class FileEAZY():
             Key value pairs of filter or error name, and 1D array of values in each pixel
         """
 
+        if galaxy.stacked:
+            # one reshape of each cube, with rows as views
+            n = len(galaxy.filters)
+            values = dict(zip(galaxy.filters, galaxy.value_cube.reshape(n, -1)))
+            errors = dict(zip([f'E{name[1:]}' for name in galaxy.filters], galaxy.error_cube.reshape(n, -1)))
+            return values | errors
+
         values = {name: image.flatten() for (name, image) in galaxy.values.items()}
         errors = {f'E{name[1:]}': image.flatten() for (name, image) in galaxy.errors.items()}
         return values | errors
     
 
-    def _create_dataframe(self) -> pd.DataFrame:
-        galaxy_dfs = []
+    @staticmethod
+    def count_valid_bands(galaxy:Galaxy, pixel_data:dict[str, np.ndarray]) -> np.ndarray:
+        """
+        Number of filters with data in each row, as EAZY would judge it:
+        finite values with a positive error, and not the galaxy's `unused_value`.
+        """
+
+        n_valid = np.zeros(len(pixel_data[galaxy.filters[0]]), dtype=int)
+        for filt in galaxy.filters:
+            values = pixel_data[filt]
+            errors = pixel_data[f'E{filt[1:]}']
+            valid = np.isfinite(values) & np.isfinite(errors) & (errors > 0)
+            if galaxy.unused_value is not None:
+                valid &= (values != galaxy.unused_value)
+            n_valid += valid
+        return n_valid
+
+    @classmethod
+    def galaxy_rows(cls, galaxy:Galaxy, min_valid_bands:int=1) -> tuple[np.ndarray, dict[str, np.ndarray]]:
+        """
+        Return the rows to be fit for a galaxy: the selected pixels, or the bins if binned.
+        Rows with data in fewer than `min_valid_bands` filters are dropped.
+
+        Returns
+        -------
+        pixel_ids : ndarray
+            pixel id (or bin id) of each row
+        pixel_data : dict[str, ndarray]
+            Filter and error columns, as `extract_pixel_data`
+        """
+
+        if galaxy.bin_map is not None:
+            bin_values, bin_errors = galaxy.binned_pixel_data()
+            values = dict(zip(galaxy.filters, bin_values))
+            errors = dict(zip([f'E{name[1:]}' for name in galaxy.filters], bin_errors))
+            pixel_ids, pixel_data = np.arange(galaxy.n_bins), values | errors
+        else:
+            pixel_ids = galaxy.selected_pixel_ids
+            pixel_data = cls.extract_pixel_data(galaxy)
+            if galaxy.selected is not None:
+                pixel_data = {name: col[pixel_ids] for (name, col) in pixel_data.items()}
+
+        if min_valid_bands > 0:
+            keep = cls.count_valid_bands(galaxy, pixel_data) >= min_valid_bands
+            if not np.all(keep):
+                pixel_ids = pixel_ids[keep]
+                pixel_data = {name: col[keep] for (name, col) in pixel_data.items()}
+
+        return pixel_ids, pixel_data
 
-        for idx, galaxy in enumerate(self.galaxies):
-            id_cols = {
-                'galaxy_idx': np.full(galaxy.size, idx, dtype=int),
-                'galaxy_id': np.full(galaxy.size, galaxy.id, dtype=int),
-                'pixel_id': galaxy.pixel_ids_flat,
-            }
-            cols = id_cols | self.extract_pixel_data(galaxy)
-            galaxy_dfs.append(pd.DataFrame(cols))
+    @classmethod
+    def galaxy_columns(cls, idx:int, galaxy:Galaxy, min_valid_bands:int=1) -> dict[str, np.ndarray]:
+        """Columns of the rows for a single galaxy, at `galaxy_idx` idx"""
 
-        df = pd.concat(galaxy_dfs, ignore_index=True)
+        pixel_ids, pixel_data = cls.galaxy_rows(galaxy, min_valid_bands)
+        id_cols = {
+            'galaxy_idx': np.full(pixel_ids.size, idx, dtype=int),
+            'galaxy_id': np.full(pixel_ids.size, galaxy.id, dtype=int),
+            'pixel_id': pixel_ids,
+        }
+        return id_cols | pixel_data
 
-        return df
+    def _create_columns(self) -> dict[str, np.ndarray]:
+        """All columns (excluding id), each concatenated once over the galaxies"""
+
+        galaxy_cols = [self.galaxy_columns(idx, galaxy, self.min_valid_bands) for (idx, galaxy) in enumerate(self.galaxies)]
+        return {name: np.concatenate([cols[name] for cols in galaxy_cols]) for name in galaxy_cols[0]}
+
+    def _create_dataframe(self) -> pd.DataFrame:
+        return pd.DataFrame(self._create_columns())
     
     def save_csv_file(self, filepath:str) -> None:
         df = self._create_dataframe()
         df.to_csv(filepath, index_label='id')
 
+    def save_file(self, run_folder:str, catalog_format:Literal['csv', 'fits']='csv') -> str:
+        """
+        Save the EAZY input file into the run folder, as `EAZY_input.csv` or `EAZY_input.fits`,
+        along with the row offsets of each galaxy (see `StreamEAZYWriter`).
+
+        Returns
+        -------
+        filepath : str
+            Path of the file saved
+        """
+
+        with StreamEAZYWriter(run_folder, catalog_format, np.iinfo(int).max, self.min_valid_bands) as writer:
+            for idx, galaxy in enumerate(self.galaxies):
+                writer.add(idx, galaxy)
+        return writer.filepath
+
+
+class StreamEAZYWriter():
+    """
+    Writes the EAZY input file incrementally, so galaxies can be added as they are extracted
+    without holding the whole selection in memory.
+
+    Rows are buffered and written in chunks of `chunk_rows`.
+    For FITS, rows are streamed to a temporary file of raw records, with the table header
+    (which needs the final number of rows) written in front on `close`.
+    If no rows are written, the file still holds an empty table with the columns.
+
+    Parameters
+    ----------
+    run_folder : str
+        Folder of the run, the file is saved as `EAZY_input.csv` or `EAZY_input.fits`
+    catalog_format : Literal['csv', 'fits'], default csv
+        Format of the file
+    chunk_rows : int, default 100000
+        Number of rows buffered before each write
+    min_valid_bands : int, default 1
+        Rows with data in fewer filters are left out (see `FileEAZY`)
+
+    Attributes
+    ----------
+    offsets : list[tuple[int, int]]
+        Row (start, stop) of each galaxy added, in order of `galaxy_idx`
+    n_dropped : int
+        Number of rows left out for too few valid bands
+
+    Methods
+    -------
+    add
+        Add the rows of a galaxy
+    close
+        Write remaining rows and finish the file, saving the offsets
+    """
+
+    def __init__(
+            self, run_folder:str, catalog_format:Literal['csv', 'fits']='csv', chunk_rows:int=100_000,
+            min_valid_bands:int=1
+        ) -> None:
+        if catalog_format not in ['csv', 'fits']:
+            raise ValueError(f'Unknown catalog format {catalog_format}')
+
+        self.run_folder = run_folder
+        self.catalog_format = catalog_format
+        self.filepath = f'{run_folder}/EAZY_input.{catalog_format}'
+        self.chunk_rows = chunk_rows
+        self.min_valid_bands = min_valid_bands
+
+        self.n_dropped = 0
+        self.offsets:list[tuple[int, int]] = []
+        self.n_rows = 0
+        self.n_written = 0
+
+        self._buffer:list[dict[str, np.ndarray]] = []
+        self._buffer_rows = 0
+        self._dtype:np.dtype|None = None
+        self._part_file = f'{self.filepath}.part'
+
+    def __enter__(self) -> 'StreamEAZYWriter':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def add(self, idx:int, galaxy:Galaxy) -> None:
+        """
+        Add the rows of a galaxy, to be written once the buffer fills.
+
+        Parameters
+        ----------
+        idx : int
+            `galaxy_idx` of the galaxy, should follow on from the previous galaxy
+        galaxy : Galaxy
+            Galaxy to add
+        """
+
+        cols = FileEAZY.galaxy_columns(idx, galaxy, self.min_valid_bands)
+        n = len(cols['galaxy_idx'])
+        self.n_dropped += galaxy.n_bins if (galaxy.bin_map is not None) else galaxy.selected_pixel_ids.size
+        self.n_dropped -= n
+
+        self.offsets.append((self.n_rows, self.n_rows + n))
+        self.n_rows += n
+
+        self._buffer.append(cols)
+        self._buffer_rows += n
+        if self._buffer_rows >= self.chunk_rows:
+            self.flush()
+
+    def flush(self) -> None:
+        """Write the buffered rows"""
+
+        if self._buffer_rows == 0:
+            return
+
+        cols = {name: np.concatenate([buf[name] for buf in self._buffer]) for name in self._buffer[0]}
+        ids = np.arange(self.n_written, self.n_written + self._buffer_rows)
+
+        if self.catalog_format == 'csv':
+            df = pd.DataFrame(cols, index=ids)
+            df.to_csv(self.filepath, index_label='id', mode='w' if self.n_written == 0 else 'a', header=(self.n_written == 0))
+        else:
+            cols = {'id': ids} | cols
+            if self._dtype is None:
+                self._set_dtype(cols)
+            records = np.empty(self._buffer_rows, dtype=self._dtype)
+            for name, col in cols.items():
+                records[name] = col
+            with open(self._part_file, 'wb' if self.n_written == 0 else 'ab') as f:
+                records.tofile(f)
+
+        self.n_written += self._buffer_rows
+        self._buffer = []
+        self._buffer_rows = 0
+
+    def _set_dtype(self, cols:dict[str, np.ndarray]) -> None:
+        # FITS binary tables are big-endian records
+        self._dtype = np.dtype([(name, col.dtype.newbyteorder('>')) for (name, col) in cols.items()])
+
+    def _empty_columns(self) -> dict[str, np.ndarray]:
+        """Columns of no rows, from the galaxies added (all rows dropped) or just the ids if none were"""
+
+        cols = {'id': np.empty(0, dtype=int)}
+        if self._buffer:
+            return cols | {name: col[:0] for (name, col) in self._buffer[0].items()}
+        return cols | {name: np.empty(0, dtype=int) for name in ['galaxy_idx', 'galaxy_id', 'pixel_id']}
+
+    def _finish_fits(self) -> None:
+        # header of an empty table with the same columns, then set to the final length
+        empty = Table(np.empty(0, dtype=self._dtype))
+        header = fits.table_to_hdu(empty).header
+        header['NAXIS2'] = self.n_written
+
+        with open(self.filepath, 'wb') as f:
+            f.write(fits.PrimaryHDU().header.tostring().encode('ascii'))
+            f.write(header.tostring().encode('ascii'))
+            size = 0
+            if self.n_written > 0:
+                with open(self._part_file, 'rb') as part:
+                    while True:
+                        block = part.read(1 << 24)
+                        if not block:
+                            break
+                        f.write(block)
+                        size += len(block)
+            # pad data to a whole FITS block
+            f.write(b'\0' * (-size % 2880))
+
+        if self.n_written > 0:
+            os.remove(self._part_file)
+
+    def close(self) -> None:
+        """Write any remaining rows, finish the file and save the galaxy row offsets"""
+
+        self.flush()
+        if self.catalog_format == 'fits':
+            if self._dtype is None:
+                # no rows written, still leave a table with the columns
+                self._set_dtype(self._empty_columns())
+            self._finish_fits()
+        elif self.n_written == 0:
+            pd.DataFrame(self._empty_columns()).drop(columns='id').to_csv(self.filepath, index_label='id')
+
+        np.save(offsets_path(self.run_folder), np.array(self.offsets, dtype=int).reshape(-1, 2))
+
+
+def offsets_path(run_folder:str) -> str:
+    """Path of the (start, stop) rows of each galaxy within the EAZY input file"""
+    return f'{run_folder}/EAZY_offsets.npy'
+
+def eazy_catalog_path(run_folder:str) -> str:
+    """
+    Path of the EAZY input file of a run, the FITS table if it exists, otherwise the csv.
+    """
+
+    fits_file = f'{run_folder}/EAZY_input.fits'
+    if os.path.isfile(fits_file):
+        return fits_file
+    return f'{run_folder}/EAZY_input.csv'
+
+def read_eazy_catalog(run_folder:str, columns:list[str]|None=None) -> pd.DataFrame:
+    """
+    Read the EAZY input file of a run (FITS or csv).
+
+    Parameters
+    ----------
+    run_folder : str
+        Folder of the run
+    columns : list[str] | None, default None
+        If set, only read these columns
+
+    Returns
+    -------
+    catalog : DataFrame
+        The catalog, indexed by row
+    """
+
+    filepath = eazy_catalog_path(run_folder)
+
+    if filepath.endswith('.csv'):
+        return pd.read_csv(filepath, usecols=columns)
+
+    with fits.open(filepath, memmap=True) as hdul:
+        data = hdul[1].data
+        if columns is None:
+            columns = data.columns.names
+        # convert from FITS big-endian for pandas
+        return pd.DataFrame({name: data[name].astype(data[name].dtype.newbyteorder('=')) for name in columns})
+
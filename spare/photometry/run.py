@@ -1,18 +1,229 @@
 import os
+import shutil
+from typing import Literal
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import hashlib
+import json
 
 import numpy as np
+from astropy.io import fits
+from astropy.table import Table
 import eazy
 import eazy.hdf5
+import eazy.param
+import eazy.utils
 
 from ..filemanage import RunManager
+from ..filemanage.catalog import _file_stamp
+from .prep import eazy_catalog_path
+from .chi2store import encode_chi2
+from .fitstore import fit_folder, catalog_index, save_fit_data
+
+
+__all__ = ['WrapperEAZY', 'init_wrapper_from_hdf5', 'resume', 'tempfilt_key', 'fit_coarse_to_fine']
+
+
+# fit options of checkpointed fits saved before they were recorded
+_DEFAULT_FIT_OPTIONS = {'coarse_step': None, 'n_minima': 2}
+
+# parameters that the template grid (tempfilt) depends on
+TEMPFILT_PARAMS = [
+    'TEMPLATES_FILE', 'TEMPLATE_SMOOTH', 'RESAMPLE_WAVE',
+    'IGM_SCALE_TAU', 'ADD_CGM', 'SIGMOID_PARAM1', 'SIGMOID_PARAM2', 'SIGMOID_PARAM3',
+    'Z_MIN', 'Z_MAX', 'Z_STEP', 'Z_STEP_TYPE',
+    'FILTERS_RES', 'MW_EBV', 'SCALE_2175_BUMP'
+]
+
+
+def _catalog_columns(catalog_file:str) -> list[str]:
+    """Column names of the catalog, read from its header only"""
+    if 'fits' in catalog_file.lower():
+        header = fits.getheader(catalog_file, 1)
+        return [header[f'TTYPE{i+1}'] for i in range(header['TFIELDS'])]
+    with open(catalog_file) as f:
+        return f.readline().strip().split(',')
+
+def _template_files(templates_file:str) -> list[str]:
+    """Paths of the templates listed in a templates param file"""
+    files = []
+    with open(templates_file) as f:
+        for line in f:
+            parts = line.split()
+            if (len(parts) > 1) and not parts[0].startswith('#'):
+                files.append(parts[1])
+    return files
+
+def tempfilt_key(param_file:str|None, params:dict, translate_file:str) -> str:
+    """
+    Hash identifying the template grid (tempfilt) a photoz object would compute.
+
+    Covers the grid and template parameters (`TEMPFILT_PARAMS`), the contents of the templates and translate files,
+    the size and modification time of each template and of the filter file, the catalog columns (which set the filters)
+    and the eazy version.
+
+    Parameters
+    ----------
+    param_file : str | None
+        Param file, as passed to the photoz object
+    params : dict
+        Parameters above the param file
+    translate_file : str
+        Translate file
+
+    Returns
+    -------
+    key : str
+        Hex digest
+    """
 
+    param = eazy.param.read_param_file(param_file, verbose=False)
+    for key in params:
+        param.params[key] = params[key]
+
+    def stamp(path:str) -> dict|str:
+        if not os.path.isfile(path):
+            return path
+        file_stamp = _file_stamp(path)
+        return {'size': file_stamp['size'], 'mtime': file_stamp['mtime']}
+
+    def contents(path:str) -> str:
+        with open(path) as f:
+            return f.read()
+
+    templates_file = param['TEMPLATES_FILE']
+    parts = {
+        'eazy': eazy.__version__,
+        'params': {key: str(param[key]) for key in TEMPFILT_PARAMS if key in param.params},
+        'templates_file': contents(templates_file),
+        'templates': [stamp(file) for file in _template_files(templates_file)],
+        'filters_res': stamp(param['FILTERS_RES']),
+        'translate': contents(translate_file),
+        'columns': _catalog_columns(param['CATALOG_FILE'])
+    }
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode()).hexdigest()
+
+def _save_tempfilt(filepath:str, tempfilt_data:np.ndarray) -> None:
+    """Save a template grid, via a temporary file so that concurrent writers never leave a partial file"""
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+    tmp_file = f'{filepath}.{os.getpid()}.tmp.npy'
+    np.save(tmp_file, tempfilt_data)
+    os.replace(tmp_file, filepath)
+
+def _save_chunk(filepath:str, result:dict[str, np.ndarray]) -> None:
+    """Save the fit of a chunk, via a temporary file so that an interrupted write never leaves a partial chunk"""
+    tmp_file = f'{filepath}.{os.getpid()}.tmp'
+    with open(tmp_file, 'wb') as f:
+        np.savez(f, **result)
+    os.replace(tmp_file, filepath)
+
+def _load_tempfilt(filepath:str|None) -> np.ndarray|None:
+    if (filepath is None) or not os.path.isfile(filepath):
+        return None
+    return np.load(filepath)
+
+
+def fit_coarse_to_fine(photoz:eazy.photoz.PhotoZ, coarse_step:int, n_minima:int=2) -> np.ndarray:
+    """
+    Fit the catalog of a photoz object in two passes, in place of `fit_catalog`.
+
+    Every object is first fit at every `coarse_step`-th point of `zgrid` (and the last).
+    Each object is then fit at every point of `zgrid` within windows around its `n_minima` lowest local minima
+    of the coarse chi2, each window reaching to the coarse points either side of its minimum.
+    The chi2 at points not evaluated is linearly interpolated between the coarse points,
+    so `chi2_fit` keeps the full `zgrid`, and zbest is then found as by `fit_catalog`.
+
+    Parameters
+    ----------
+    photoz : PhotoZ
+        Photoz object to fit, with `chi2_fit`, `fit_coeffs`, `zbest` etc. updated in place
+    coarse_step : int
+        Number of `zgrid` steps between coarse points
+    n_minima : int, default 2
+        Number of coarse minima of each object refit finely
+
+    Returns
+    -------
+    windows : ndarray[int]
+        Shape (NOBJ, n_minima, 2) of the first and last `zgrid` index of each fine window, -1 for no window.
+        The chi2 of an object was evaluated at the coarse points and within its windows, and interpolated elsewhere
+    """
 
-__all__ = ['WrapperEAZY', 'init_wrapper_from_hdf5']
+    from eazy.photoz import fit_by_redshift
+
+    fnu_corr = photoz.fnu*photoz.ext_redden*photoz.zp
+    efnu_corr = photoz.efnu*photoz.ext_redden*photoz.zp
+    efnu_corr[photoz.fnu < photoz.param['NOT_OBS_THRESHOLD']] = photoz.param['NOT_OBS_THRESHOLD'] - 9.
+
+    fit_args = (
+        photoz.zp, photoz.param.params['VERBOSITY'], photoz.param['FITTER'],
+        photoz.param['RENORM_TEMPLATES'] in eazy.utils.TRUE_VALUES, photoz.param['HESS_THRESHOLD']
+    )
+
+    def fit_at(iz:int, objects:np.ndarray|slice) -> None:
+        z = photoz.zgrid[iz]
+        _, chi2, coeffs = fit_by_redshift(
+            iz, z, photoz.tempfilt(z), fnu_corr[objects], efnu_corr[objects], photoz.TEF(z), *fit_args
+        )
+        photoz.chi2_fit[objects, iz] = chi2
+        photoz.fit_coeffs[objects, iz, :] = coeffs
+
+    n_z = len(photoz.zgrid)
+    n_obj = photoz.NOBJ
+
+    # coarse pass
+    coarse = np.unique(np.append(np.arange(0, n_z, coarse_step), n_z - 1))
+    for iz in coarse:
+        fit_at(iz, slice(None))
+    chi2_coarse = photoz.chi2_fit[:, coarse]
+    has_chi2 = np.any(chi2_coarse != 0, axis=1)
+
+    # lowest local minima of the coarse chi2
+    padded = np.pad(chi2_coarse, ((0, 0), (1, 1)), constant_values=np.inf)
+    is_minimum = (chi2_coarse <= padded[:, :-2]) & (chi2_coarse <= padded[:, 2:])
+    ranked = np.argsort(np.where(is_minimum, chi2_coarse, np.inf), axis=1)[:, :n_minima]
+    valid = np.take_along_axis(is_minimum, ranked, axis=1) & has_chi2[:, np.newaxis]
+
+    windows = np.full((n_obj, ranked.shape[1], 2), -1, dtype=int)
+    windows[..., 0] = np.where(valid, coarse[np.maximum(ranked - 1, 0)], -1)
+    windows[..., 1] = np.where(valid, coarse[np.minimum(ranked + 1, len(coarse) - 1)], -1)
+
+    # fine pass, with the windows sorted by start to find those over each point
+    starts, ends = windows[valid].T
+    objects = np.nonzero(valid)[0]
+    order = np.argsort(starts, kind='stable')
+    starts, ends, objects = starts[order], ends[order], objects[order]
+    width = int(np.max(ends - starts, initial=0))
+
+    is_coarse = np.zeros(n_z, dtype=bool)
+    is_coarse[coarse] = True
+    for iz in np.flatnonzero(~is_coarse):
+        near = slice(np.searchsorted(starts, iz - width, 'left'), np.searchsorted(starts, iz, 'right'))
+        to_fit = np.unique(objects[near][ends[near] >= iz])
+        if to_fit.size:
+            fit_at(iz, to_fit)
+
+    # interpolate the points not evaluated
+    zi = np.arange(n_z)
+    j = np.clip(np.searchsorted(coarse, zi, 'right') - 1, 0, max(len(coarse) - 2, 0))
+    j_next = np.minimum(j + 1, len(coarse) - 1)
+    w = (zi - coarse[j]) / np.maximum(coarse[j_next] - coarse[j], 1)
+
+    evaluated = np.zeros((n_obj, n_z), dtype=bool)
+    evaluated[:, coarse] = True
+    for m in range(windows.shape[1]):
+        evaluated |= (zi >= windows[:, m, 0, np.newaxis]) & (zi <= windows[:, m, 1, np.newaxis])
+
+    interpolated = chi2_coarse[:, j]*(1 - w) + chi2_coarse[:, j_next]*w
+    photoz.chi2_fit[~evaluated] = interpolated[~evaluated]
+
+    photoz.fit_at_zbest(zbest=None, prior=False, beta_prior=False)
+
+    return windows
 
 
 class WrapperEAZY():
     """
-    Helper class for running EAZY on the EAZY_input.csv file.
+    Helper class for running EAZY on the EAZY_input.csv (or .fits) file.
 
     Parameters
     ----------
@@ -20,21 +231,39 @@ class WrapperEAZY():
         Identifier of the run to extract from
     config_file : str, default 'config.yml'
         Config file to use
+    cache_tempfilt : bool, default True
+        If set, the template grid (templates integrated through the filters over the zgrid) is kept in the
+        output cache folder, and reused by any later photoz object with the same templates, filters and zgrid
+        (see `tempfilt_key`), rather than being recomputed
+
+    Attributes
+    ----------
+    photoz : PhotoZ | None
+        The eazy photoz object, over the whole catalog
+    photoz_args : tuple | None
+        (param_file, params, translate_file) used to create photoz objects
+    fit_data : dict[str, ndarray] | None
+        zgrid, zbest and chi2 of the last fit, in catalog order
     """
 
-    def __init__(self, run_id:int, config_file:str='config.yml') -> None:
+    def __init__(self, run_id:int, config_file:str='config.yml', cache_tempfilt:bool=True) -> None:
         self.run_id = run_id
         self.runmanage = RunManager(config_file)
 
         self.run_folder = self.runmanage.run_folder(run_id)
         self.eazy_out_folder = f'{self.run_folder}/eazy'
 
+        self.cache_tempfilt = cache_tempfilt
+        self.tempfilt_folder = f'{self.runmanage.folder}/cache/tempfilt'
+
         self.photoz = None
+        self.photoz_args:tuple[str|None, dict, str]|None = None
+        self.fit_data:dict[str, np.ndarray]|None = None
 
     
-    def init_photoz(self, add_params:dict|None=None, param_file:str|None=None, translate_file:str='eazy_files/z_phot.translate') -> None:
+    def set_photoz_params(self, add_params:dict|None=None, param_file:str|None=None, translate_file:str='eazy_files/z_phot.translate') -> None:
         """
-        Initialise the photoz object from eazy, using given parameters and translate.
+        Set the parameters photoz objects are created with, without creating one.
         A set of default parameters are applied if no param_file is given.
         Additional parameters above the param file and defaults can be set with add_params.
 
@@ -50,9 +279,10 @@ class WrapperEAZY():
         
         # 'default' params if no param_file given
         if param_file is None:
+            catalog_file = eazy_catalog_path(self.run_folder)
             params = {
-                'CATALOG_FILE': f'{self.run_folder}/EAZY_input.csv',
-                'CATALOG_FORMAT': 'csv',
+                'CATALOG_FILE': catalog_file,
+                'CATALOG_FORMAT': 'fits' if catalog_file.endswith('.fits') else 'csv',
                 'FILTERS_RES': 'eazy_files/FILTER.RES.latest',
                 'TEMPLATES_FILE': 'templates/JADES/JADES_fsps_local.param',
                 'APPLY_PRIOR': 'n',
@@ -68,59 +298,297 @@ class WrapperEAZY():
         # add in add_params if needed
         if add_params is not None:
             params |= add_params
-        
-        # create photoz object
-        self.photoz = eazy.photoz.PhotoZ(param_file=param_file, params=params, translate_file=translate_file)
 
-    def run_EAZY_fit(self, save_to_hdf5:bool=True) -> None:
+        self.photoz_args = (param_file, params, translate_file)
+
+    def init_photoz(self, add_params:dict|None=None, param_file:str|None=None, translate_file:str='eazy_files/z_phot.translate') -> None:
+        """
+        Initialise the photoz object from eazy, using given parameters and translate.
+        A set of default parameters are applied if no param_file is given.
+        Additional parameters above the param file and defaults can be set with add_params.
+
+        Parameters
+        ----------
+        add_params : dict | None, default None
+            If set, will include these additional parameters
+        param_file : str | None, default None
+            If set, uses this param_file
+        translate_file : str, default 'eazy_files/z_phot.translate'
+            Translate file for use in photoz initialisation
+        """
+
+        self.set_photoz_params(add_params, param_file, translate_file)
+        param_file, params, translate_file = self.photoz_args
+
+        # create photoz object, with the template grid from cache if there
+        tempfilt_file = self.tempfilt_file()
+        tempfilt_data = _load_tempfilt(tempfilt_file)
+        self.photoz = eazy.photoz.PhotoZ(
+            param_file=param_file, params=params, translate_file=translate_file, tempfilt_data=tempfilt_data
+        )
+        if (tempfilt_file is not None) and (tempfilt_data is None):
+            _save_tempfilt(tempfilt_file, self.photoz.tempfilt.tempfilt)
+
+    def tempfilt_file(self) -> str|None:
+        """
+        Path of the cached template grid for the current photoz params, or `None` if not caching
+        """
+
+        if not self.cache_tempfilt:
+            return None
+        if self.photoz_args is None:
+            raise Exception('Need to set photoz params')
+        return f'{self.tempfilt_folder}/{tempfilt_key(*self.photoz_args)}.npy'
+
+    def run_EAZY_fit(
+            self, save_to_hdf5:bool=True, workers:int=1, chunk_rows:int=50_000, checkpoint:bool=False,
+            coarse_step:int|None=None, n_minima:int=2
+        ) -> None:
         """
         Run EAZY using the current photoz object.
         Saves instance to hdf5 file.
 
+        If `workers` is more than 1, or `checkpoint` is set, the catalog is instead split into chunks of rows,
+        fit in a pool of processes (see `run_EAZY_fit_parallel`).
+
         Parameters
         ----------
         save_to_hdf5 : bool, default True
-            Controls whether photoz object is saved using hdf5
+            Controls whether photoz object is saved using hdf5.
+            Not possible for a chunked fit, as there is then no photoz object over the whole catalog
+        workers : int, default 1
+            Number of processes to fit with
+        chunk_rows : int, default 50000
+            Maximum number of catalog rows fit at once by each process
+        checkpoint : bool, default False
+            If set, each chunk is saved as it completes, so that an interrupted run can be continued with `resume`
+        coarse_step : int | None, default None
+            If set, fit on a coarse grid of every `coarse_step`-th redshift,
+            then finely only around the coarse minima (see `fit_coarse_to_fine`)
+        n_minima : int, default 2
+            Number of coarse minima refit finely, with `coarse_step`
         """
+
+        if (workers > 1) or checkpoint:
+            self.run_EAZY_fit_parallel(workers, chunk_rows, checkpoint, coarse_step, n_minima)
+            if save_to_hdf5:
+                print('Warning: photoz object not saved to hdf5 for a chunked fit, only fit_data')
+            return
         
         if self.photoz is None:
             raise Exception('Need to init photoz object')
 
-        self.photoz.fit_catalog()
+        windows = None
+        if coarse_step is None:
+            self.photoz.fit_catalog()
+        else:
+            windows = fit_coarse_to_fine(self.photoz, coarse_step, n_minima)
+        self.fit_data = _fit_data(self.photoz, windows)
         
         if save_to_hdf5:
             os.makedirs(self.eazy_out_folder, exist_ok=True)
             eazy.hdf5.write_hdf5(self.photoz, f'{self.eazy_out_folder}/photoz.h5')
 
-    def save_EAZY_data(self, folder:str|None=None) -> None:
+    @property
+    def chunks_folder(self) -> str:
+        return f'{self.eazy_out_folder}/chunks'
+
+    @property
+    def progress_file(self) -> str:
+        return f'{self.eazy_out_folder}/progress.json'
+
+    def read_progress(self) -> dict|None:
         """
-        Saves relevant EAZY data from the fit as npz file.
+        Progress of a checkpointed fit, or `None` if there is none.
+
+        Keys are `n_rows`, `chunk_rows`, `n_chunks`, `done` (indices of the chunks saved),
+        `photoz_args` (param_file, params and translate_file of the fit) and `fit_options` (coarse_step and n_minima).
+        """
+
+        if not os.path.isfile(self.progress_file):
+            return None
+        with open(self.progress_file) as f:
+            return json.load(f)
+
+    def _write_progress(self, progress:dict) -> None:
+        tmp_file = f'{self.progress_file}.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(progress, f, indent=4, default=str)
+        os.replace(tmp_file, self.progress_file)
+
+    def _chunk_file(self, i:int) -> str:
+        return f'{self.chunks_folder}/chunk_{i:05d}.npz'
+
+    def run_EAZY_fit_parallel(
+            self, workers:int, chunk_rows:int=50_000, checkpoint:bool=False,
+            coarse_step:int|None=None, n_minima:int=2
+        ) -> None:
+        """
+        Fit the catalog in chunks of rows across a pool of processes.
+
+        Each process keeps the template grid (`tempfilt`) of its first chunk (or loads it from the cache),
+        so it is only computed once per process, and each chunk is fit by a photoz object of its rows only,
+        keeping memory to the chunk size. The zbest and chi2 of the chunks are merged into `fit_data`,
+        in the order of the catalog.
+
+        With `checkpoint`, each chunk is written to `eazy/chunks` as it completes and recorded in `eazy/progress.json`,
+        and chunks already recorded there (from an earlier, interrupted call) are not fit again.
+
+        Parameters
+        ----------
+        workers : int
+            Number of processes to fit with. With 1, chunks are fit within this process
+        chunk_rows : int, default 50000
+            Maximum number of catalog rows in each chunk.
+            Chunks are made smaller if needed so that every process has at least one.
+            Ignored when continuing a checkpointed fit, which keeps its chunks
+        checkpoint : bool, default False
+            Save and record each chunk as it completes
+        coarse_step : int | None, default None
+            If set, fit each chunk coarse to fine (see `fit_coarse_to_fine`).
+            When continuing a checkpointed fit, this, `n_minima` and the photoz params must match those it was started with
+        n_minima : int, default 2
+            Number of coarse minima refit finely, with `coarse_step`
+        """
+
+        if self.photoz_args is None:
+            raise Exception('Need to set photoz params')
+        param_file, params, translate_file = self.photoz_args
+
+        catalog_file = params.get('CATALOG_FILE', eazy_catalog_path(self.run_folder))
+        catalog = Table.read(catalog_file, format='fits' if ('fits' in catalog_file.lower()) else 'csv')
+        n_rows = len(catalog)
+
+        photoz_args = {'param_file': param_file, 'params': params, 'translate_file': translate_file}
+        fit_options = {'coarse_step': coarse_step, 'n_minima': n_minima}
+
+        progress = self.read_progress() if checkpoint else None
+        if progress is not None:
+            if progress['n_rows'] != n_rows:
+                raise Exception(f'Checkpointed fit was of {progress["n_rows"]} rows, catalog has {n_rows}')
+            # compared as saved, through json
+            if progress['photoz_args'] != json.loads(json.dumps(photoz_args, default=str)):
+                raise Exception('Checkpointed fit was with different photoz params, use `resume` to finish it')
+            if progress.get('fit_options', _DEFAULT_FIT_OPTIONS) != fit_options:
+                raise Exception(f'Checkpointed fit was with options {progress.get("fit_options", _DEFAULT_FIT_OPTIONS)}, not {fit_options}')
+        else:
+            chunk_rows = max(min(chunk_rows, -(-n_rows // max(workers, 1))), 1)
+            progress = {
+                'n_rows': n_rows,
+                'chunk_rows': chunk_rows,
+                'n_chunks': -(-n_rows // chunk_rows),
+                'done': [],
+                'photoz_args': photoz_args,
+                'fit_options': fit_options
+            }
+            if checkpoint:
+                os.makedirs(self.chunks_folder, exist_ok=True)
+                self._write_progress(progress)
+        chunk_rows = progress['chunk_rows']
+
+        todo = [i for i in range(progress['n_chunks']) if i not in progress['done']]
+        results:dict[int, dict[str, np.ndarray]] = dict()
+
+        def finished(i:int, result:dict[str, np.ndarray]) -> None:
+            if not checkpoint:
+                results[i] = result
+                return
+            _save_chunk(self._chunk_file(i), result)
+            # kept in catalog order, whatever order the chunks finish in
+            progress['done'] = sorted(progress['done'] + [i])
+            self._write_progress(progress)
+
+        initargs = (*self.photoz_args, self.tempfilt_file())
+        if workers > 1:
+            # each process builds its template grid serially, as the pool already uses the cores
+            with ProcessPoolExecutor(workers, initializer=_init_fit_worker, initargs=(*initargs, -1)) as pool:
+                # at most two chunks per process in flight, so only those are held pickled at once
+                todo_iter = iter(todo)
+                running = dict()
+                for i in todo_iter:
+                    running[pool.submit(_fit_chunk, catalog[i*chunk_rows:(i+1)*chunk_rows], **fit_options)] = i
+                    if len(running) >= 2 * workers:
+                        break
+                while running:
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        finished(running.pop(future), future.result())
+                        i = next(todo_iter, None)
+                        if i is not None:
+                            running[pool.submit(_fit_chunk, catalog[i*chunk_rows:(i+1)*chunk_rows], **fit_options)] = i
+        else:
+            _init_fit_worker(*initargs)
+            for i in todo:
+                finished(i, _fit_chunk(catalog[i*chunk_rows:(i+1)*chunk_rows], **fit_options))
+
+        if checkpoint:
+            for i in range(progress['n_chunks']):
+                with np.load(self._chunk_file(i)) as chunk:
+                    results[i] = dict(chunk)
+        ordered = [results[i] for i in range(progress['n_chunks'])]
+
+        self.fit_data = {'zgrid': ordered[0]['zgrid']}
+        for name in ordered[0]:
+            if name != 'zgrid':
+                self.fit_data[name] = np.concatenate([result[name] for result in ordered])
+
+    def save_EAZY_data(
+            self, folder:str|None=None,
+            chi2_storage:Literal['float64', 'float32', 'compressed', 'topk', 'percentiles']='float64', **storage_options
+        ) -> None:
+        """
+        Saves relevant EAZY data from the fit, as one `.npy` file per array in the `fit` folder
+        (see `save_fit_data`), so that `Extract` can memory-map them.
+        Alongside are the `pixel_id` of each row and the `galaxy_offsets` (start, stop) rows of each galaxy.
         Saved in same location as hdf5 if no location specified.
+        With `compressed` storage, arrays are instead saved to a compressed `fit_data.npz`, which cannot be memory-mapped.
 
         Parameters
         ----------
         folder : str | None, default None
             If specified, will save in that folder instead
+        chi2_storage : Literal['float64', 'float32', 'compressed', 'topk', 'percentiles'], default float64
+            How chi2 is stored, dense or reduced (see `encode_chi2`).
+            `Extract` turns any of them back into dense chi2
+        **storage_options
+            `k` and `half_width` for `topk`
         """
 
-        if self.photoz is None:
+        if self.fit_data is not None:
+            fit_data = self.fit_data
+        elif self.photoz is not None:
+            fit_data = _fit_data(self.photoz)
+        else:
             raise Exception('Must have photoz object instantiated')
-        if not np.any(self.photoz.zbest):
+        if not np.any(fit_data['zbest']):
             print('Warning: All zbest values are zero')
 
-        fit_data = {
-            'zgrid': self.photoz.zgrid,
-            'zbest': self.photoz.zbest,
-            'chi2': self.photoz.chi2_fit
-        }
-
         if folder is None:
             folder = self.eazy_out_folder
 
-        np.savez(f'{folder}/fit_data.npz', **fit_data)
+        chi2 = fit_data['chi2']
+        fit_data = {name: array for (name, array) in fit_data.items() if name != 'chi2'}
+        fit_data |= encode_chi2(chi2, fit_data['zgrid'], chi2_storage, **storage_options)
 
+        fit_data |= catalog_index(self.run_folder)
 
-    def init_and_run_EAZY(self, save_output:bool=True, add_params:dict|None=None, param_file:str|None=None, translate_file:str='eazy_files/z_phot.translate') -> None:
+        os.makedirs(folder, exist_ok=True)
+        # any save of the other form from an earlier fit of the run would otherwise be out of date
+        if chi2_storage == 'compressed':
+            np.savez_compressed(f'{folder}/fit_data.npz', **fit_data)
+            if os.path.isdir(fit_folder(folder)):
+                shutil.rmtree(fit_folder(folder))
+        else:
+            save_fit_data(fit_folder(folder), fit_data)
+            if os.path.isfile(f'{folder}/fit_data.npz'):
+                os.remove(f'{folder}/fit_data.npz')
+
+    def init_and_run_EAZY(
+            self, save_output:bool=True, add_params:dict|None=None, param_file:str|None=None, translate_file:str='eazy_files/z_phot.translate',
+            workers:int=1, chunk_rows:int=50_000, checkpoint:bool=False,
+            coarse_step:int|None=None, n_minima:int=2,
+            chi2_storage:Literal['float64', 'float32', 'compressed', 'topk', 'percentiles']='float64'
+        ) -> None:
         """
         Perform both the initialisation of photoz object and run of EAZY.
 
@@ -138,15 +606,74 @@ class WrapperEAZY():
             If set, uses this param_file
         translate_file : str, default 'eazy_files/z_phot.translate'
             Translate file for use in photoz initialisation
+        workers : int, default 1
+            If more than 1, the catalog is fit in chunks across this many processes,
+            and no photoz object over the whole catalog is created (or saved to hdf5)
+        chunk_rows : int, default 50000
+            Maximum number of catalog rows in each chunk, for a parallel fit
+        checkpoint : bool, default False
+            If set, the fit is done in chunks, each saved as it completes,
+            so that an interrupted run can be finished with `resume`
+        coarse_step : int | None, default None
+            If set, fit coarse to fine (see `fit_coarse_to_fine`), every `coarse_step`-th redshift first
+        n_minima : int, default 2
+            Number of coarse minima refit finely, with `coarse_step`
+        chi2_storage : Literal['float64', 'float32', 'compressed', 'topk', 'percentiles'], default float64
+            How chi2 is saved (see `save_EAZY_data`)
         """
 
-        self.init_photoz(add_params, param_file, translate_file)
-        self.run_EAZY_fit(save_to_hdf5=save_output)
+        if (workers > 1) or checkpoint:
+            self.set_photoz_params(add_params, param_file, translate_file)
+        else:
+            self.init_photoz(add_params, param_file, translate_file)
+        self.run_EAZY_fit(save_output, workers, chunk_rows, checkpoint, coarse_step, n_minima)
         if save_output:
-            self.save_EAZY_data()
+            self.save_EAZY_data(chi2_storage=chi2_storage)
 
 
 
+# state of each fitting process, set by `_init_fit_worker`
+_fit_worker:dict = dict()
+
+def _init_fit_worker(param_file:str|None, params:dict, translate_file:str, tempfilt_file:str|None, n_proc:int=0) -> None:
+    # n_proc of the template grid, as eazy: 0 for all cores, -1 for serial
+    _fit_worker['args'] = (param_file, params, translate_file)
+    _fit_worker['tempfilt_file'] = tempfilt_file
+    _fit_worker['tempfilt'] = None
+    _fit_worker['n_proc'] = n_proc
+
+def _fit_data(photoz:eazy.photoz.PhotoZ, windows:np.ndarray|None=None) -> dict[str, np.ndarray]:
+    """Arrays kept from a fit: zgrid, zbest, chi2, and the fine windows if fit coarse to fine"""
+    fit_data = {
+        'zgrid': photoz.zgrid,
+        'zbest': photoz.zbest,
+        'chi2': photoz.chi2_fit
+    }
+    if windows is not None:
+        fit_data['windows'] = windows
+    return fit_data
+
+def _fit_chunk(catalog:Table, coarse_step:int|None=None, n_minima:int=2) -> dict[str, np.ndarray]:
+    """Fit the rows of a chunk of the catalog, returning the `fit_data` of the chunk"""
+
+    param_file, params, translate_file = _fit_worker['args']
+    tempfilt_file = _fit_worker['tempfilt_file']
+    tempfilt_data = _load_tempfilt(tempfilt_file) if (_fit_worker['tempfilt'] is None) else None
+
+    photoz = eazy.photoz.PhotoZ(
+        param_file=param_file, params=params | {'CATALOG_FILE': catalog}, translate_file=translate_file,
+        tempfilt=_fit_worker['tempfilt'], tempfilt_data=tempfilt_data, n_proc=_fit_worker['n_proc']
+    )
+    if (_fit_worker['tempfilt'] is None) and (tempfilt_file is not None) and (tempfilt_data is None):
+        _save_tempfilt(tempfilt_file, photoz.tempfilt.tempfilt)
+    _fit_worker['tempfilt'] = photoz.tempfilt
+
+    if coarse_step is None:
+        photoz.fit_catalog(n_proc=0, verbose=False)
+        return _fit_data(photoz)
+    return _fit_data(photoz, fit_coarse_to_fine(photoz, coarse_step, n_minima))
+
+
 def init_wrapper_from_hdf5(run_id:int, config_file:str='config.yml') -> WrapperEAZY:
     """
     Initialise a `WrapperEAZY` object from the hdf5 produced after a run.
@@ -163,3 +690,42 @@ def init_wrapper_from_hdf5(run_id:int, config_file:str='config.yml') -> WrapperE
     wrapper.photoz = eazy.hdf5.initialize_from_hdf5(f'{wrapper.eazy_out_folder}/photoz.h5')
     return wrapper
 
+
+def resume(
+        run_id:int, config_file:str='config.yml', workers:int=1,
+        chi2_storage:Literal['float64', 'float32', 'compressed', 'topk', 'percentiles']='float64'
+    ) -> WrapperEAZY:
+    """
+    Finish a checkpointed EAZY run (see `WrapperEAZY.run_EAZY_fit_parallel`) that was interrupted,
+    fitting only the chunks not yet saved, with the same photoz params.
+    The chunks are then assembled and saved as `fit_data`.
+
+    Parameters
+    ----------
+    run_id : int
+        Identifier of the run to finish
+    config_file : str, default 'config.yml'
+        Config file to use
+    workers : int, default 1
+        Number of processes to fit the remaining chunks with
+    chi2_storage : Literal['float64', 'float32', 'compressed', 'topk', 'percentiles'], default float64
+        How chi2 is saved (see `WrapperEAZY.save_EAZY_data`)
+
+    Returns
+    -------
+    wrapper : WrapperEAZY
+        Wrapper of the run, with `fit_data` of the whole catalog
+    """
+
+    wrapper = WrapperEAZY(run_id, config_file)
+    progress = wrapper.read_progress()
+    if progress is None:
+        raise Exception(f'Run {run_id} has no checkpointed fit to resume')
+
+    args = progress['photoz_args']
+    wrapper.photoz_args = (args['param_file'], args['params'], args['translate_file'])
+
+    wrapper.run_EAZY_fit_parallel(workers, progress['chunk_rows'], checkpoint=True, **progress.get('fit_options', _DEFAULT_FIT_OPTIONS))
+    wrapper.save_EAZY_data(chi2_storage=chi2_storage)
+
+    return wrapper
@@ -24,9 +24,12 @@ def _ax_single_chi2(ax:plt.Axes, zgrid:np.ndarray, chi2:np.ndarray, zbest:float|
 
 def pixel_chi2(galaxy:PhotGalaxy, x_idx:int, y_idx:int, zmark:float|None=None) -> plt.Figure:
     zgrid = galaxy.zgrid
-    chi2 = galaxy.chi2_reshaped()[y_idx, x_idx, :]
+    chi2 = galaxy.pixel_chi2(y_idx, x_idx)
 
     zbest = galaxy.zbest_reshaped()[y_idx, x_idx]
+    if np.isnan(zbest):
+        # pixel not fit
+        zbest = None
 
     fig, ax = plt.subplots()
     _ax_single_chi2(ax, zgrid, chi2, zbest, zmark)
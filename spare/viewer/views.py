@@ -53,18 +53,18 @@ def _ax_redshift(ax:plt.Axes, galaxy:PhotGalaxy, show_text:bool) -> None:
     ax.imshow(zbest, cmap=cmap, origin='lower')
 
     if show_text:
-        for i, row in enumerate(zbest):
-            for j, z in enumerate(row):
-                _ = ax.text(j, i, f'{z:.1f}', ha='center', va='center', color='w')
+        # no text over pixels not fit
+        for i, j in zip(*np.nonzero(np.isfinite(zbest))):
+            _ = ax.text(j, i, f'{zbest[i, j]:.1f}', ha='center', va='center', color='w')
 
 def _ax_max_chi2(ax:plt.Axes, galaxy:PhotGalaxy, max_value:float|None=None) -> None:
-    chi2 = galaxy.chi2_reshaped()
-    max_chi2 = np.max(chi2, axis=2)
+    # NaN where not fit
+    max_chi2 = galaxy.max_chi2_map()
 
     cmap = plt.get_cmap('plasma').reversed()
     cmap.set_bad(color='green')
 
-    if (max_value is None) or (np.max(max_chi2) < max_value):
+    if (max_value is None) or (np.nanmax(max_chi2, initial=-np.inf) < max_value):
         ax.imshow(max_chi2, cmap=cmap, origin='lower')
     else:
         ax.imshow(max_chi2, cmap=cmap, origin='lower', vmax=max_value)
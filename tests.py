@@ -1,10 +1,90 @@
 import unittest
+import unittest.mock
 
+import os
 import json
+import tempfile
+import warnings
+import yaml
 import numpy as np
+from astropy.io import fits
+from astropy.table import Table
 
 import spare
 
+def synthetic_galaxy(shape:tuple[int, int]=(9, 11), id:int=1, filters:list[str]=['F090W', 'F200W'], seed:int=0) -> spare.galaxy.Galaxy:
+    """Galaxy of random positive fluxes and unit errors, with a rectangle of the segmap as the object"""
+
+    rng = np.random.default_rng(seed)
+    segmap = np.zeros(shape, dtype=int)
+    segmap[2:shape[0]-2, 3:shape[1]-3] = id
+    values = {filt: rng.uniform(1, 10, shape) for filt in filters}
+    errors = {filt: np.ones(shape) for filt in filters}
+
+    return spare.galaxy.Galaxy(id, (shape[0]/2, shape[1]/2), ((0, shape[0]-1), (0, shape[1]-1)), values, errors, segmap)
+
+
+def synthetic_config(folder:str, shape:tuple[int, int]=(60, 80), filters:list[str]=['F090W', 'F200W']) -> str:
+    """
+    Write a small mosaic, segmap and catalog of four round galaxies into folder,
+    returning the path of a config file for them
+    """
+
+    rng = np.random.default_rng(0)
+    yy, xx = np.ogrid[:shape[0], :shape[1]]
+    segmap = np.zeros(shape, dtype=np.int32)
+    rows = []
+    for id, y, x, r in [(11, 12, 15, 5), (4, 30, 40, 7), (27, 48, 65, 6), (8, 14, 26, 3)]:
+        segmap[((yy - y)**2 + (xx - x)**2 <= r*r) & (segmap == 0)] = id
+        ys, xs = np.nonzero(segmap == id)
+        rows.append((id, xs.mean(), ys.mean(), xs.min(), xs.max(), ys.min(), ys.max()))
+
+    os.makedirs(f'{folder}/cat')
+    size = Table(rows=rows, names=['ID', 'X', 'Y', 'BBOX_XMIN', 'BBOX_XMAX', 'BBOX_YMIN', 'BBOX_YMAX'])
+    photoz = Table({'ID': size['ID'], 'EAZY_z_a': rng.uniform(0, 5, len(size))})
+    fits.HDUList([fits.PrimaryHDU(), fits.BinTableHDU(size, name='SIZE'), fits.BinTableHDU(photoz, name='PHOTOZ')]).writeto(f'{folder}/cat/cat.fits')
+    fits.PrimaryHDU(segmap).writeto(f'{folder}/cat/seg.fits')
+
+    for filt in filters:
+        os.makedirs(f'{folder}/img/{filt}')
+        sci = (rng.normal(0, 1, shape) + 20*(segmap > 0)).astype(np.float32)
+        err = np.ones(shape, dtype=np.float32)
+        sci[:, :4] = 0
+        err[:, :4] = 0
+        fits.HDUList([fits.PrimaryHDU(), fits.ImageHDU(sci, name='SCI'), fits.ImageHDU(err, name='ERR')]).writeto(f'{folder}/img/{filt}/mosaic_{filt}.fits')
+
+    config = {
+        'catalogs': {'folder': f'{folder}/cat', 'phot_cat': 'cat.fits', 'segmap': 'seg.fits'},
+        'images': {'folder': f'{folder}/img', 'filename': 'mosaic_?.fits'},
+        'filters': filters,
+        'output': {'folder': f'{folder}/output'},
+    }
+    with open(f'{folder}/config.yml', 'w') as f:
+        yaml.safe_dump(config, f)
+    return f'{folder}/config.yml'
+
+
+def synthetic_fit(config_file:str, ids:list[int], store:str='hdf5', seed:int=0) -> int:
+    """
+    Prep a run of the galaxies of a synthetic config and save a made up fit of it,
+    with the chi2 of each row a parabola about a redshift of its galaxy. Returns the run id
+    """
+
+    run_id = spare.prep_for_EAZY('synthetic', ids, pixels='segmap', catalog_format='fits', store=store, config_file=config_file)
+    run_folder = spare.filemanage.RunManager(config_file).run_folder(run_id)
+    index = spare.photometry.catalog_index(run_folder)
+
+    rng = np.random.default_rng(seed)
+    zgrid = np.arange(0.01, 6, 0.01)
+    z_galaxy = rng.uniform(0.5, 4, len(ids))
+    z_rows = np.repeat(z_galaxy, np.diff(index['galaxy_offsets'], axis=1)[:, 0]) + rng.normal(0, 0.05, len(index['pixel_id']))
+    chi2 = 5 + ((zgrid - z_rows[:, np.newaxis]) / 0.2)**2 + rng.uniform(0, 1, (len(z_rows), 1))
+
+    fit_data = {'zgrid': zgrid, 'zbest': zgrid[np.argmin(chi2, axis=1)], 'chi2': chi2} | index
+    spare.photometry.save_fit_data(spare.photometry.fit_folder(f'{run_folder}/eazy'), fit_data)
+    return run_id
+
+
 class TestData(unittest.TestCase):
     def setUp(self):
         self.data = spare.filemanage.Data()
@@ -18,9 +98,198 @@ class TestData(unittest.TestCase):
         self.assertEqual(segmap_shape, image_shape)
 
 
+class TestLazyData(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        config_file = synthetic_config(self.tmp.name)
+        self.data = spare.filemanage.Data(config_file)
+        self.lazy = spare.filemanage.Data(config_file, lazy=True)
+
+    def test_lazy_same_galaxy(self):
+        galaxy = spare.extract_galaxy(4, self.data)
+        lazy_galaxy = spare.extract_galaxy(4, self.lazy)
+        self.assertEqual(galaxy, lazy_galaxy)
+        for filt in self.data.filters:
+            self.assertTrue(np.array_equal(galaxy.values[filt], lazy_galaxy.values[filt]))
+            self.assertTrue(np.array_equal(galaxy.errors[filt], lazy_galaxy.errors[filt]))
+
+    def test_section_cutouts(self):
+        # all within the default gap of each other, so read from one shared section
+        ids = [11, 4, 27, 8]
+        galaxies = spare.extract_galaxies(ids, self.lazy, border=2)
+        for id, galaxy in zip(ids, galaxies):
+            eager = spare.extract_galaxy(id, self.data, border=2)
+            self.assertEqual(eager, galaxy)
+            self.assertTrue(np.array_equal(eager.segmap, galaxy.segmap))
+            for filt in self.data.filters:
+                self.assertTrue(np.array_equal(eager.values[filt], galaxy.values[filt]))
+                self.assertTrue(np.array_equal(eager.errors[filt], galaxy.errors[filt]))
+
+    def tearDown(self) -> None:
+        self.lazy.close()
+        self.data.close()
+        self.tmp.cleanup()
+
+
+class TestImageWorkers(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        self.filters = ['F090W', 'F200W', 'F356W', 'F444W']
+        synthetic_config(self.tmp.name, filters=self.filters)
+        self.paths = {filt: f'{self.tmp.name}/img/{filt}/mosaic_{filt}.fits' for filt in self.filters}
+
+    def test_filter_order(self):
+        images = spare.filemanage.data.Images(self.filters, self.paths, workers=3)
+        self.assertEqual(list(images.values), self.filters)
+        self.assertEqual(list(images.errors), self.filters)
+        self.assertEqual(list(images.load_times), self.filters)
+        for filt in self.filters:
+            self.assertTrue(np.array_equal(images.values[filt], fits.getdata(self.paths[filt], 'SCI')))
+            self.assertTrue(np.array_equal(images.errors[filt], fits.getdata(self.paths[filt], 'ERR')))
+            self.assertGreater(images.load_times[filt], 0)
+
+    def tearDown(self) -> None:
+        self.tmp.cleanup()
+
+
+class TestCutoutGroups(unittest.TestCase):
+    def test_section_capped(self):
+        # a chain of neighbouring boxes, each within the gap of the last
+        boxes = np.array([[0, 20, i*30, i*30 + 20] for i in range(200)])
+        self.assertEqual(len(spare.filemanage.CutoutReader.group_boxes(boxes, 64)), 1)
+
+        groups = spare.filemanage.CutoutReader.group_boxes(boxes, 64, max_section=2000)
+        self.assertGreater(len(groups), 1)
+        self.assertEqual(sorted(np.concatenate(groups)), list(range(200)))
+        for group in groups:
+            union = boxes[group]
+            area = (union[:, 1].max() - union[:, 0].min()) * (union[:, 3].max() - union[:, 2].min())
+            self.assertLessEqual(area, 2000)
+
+
+class TestCatalogIndex(unittest.TestCase):
+    def setUp(self) -> None:
+        self.folder = tempfile.TemporaryDirectory()
+        self.phot_cat = f'{self.folder.name}/cat.fits'
+
+        size = Table({name: np.arange(5) for name in spare.filemanage.CatalogIndex.SIZE_COLUMNS})
+        size['ID'] = [5, 3, 9, 1, 7]
+        # id 9 is missing from PHOTOZ
+        photoz = Table({'ID': [1, 3, 5, 7], 'EAZY_z_a': [0.1, 0.3, 0.5, 0.7]})
+        fits.HDUList([
+            fits.PrimaryHDU(), fits.BinTableHDU(size, name='SIZE'), fits.BinTableHDU(photoz, name='PHOTOZ')
+        ]).writeto(self.phot_cat)
+
+    def test_photoz_aligned(self):
+        catalog = spare.filemanage.CatalogIndex(self.phot_cat, self.folder.name)
+        z = catalog.lookup([1, 3, 5, 7, 9], ['EAZY_z_a'])['EAZY_z_a']
+        self.assertTrue(np.allclose(z[:4], [0.1, 0.3, 0.5, 0.7]))
+        self.assertTrue(np.isnan(z[4]))
+
+    def test_no_temporary_files(self):
+        catalog = spare.filemanage.CatalogIndex(self.phot_cat, self.folder.name)
+        self.assertFalse(any(name.endswith('.tmp') for name in os.listdir(catalog.folder)))
+
+    def tearDown(self) -> None:
+        self.folder.cleanup()
+
+
+class TestSegmapIndex(unittest.TestCase):
+    def setUp(self) -> None:
+        self.folder = tempfile.TemporaryDirectory()
+        self.segmap_path = f'{self.folder.name}/seg.fits'
+
+        self.segmap = np.zeros((20, 30), dtype=np.int32)
+        self.segmap[2:5, 3:7] = 4
+        self.segmap[10:18, 20:22] = 2
+        self.segmap[6, 8] = 4
+        fits.PrimaryHDU(self.segmap).writeto(self.segmap_path)
+
+        self.index = spare.filemanage.SegmapIndex(self.segmap_path, self.folder.name)
+
+    def test_queries(self):
+        self.assertEqual(list(self.index.ids), [2, 4])
+        self.assertEqual(list(self.index.bbox(4)), [2, 6, 3, 8])
+        self.assertEqual(self.index.count(2), 16)
+        self.assertTrue(np.array_equal(np.sort(self.index.pixels_of(4)), np.flatnonzero(self.segmap == 4)))
+        self.assertTrue(np.array_equal(self.index.mask(4, [0, 10, 0, 10]), self.segmap[0:10, 0:10] == 4))
+        self.assertEqual(list(self.index.neighbours(4, distance=15)), [2])
+        self.assertEqual(len(self.index.neighbours(4, distance=0)), 0)
+        self.assertNotIn(3, self.index)
+        with self.assertRaises(KeyError):
+            self.index.bbox(3)
+
+    def test_reload(self):
+        reloaded = spare.filemanage.SegmapIndex(self.segmap_path, self.folder.name)
+        self.assertTrue(np.array_equal(reloaded.bboxes, self.index.bboxes))
+        self.assertFalse(any(name.endswith('.tmp') for name in os.listdir(self.index.folder)))
+
+    def tearDown(self) -> None:
+        self.folder.cleanup()
+
+
+class TestDataCache(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        self.config_file = synthetic_config(self.tmp.name)
+
+    def touch(self, path:str) -> None:
+        """Move the modification time on, past the resolution of the file system"""
+        mtime = os.stat(path).st_mtime + 10
+        os.utime(path, (mtime, mtime))
+
+    def test_shared_instance(self):
+        data = spare.filemanage.get_data(self.config_file)
+        self.assertIs(spare.filemanage.get_data(self.config_file), data)
+        # the same file by another path
+        self.assertIs(spare.filemanage.get_data(f'{self.tmp.name}/./config.yml'), data)
+
+    def test_lazy_separate(self):
+        data = spare.filemanage.get_data(self.config_file)
+        lazy = spare.filemanage.get_data(self.config_file, lazy=True)
+        self.assertIsNot(data, lazy)
+        self.assertIs(spare.filemanage.get_data(self.config_file, lazy=True), lazy)
+
+    def test_config_modified(self):
+        data = spare.filemanage.get_data(self.config_file)
+        self.touch(self.config_file)
+        reloaded = spare.filemanage.get_data(self.config_file)
+        self.assertIsNot(reloaded, data)
+        self.assertIs(spare.filemanage.get_data(self.config_file), reloaded)
+
+    def test_image_modified(self):
+        data = spare.filemanage.get_data(self.config_file)
+        image = f'{self.tmp.name}/img/F200W/mosaic_F200W.fits'
+        with fits.open(image, mode='update') as hdul:
+            hdul['SCI'].data[:] = 1
+        self.touch(image)
+
+        reloaded = spare.filemanage.get_data(self.config_file)
+        self.assertIsNot(reloaded, data)
+        self.assertTrue(np.all(reloaded.images.values['F200W'] == 1))
+
+    def test_clear(self):
+        data = spare.filemanage.get_data(self.config_file)
+        spare.filemanage.clear_data_cache()
+        self.assertIsNot(spare.filemanage.get_data(self.config_file), data)
+
+    def test_galaxy_does_not_share_images(self):
+        data = spare.filemanage.get_data(self.config_file)
+        galaxy = spare.extract_galaxy(4, data)
+        filt = data.filters[0]
+        before = np.array(data.images.errors[filt][galaxy.ymin:galaxy.ymin+1, galaxy.xmin:galaxy.xmin+1])
+        galaxy.errors[filt][...] = -999
+        after = data.images.errors[filt][galaxy.ymin:galaxy.ymin+1, galaxy.xmin:galaxy.xmin+1]
+        self.assertTrue(np.array_equal(before, after, equal_nan=True))
+
+    def tearDown(self) -> None:
+        spare.filemanage.clear_data_cache()
+        self.tmp.cleanup()
+
+
 class TestGalaxy(unittest.TestCase):
     def setUp(self) -> None:
-        data = spare.filemanage.Data()
+        data = spare.filemanage.get_data()
         self.galaxy = spare.extract_galaxy(55733, data)
         # add in an 'unused' pixel to later test against
         self.filter_key = [k for k in self.galaxy.errors.keys()][0]
@@ -43,6 +312,21 @@ class TestGalaxy(unittest.TestCase):
         pixel = self.galaxy.errors[self.filter_key][0,0]
         self.assertEqual(-9999, pixel)
 
+    def test_stacked_replace_unused(self):
+        self.galaxy.stack()
+        self.galaxy.replace_unused_with_constant(-999, -9999)
+        pixel = self.galaxy.errors[self.filter_key][0,0]
+        self.assertEqual(-9999, pixel)
+        self.assertEqual(-9999, self.galaxy.error_cube[self.galaxy.filters.index(self.filter_key), 0, 0])
+
+    def test_drop_no_data_pixels(self):
+        for filt in self.galaxy.errors:
+            self.galaxy.errors[filt][0,0] = -999
+        self.galaxy.replace_unused_with_constant(-999, -9999)
+        pixel_ids, _ = spare.photometry.FileEAZY.galaxy_rows(self.galaxy, min_valid_bands=1)
+        self.assertNotIn(0, pixel_ids)
+        self.assertEqual(self.galaxy.size - 1, pixel_ids.size)
+
     def test_save_load(self):
         folder = self.rm.run_folder(self.run_id)
 
@@ -51,14 +335,883 @@ class TestGalaxy(unittest.TestCase):
 
         self.assertEqual(self.galaxy, new)
 
+    def test_save_load_store(self):
+        folder = self.rm.run_folder(self.run_id)
+
+        self.galaxy.save_to_store(spare.galaxy.store_path(folder))
+        new = spare.galaxy.load_galaxy_from_folder(f'{folder}/galaxies/0')
+
+        self.assertEqual(self.galaxy, new)
+
     def tearDown(self) -> None:
         self.rm.delete_run(self.run_id)
 
 
+class TestPixelSelection(unittest.TestCase):
+    def setUp(self) -> None:
+        self.galaxy = synthetic_galaxy()
+
+    def test_segmap(self):
+        self.galaxy.select_pixels('segmap')
+        self.assertTrue(np.array_equal(self.galaxy.selected, self.galaxy.segmap == self.galaxy.id))
+        self.assertTrue(np.array_equal(self.galaxy.selected_pixel_ids, np.flatnonzero(self.galaxy.segmap == self.galaxy.id)))
+
+    def test_dilate_disk(self):
+        # a single pixel object grows to a disk
+        self.galaxy.segmap[...] = 0
+        self.galaxy.segmap[4, 5] = self.galaxy.id
+        self.galaxy._segmap_mask = None
+
+        self.galaxy.select_pixels('segmap', dilate=1)
+        self.assertEqual(self.galaxy.selected.sum(), 5)
+        self.galaxy.select_pixels('segmap', dilate=2)
+        self.assertEqual(self.galaxy.selected.sum(), 13)
+        self.assertTrue(self.galaxy.selected[4, 3] and not self.galaxy.selected[2, 3])
+
+    def test_bbox(self):
+        self.galaxy.select_pixels('segmap')
+        self.galaxy.select_pixels('bbox')
+        self.assertIsNone(self.galaxy.selected)
+        self.assertEqual(self.galaxy.selected_pixel_ids.size, self.galaxy.size)
+
+    def test_rows_follow_selection(self):
+        self.galaxy.select_pixels('segmap', dilate=1)
+        pixel_ids, pixel_data = spare.photometry.FileEAZY.galaxy_rows(self.galaxy)
+        self.assertTrue(np.array_equal(pixel_ids, self.galaxy.selected_pixel_ids))
+        self.assertTrue(np.array_equal(pixel_data['F200W'], self.galaxy.values['F200W'].ravel()[pixel_ids]))
+
+    def test_unknown(self):
+        with self.assertRaises(ValueError):
+            self.galaxy.select_pixels('circle')
+
+
+class TestBinning(unittest.TestCase):
+    def setUp(self) -> None:
+        # signal within a factor 2, so adding any pixel to a bin never lowers its S/N
+        rng = np.random.default_rng(0)
+        self.signal = rng.uniform(5, 10, (30, 40))
+        self.noise = np.ones((30, 40))
+        self.mask = np.ones((30, 40), dtype=bool)
+        self.mask[10:15, 10:20] = False
+        self.mask[:, 35:] = False
+        self.target_sn = 25
+        self.bin_map = spare.galaxy.accrete_bins(self.signal, self.noise, self.mask, self.target_sn)
+
+    def test_masked(self):
+        self.assertTrue(np.all(self.bin_map[~self.mask] == -1))
+        self.assertTrue(np.all(self.bin_map[self.mask] >= 0))
+
+    def test_target_sn(self):
+        n_bins = self.bin_map.max() + 1
+        self.assertTrue(np.array_equal(np.unique(self.bin_map[self.mask]), np.arange(n_bins)))
+        for i in range(n_bins):
+            in_bin = (self.bin_map == i)
+            sn = self.signal[in_bin].sum() / np.sqrt(np.sum(self.noise[in_bin]**2))
+            self.assertGreaterEqual(sn, self.target_sn)
+
+    def test_contiguous(self):
+        for i in range(self.bin_map.max() + 1):
+            in_bin = (self.bin_map == i)
+            # flood fill from one pixel of the bin
+            reached = np.zeros_like(in_bin)
+            todo = [tuple(np.argwhere(in_bin)[0])]
+            while todo:
+                y, x = todo.pop()
+                if 0 <= y < in_bin.shape[0] and 0 <= x < in_bin.shape[1] and in_bin[y, x] and not reached[y, x]:
+                    reached[y, x] = True
+                    todo += [(y-1, x), (y+1, x), (y, x-1), (y, x+1)]
+            self.assertTrue(np.array_equal(reached, in_bin), f'bin {i} is not contiguous')
+
+    def test_combine(self):
+        values = np.stack([self.signal, 2*self.signal])
+        errors = np.stack([self.noise, 2*self.noise])
+        values[1, 0, 0] = -99
+        bin_values, bin_errors = spare.galaxy.combine_bins(values, errors, self.bin_map, missing=-99)
+
+        n_bins = self.bin_map.max() + 1
+        self.assertEqual(bin_values.shape, (2, n_bins))
+        for i in range(n_bins):
+            in_bin = (self.bin_map == i)
+            self.assertAlmostEqual(bin_values[0, i], self.signal[in_bin].sum())
+            self.assertAlmostEqual(bin_errors[0, i], np.sqrt(in_bin.sum()))
+        self.assertEqual(bin_values[1, self.bin_map[0, 0]], -99)
+        self.assertEqual(bin_errors[1, self.bin_map[0, 0]], -99)
+
+
+class TestEAZYCatalog(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        self.galaxies = [synthetic_galaxy(id=id, seed=id) for id in (3, 7)]
+        self.galaxies[1].select_pixels('segmap')
+        self.galaxies[0].values['F090W'][0, :] = np.nan
+
+    def tearDown(self) -> None:
+        self.tmp.cleanup()
+
+    def save_and_read(self, catalog_format:str, min_valid_bands:int=0):
+        folder = f'{self.tmp.name}/{catalog_format}'
+        os.makedirs(folder)
+        filepath = spare.photometry.FileEAZY(self.galaxies, min_valid_bands).save_file(folder, catalog_format)
+        self.assertEqual(spare.photometry.eazy_catalog_path(folder), filepath)
+        return folder, spare.photometry.read_eazy_catalog(folder)
+
+    def test_fits_matches_csv(self):
+        _, csv = self.save_and_read('csv')
+        _, fits_df = self.save_and_read('fits')
+
+        self.assertEqual(list(fits_df.columns), list(csv.columns))
+        for name in ['id', 'galaxy_idx', 'galaxy_id', 'pixel_id']:
+            self.assertTrue(np.array_equal(fits_df[name], csv[name]))
+        for name in ['F090W', 'E090W', 'F200W', 'E200W']:
+            # FITS keeps the floats exactly, csv only to the precision written
+            self.assertTrue(np.allclose(fits_df[name], csv[name], equal_nan=True))
+
+    def test_fits_exact(self):
+        folder, df = self.save_and_read('fits')
+
+        offsets = np.load(spare.photometry.offsets_path(folder))
+        for idx, galaxy in enumerate(self.galaxies):
+            start, stop = offsets[idx]
+            rows = df.iloc[start:stop]
+            self.assertTrue(np.all(rows['galaxy_id'] == galaxy.id))
+            self.assertTrue(np.array_equal(rows['pixel_id'], galaxy.selected_pixel_ids))
+            values = galaxy.values['F090W'].ravel()[galaxy.selected_pixel_ids]
+            self.assertTrue(np.array_equal(rows['F090W'].to_numpy(), values, equal_nan=True))
+
+    def test_min_valid_bands(self):
+        folder, df = self.save_and_read('fits', min_valid_bands=2)
+
+        # the nan row of the first galaxy is left out
+        offsets = np.load(spare.photometry.offsets_path(folder))
+        self.assertEqual(offsets[0, 1] - offsets[0, 0], self.galaxies[0].size - self.galaxies[0].shape[1])
+        self.assertFalse(np.any(np.isnan(df['F090W'])))
+
+    def test_default_drops_empty_rows(self):
+        galaxy = self.galaxies[0]
+        galaxy.errors['F200W'][0, :3] = 0
+        galaxy.errors['F090W'][0, :3] = 0
+
+        pixel_ids, _ = spare.photometry.FileEAZY.galaxy_rows(galaxy)
+        self.assertEqual(pixel_ids.size, galaxy.size - 3)
+        self.assertFalse(np.any(np.isin([0, 1, 2], pixel_ids)))
+
+        with spare.photometry.StreamEAZYWriter(self.tmp.name) as writer:
+            writer.add(0, galaxy)
+        self.assertEqual(writer.n_dropped, 3)
+
+    def test_no_rows(self):
+        # more bands required than there are filters, so every row is dropped
+        for catalog_format in ['fits', 'csv']:
+            folder, df = self.save_and_read(catalog_format, min_valid_bands=3)
+            self.assertEqual(len(df), 0)
+            self.assertEqual(list(df.columns), ['id', 'galaxy_idx', 'galaxy_id', 'pixel_id', 'F090W', 'F200W', 'E090W', 'E200W'])
+            self.assertTrue(np.all(np.load(spare.photometry.offsets_path(folder)) == 0))
+
+    def test_no_galaxies(self):
+        os.makedirs(f'{self.tmp.name}/empty')
+        with spare.photometry.StreamEAZYWriter(f'{self.tmp.name}/empty', 'fits'):
+            pass
+        df = spare.photometry.read_eazy_catalog(f'{self.tmp.name}/empty')
+        self.assertEqual(list(df.columns), ['id', 'galaxy_idx', 'galaxy_id', 'pixel_id'])
+        self.assertEqual(len(df), 0)
+
+
+class TestStreamingPrep(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        self.config_file = synthetic_config(self.tmp.name)
+        self.ids = [4, 27, 11, 8]
+        self.options = dict(border=2, pixels='segmap', dilate=1, catalog_format='fits', config_file=self.config_file)
+
+    def tearDown(self) -> None:
+        spare.filemanage.clear_data_cache()
+        self.tmp.cleanup()
+
+    def run_folder(self, run_id:int) -> str:
+        return spare.filemanage.RunManager(self.config_file).run_folder(run_id)
+
+    def assertSameRun(self, run_a:int, run_b:int) -> None:
+        folder_a, folder_b = self.run_folder(run_a), self.run_folder(run_b)
+
+        catalog_a = spare.photometry.read_eazy_catalog(folder_a)
+        catalog_b = spare.photometry.read_eazy_catalog(folder_b)
+        self.assertGreater(len(catalog_a), 0)
+        self.assertTrue(catalog_a.equals(catalog_b))
+        self.assertTrue(np.array_equal(
+            np.load(spare.photometry.offsets_path(folder_a)), np.load(spare.photometry.offsets_path(folder_b))
+        ))
+
+        for idx, id in enumerate(self.ids):
+            gal_a = spare.galaxy.load_galaxy_from_folder(f'{folder_a}/galaxies/{idx}')
+            gal_b = spare.galaxy.load_galaxy_from_folder(f'{folder_b}/galaxies/{idx}')
+            self.assertEqual(gal_a.id, id)
+            self.assertEqual(gal_b.id, id)
+            self.assertTrue(np.array_equal(gal_a.segmap, gal_b.segmap))
+            for filt in gal_a.filters:
+                self.assertTrue(np.array_equal(gal_a.values[filt], gal_b.values[filt]))
+
+    def test_streaming(self):
+        serial = spare.prep_for_EAZY('serial', self.ids, **self.options)
+        streamed = spare.prep_for_EAZY('streamed', self.ids, streaming=True, **self.options)
+        self.assertSameRun(serial, streamed)
+
+    def test_workers(self):
+        serial = spare.prep_for_EAZY('serial', self.ids, **self.options)
+        pooled = spare.funcs._prep_streaming(
+            'pooled', self.ids, 2, {
+                'stacked': False, 'replace_unused': False, 'unused': None, 'replace': None, 'using': 'errors', 'verbose_replace': False,
+                'pixels': 'segmap', 'dilate': 1, 'bin_sn': None, 'bin_band': None
+            },
+            self.config_file, 'folders', 'fits', min_valid_bands=1, workers=2, batch=1
+        )
+        self.assertSameRun(serial, pooled)
+
+
+class TestTempfiltKey(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        folder = self.tmp.name
+
+        self.template = f'{folder}/t0.dat'
+        with open(self.template, 'w') as f:
+            f.write('1000 1.0\n2000 2.0\n')
+        with open(f'{folder}/templates.param', 'w') as f:
+            f.write(f'1 {self.template} 1.0 0 1.0\n')
+        self.translate_file = f'{folder}/z_phot.translate'
+        with open(self.translate_file, 'w') as f:
+            f.write('F090W F363\nE090W E363\n')
+        self.catalog_file = f'{folder}/EAZY_input.csv'
+        with open(self.catalog_file, 'w') as f:
+            f.write('id,galaxy_idx,galaxy_id,pixel_id,F090W,E090W\n')
+
+        self.params = {'TEMPLATES_FILE': f'{folder}/templates.param', 'CATALOG_FILE': self.catalog_file, 'Z_STEP': 0.01}
+
+    def tearDown(self) -> None:
+        self.tmp.cleanup()
+
+    def key(self, **params) -> str:
+        return spare.photometry.tempfilt_key(None, self.params | params, self.translate_file)
+
+    def test_same_inputs(self):
+        self.assertEqual(self.key(), self.key())
+        # parameters the grid does not depend on
+        self.assertEqual(self.key(), self.key(VERBOSITY=0, PRIOR_FILTER=363))
+
+    def test_grid_params(self):
+        self.assertNotEqual(self.key(), self.key(Z_STEP=0.02))
+        self.assertNotEqual(self.key(), self.key(Z_MAX=8.0))
+
+    def test_template_changed(self):
+        key = self.key()
+        with open(self.template, 'w') as f:
+            f.write('1000 1.0\n2000 3.0\n')
+        stat = os.stat(self.template)
+        os.utime(self.template, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        self.assertNotEqual(key, self.key())
+
+    def test_translate_and_columns(self):
+        key = self.key()
+        with open(self.catalog_file, 'w') as f:
+            f.write('id,galaxy_idx,galaxy_id,pixel_id,F090W,E090W,F200W,E200W\n')
+        key_columns = self.key()
+        self.assertNotEqual(key, key_columns)
+
+        with open(self.translate_file, 'a') as f:
+            f.write('F200W F366\nE200W E366\n')
+        self.assertNotEqual(key_columns, self.key())
+
+
+class TestCheckpointOptions(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        config_file = synthetic_config(self.tmp.name)
+        run_id = spare.prep_for_EAZY('checkpoint', [4, 27], pixels='segmap', catalog_format='fits', config_file=config_file)
+
+        self.wrapper = spare.photometry.WrapperEAZY(run_id, config_file)
+        self.wrapper.set_photoz_params({'Z_STEP': 0.05})
+        n_rows = len(spare.photometry.read_eazy_catalog(self.wrapper.run_folder, ['id']))
+
+        param_file, params, translate_file = self.wrapper.photoz_args
+        self.progress = {
+            'n_rows': n_rows, 'chunk_rows': n_rows, 'n_chunks': 1, 'done': [],
+            'photoz_args': json.loads(json.dumps({'param_file': param_file, 'params': params, 'translate_file': translate_file})),
+            'fit_options': {'coarse_step': 4, 'n_minima': 2}
+        }
+        os.makedirs(self.wrapper.chunks_folder)
+        self.wrapper._write_progress(self.progress)
+
+    def tearDown(self) -> None:
+        spare.filemanage.clear_data_cache()
+        self.tmp.cleanup()
+
+    def test_fit_options_differ(self):
+        with self.assertRaisesRegex(Exception, 'options'):
+            self.wrapper.run_EAZY_fit_parallel(1, checkpoint=True, coarse_step=None)
+        with self.assertRaisesRegex(Exception, 'options'):
+            self.wrapper.run_EAZY_fit_parallel(1, checkpoint=True, coarse_step=4, n_minima=3)
+
+    def test_photoz_args_differ(self):
+        self.wrapper.set_photoz_params({'Z_STEP': 0.02})
+        with self.assertRaisesRegex(Exception, 'photoz params'):
+            self.wrapper.run_EAZY_fit_parallel(1, checkpoint=True, coarse_step=4)
+
+    def test_progress_without_fit_options(self):
+        # saved before fit options were recorded, so taken as a fine fit
+        del self.progress['fit_options']
+        self.wrapper._write_progress(self.progress)
+        with self.assertRaisesRegex(Exception, 'options'):
+            self.wrapper.run_EAZY_fit_parallel(1, checkpoint=True, coarse_step=4)
+
+
+class TestChi2Storage(unittest.TestCase):
+    def setUp(self) -> None:
+        # two wells in each row, the deeper at z_true
+        rng = np.random.default_rng(0)
+        self.zgrid = np.arange(0, 6, 0.01)
+        self.z_true = rng.uniform(0.5, 2.5, 20)
+        z_second = self.z_true + rng.uniform(1.5, 3, 20)
+        self.chi2 = np.minimum(
+            10 + ((self.zgrid - self.z_true[:, np.newaxis]) / 0.1)**2,
+            15 + ((self.zgrid - z_second[:, np.newaxis]) / 0.2)**2
+        )
+        self.chi2 = np.minimum(self.chi2, 500)
+
+    def roundtrip(self, storage:str, **options) -> np.ndarray:
+        arrays = spare.photometry.encode_chi2(self.chi2, self.zgrid, storage, **options)
+        self.assertEqual(spare.photometry.chi2_storage_of(arrays), storage)
+        return spare.photometry.decode_chi2(arrays, self.zgrid)
+
+    def test_dense(self):
+        self.assertTrue(np.array_equal(self.roundtrip('float64'), self.chi2))
+        self.assertTrue(np.allclose(self.roundtrip('float32'), self.chi2, rtol=1e-6))
+
+    def test_compressed(self):
+        arrays = spare.photometry.encode_chi2(self.chi2, self.zgrid, 'compressed')
+        with tempfile.TemporaryDirectory() as folder:
+            np.savez_compressed(f'{folder}/fit_data.npz', **arrays)
+            with np.load(f'{folder}/fit_data.npz') as saved:
+                chi2 = spare.photometry.decode_chi2(saved, self.zgrid)
+        self.assertTrue(np.array_equal(chi2, self.chi2.astype(np.float32)))
+
+    def test_topk(self):
+        chi2 = self.roundtrip('topk', k=2, half_width=5)
+
+        self.assertTrue(np.array_equal(np.argmin(chi2, axis=1), np.argmin(self.chi2, axis=1)))
+        self.assertTrue(np.allclose(chi2.min(axis=1), self.chi2.min(axis=1)))
+        self.assertTrue(np.allclose(chi2.max(axis=1), self.chi2.max(axis=1)))
+        # exact within the windows, the row maximum outside
+        kept = ~np.isclose(chi2, self.chi2.max(axis=1, keepdims=True))
+        self.assertTrue(np.allclose(chi2[kept], self.chi2[kept], rtol=1e-6))
+        self.assertTrue(np.all(np.sum(kept, axis=1) <= 2*11))
+
+    def test_percentiles(self):
+        chi2 = self.roundtrip('percentiles')
+
+        step = self.zgrid[1] - self.zgrid[0]
+        self.assertTrue(np.all(np.abs(self.zgrid[np.argmin(chi2, axis=1)] - self.z_true) <= step))
+        self.assertTrue(np.allclose(chi2.min(axis=1), self.chi2.min(axis=1), rtol=1e-3))
+        self.assertTrue(np.all(chi2 <= self.chi2.max(axis=1, keepdims=True) * (1 + 1e-6)))
+
+    def test_rows(self):
+        for storage in spare.photometry.CHI2_STORAGE:
+            arrays = spare.photometry.encode_chi2(self.chi2, self.zgrid, storage)
+            chi2 = spare.photometry.decode_chi2(arrays, self.zgrid)
+            self.assertTrue(np.array_equal(spare.photometry.decode_chi2(arrays, self.zgrid, slice(3, 7)), chi2[3:7]))
+            self.assertTrue(np.array_equal(spare.photometry.decode_chi2(arrays, self.zgrid, np.array([5, 1])), chi2[[5, 1]]))
+
+    def test_unknown(self):
+        with self.assertRaises(ValueError):
+            spare.photometry.encode_chi2(self.chi2, self.zgrid, 'float16')
+        self.assertEqual(spare.photometry.chi2_storage_of({'chi2': self.chi2}), 'float64')
+
+
+class TestGalaxyOffsets(unittest.TestCase):
+    def test_offsets(self):
+        offsets = spare.photometry.galaxy_offsets(np.array([0, 0, 0, 2, 2, 3]))
+        self.assertTrue(np.array_equal(offsets, [[0, 3], [3, 3], [3, 5], [5, 6]]))
+
+    def test_empty_trailing(self):
+        offsets = spare.photometry.galaxy_offsets(np.array([0, 0, 1]), n_galaxies=4)
+        self.assertTrue(np.array_equal(offsets, [[0, 2], [2, 3], [3, 3], [3, 3]]))
+
+    def test_no_rows(self):
+        self.assertEqual(spare.photometry.galaxy_offsets(np.array([], dtype=int)).shape, (0, 2))
+        self.assertTrue(np.array_equal(spare.photometry.galaxy_offsets(np.array([], dtype=int), n_galaxies=2), [[0, 0], [0, 0]]))
+
+    def test_catalog_index(self):
+        # the last galaxy has every row dropped, so is only known from the saved offsets
+        galaxies = [synthetic_galaxy(id=1), synthetic_galaxy(id=2)]
+        for filt in galaxies[1].filters:
+            galaxies[1].errors[filt][...] = 0
+
+        with tempfile.TemporaryDirectory() as folder:
+            spare.photometry.FileEAZY(galaxies).save_file(folder, 'fits')
+            index = spare.photometry.catalog_index(folder)
+
+            self.assertTrue(np.array_equal(index['galaxy_offsets'], [[0, galaxies[0].size], [galaxies[0].size, galaxies[0].size]]))
+            self.assertTrue(np.array_equal(index['pixel_id'], np.arange(galaxies[0].size)))
+
+
+class TestExtractGalaxies(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        self.config_file = synthetic_config(self.tmp.name)
+        self.ids = [4, 27, 11, 8]
+        self.run_id = synthetic_fit(self.config_file, self.ids)
+        self.extract = spare.photometry.Extract(self.run_id, self.config_file, cache_size=2)
+
+    def tearDown(self) -> None:
+        self.extract.close()
+        spare.filemanage.clear_data_cache()
+        self.tmp.cleanup()
+
+    def test_by_id(self):
+        for idx, id in enumerate(self.ids):
+            galaxy = self.extract.get_galaxy(id, by='id')
+            self.assertEqual(galaxy.id, id)
+            self.assertIs(galaxy, self.extract.get_galaxy(idx))
+        with self.assertRaises(ValueError):
+            self.extract.get_galaxy(5, by='id')
+
+    def test_out_of_range(self):
+        with self.assertRaises(IndexError):
+            self.extract.get_galaxy(len(self.ids))
+        with self.assertRaises(IndexError):
+            self.extract.get_galaxy(-1)
+
+    def test_lru(self):
+        first = self.extract.get_galaxy(0)
+        second = self.extract.get_galaxy(1)
+        self.assertIs(self.extract.get_galaxy(0), first)
+        store_file = self.extract._run_store._file
+        self.extract.get_galaxy(2)
+        # the store is kept open between reads
+        self.assertIs(self.extract._run_store._file, store_file)
+
+        # 1 was least recently used, so is dropped and read again
+        self.assertEqual(list(self.extract._cache), [0, 2])
+        self.assertIs(self.extract.get_galaxy(0), first)
+        self.assertIsNot(self.extract.get_galaxy(1), second)
+        self.assertEqual(list(self.extract._cache), [0, 1])
+
+    def test_iter_skips_cached(self):
+        cached = self.extract.get_galaxy(1)
+        read = []
+        iter_read = spare.galaxy.RunStore.iter_read
+        def recording_iter_read(store, idxs):
+            read.extend(idxs)
+            return iter_read(store, idxs)
+
+        with unittest.mock.patch.object(spare.galaxy.RunStore, 'iter_read', recording_iter_read):
+            galaxies = list(self.extract.iter_galaxies([0, 1, 3]))
+
+        self.assertEqual(read, [0, 3])
+        self.assertIs(galaxies[1], cached)
+        self.assertEqual([galaxy.id for galaxy in galaxies], [self.ids[0], self.ids[1], self.ids[3]])
+
+    def test_matches_folders(self):
+        run_id = synthetic_fit(self.config_file, self.ids, store='folders')
+        extract = spare.photometry.Extract(run_id, self.config_file)
+        for galaxy, stored in zip(extract.iter_galaxies(), self.extract.iter_galaxies()):
+            self.assertEqual(galaxy.id, stored.id)
+            self.assertTrue(np.array_equal(galaxy.segmap, stored.segmap))
+            self.assertTrue(np.array_equal(galaxy.fit_pixels, stored.fit_pixels))
+
+
+class TestPhotGalaxyRows(unittest.TestCase):
+    """Results from the fitted rows only, against dense masked arrays of the chi2 of every pixel"""
+
+    def setUp(self) -> None:
+        self.rng = np.random.default_rng(0)
+        self.galaxy = synthetic_galaxy()
+        self.zgrid = np.linspace(0.1, 6, 60)
+
+    def masked(self, zbest:np.ndarray, chi2:np.ndarray, rows:np.ndarray) -> tuple[np.ma.MaskedArray, np.ma.MaskedArray]:
+        """zbest and chi2 of each pixel from the row it takes (-1 for none), masked where not fit"""
+        zbest_full = np.where(rows >= 0, zbest[rows], -1)
+        chi2_full = np.where((rows >= 0)[:, np.newaxis], chi2[rows], 0)
+        mask = (zbest_full == -1)
+        return np.ma.masked_array(zbest_full, mask=mask), np.ma.masked_array(chi2_full, mask=np.repeat(mask[:, np.newaxis], len(self.zgrid), axis=1))
+
+    def check(self, phot_galaxy:spare.galaxy.PhotGalaxy, zbest:np.ma.MaskedArray, chi2:np.ma.MaskedArray) -> None:
+        self.assertTrue(np.array_equal(phot_galaxy.no_fit_mask, zbest.mask))
+        self.assertTrue(np.array_equal(phot_galaxy.zbest, zbest.filled(np.nan), equal_nan=True))
+        self.assertTrue(np.array_equal(phot_galaxy.chi2, chi2.filled(np.nan), equal_nan=True))
+
+        phot_galaxy.calc_zchi2()
+        self.assertTrue(np.allclose(phot_galaxy.total_chi2, np.sum(chi2, axis=0)))
+
+        mask = phot_galaxy.segmap_mask
+        _, total_chi2 = phot_galaxy.calc_zchi2_pixels(mask)
+        self.assertTrue(np.allclose(total_chi2, np.sum(chi2[mask.ravel()], axis=0)))
+
+        regions = self.rng.uniform(size=(4, *phot_galaxy.shape)) < 0.4
+        summed = phot_galaxy.region_weights(regions) @ phot_galaxy.fit_chi2
+        for region, region_chi2 in zip(regions, summed):
+            self.assertTrue(np.allclose(region_chi2, np.sum(chi2[region.ravel()], axis=0)))
+            self.assertTrue(np.allclose(phot_galaxy.pixel_weights(region) @ phot_galaxy.fit_chi2, region_chi2))
+
+    def test_pixel_ids(self):
+        self.galaxy.select_pixels('segmap', dilate=1)
+        pixel_ids = self.galaxy.selected_pixel_ids
+        zbest = self.rng.uniform(0.1, 6, pixel_ids.size)
+        zbest[::7] = -1
+        chi2 = self.rng.uniform(0, 100, (pixel_ids.size, len(self.zgrid)))
+
+        phot_galaxy = spare.galaxy.PhotGalaxy.from_galaxy(self.galaxy, self.zgrid, zbest, chi2, pixel_ids=pixel_ids)
+
+        rows = np.full(self.galaxy.size, -1)
+        rows[pixel_ids] = np.arange(pixel_ids.size)
+        self.check(phot_galaxy, *self.masked(zbest, chi2, rows))
+
+    def test_bin_map(self):
+        self.galaxy.select_pixels('segmap')
+        self.galaxy.bin_pixels(10, 'F200W')
+        n_bins = self.galaxy.n_bins
+        self.assertGreater(n_bins, 2)
+        zbest = self.rng.uniform(0.1, 6, n_bins)
+        zbest[1] = -1
+        chi2 = self.rng.uniform(0, 100, (n_bins, len(self.zgrid)))
+
+        phot_galaxy = spare.galaxy.PhotGalaxy.from_galaxy(self.galaxy, self.zgrid, zbest, chi2, pixel_ids=np.arange(n_bins))
+
+        self.check(phot_galaxy, *self.masked(zbest, chi2, self.galaxy.bin_map.ravel()))
+
+
+class TestChi2Integral(unittest.TestCase):
+    def setUp(self) -> None:
+        rng = np.random.default_rng(0)
+        galaxy = synthetic_galaxy()
+        galaxy.select_pixels('segmap', dilate=2)
+        pixel_ids = galaxy.selected_pixel_ids
+        zgrid = np.linspace(0.1, 6, 40)
+        chi2 = rng.uniform(0, 100, (pixel_ids.size, len(zgrid)))
+        self.galaxy = spare.galaxy.PhotGalaxy.from_galaxy(galaxy, zgrid, np.ones(pixel_ids.size), chi2, pixel_ids=pixel_ids)
+
+        yy, xx = np.mgrid[:self.galaxy.shape[0], :self.galaxy.shape[1]]
+        r2 = (yy - 4)**2 + (xx - 5)**2
+        self.regions = np.stack([r2 <= 4, (r2 > 4) & (r2 <= 16), np.zeros_like(r2, dtype=bool), rng.uniform(size=r2.shape) < 0.5])
+
+    def test_rects(self):
+        rects = np.array([[0, 9, 0, 11], [2, 5, 3, 8], [4, 4, 1, 6], [-3, 3, 9, 20]])
+        zchi2, total_chi2 = self.galaxy.calc_zchi2_rects(rects)
+
+        for rect, z, total in zip(rects, zchi2, total_chi2):
+            pixels = np.zeros(self.galaxy.shape, dtype=bool)
+            pixels[max(rect[0], 0):rect[1], max(rect[2], 0):rect[3]] = True
+            z_pixels, total_pixels = self.galaxy.calc_zchi2_pixels(pixels)
+            self.assertTrue(np.allclose(total, total_pixels))
+            if np.any(pixels.ravel()[self.galaxy.fit_pixels]):
+                self.assertEqual(z, z_pixels)
+            else:
+                self.assertTrue(np.isnan(z))
+
+    def test_regions(self):
+        zchi2, total_chi2 = self.galaxy.calc_zchi2_regions(self.regions)
+
+        for region, z, total in zip(self.regions, zchi2, total_chi2):
+            z_pixels, total_pixels = self.galaxy.calc_zchi2_pixels(region)
+            self.assertTrue(np.allclose(total, total_pixels))
+            if np.any(region.ravel()[self.galaxy.fit_pixels]):
+                self.assertEqual(z, z_pixels)
+            else:
+                self.assertTrue(np.isnan(z))
+        self.assertTrue(np.allclose(total_chi2, self.galaxy.region_weights(self.regions) @ self.galaxy.fit_chi2))
+
+    def test_no_fit_pixels(self):
+        # the corner lies outside the dilated segmap, so has pixels but none fit
+        corner = np.zeros(self.galaxy.shape, dtype=bool)
+        corner[:1, :2] = True
+        self.assertFalse(np.any(corner.ravel()[self.galaxy.fit_pixels]))
+
+        zchi2, total_chi2 = self.galaxy.calc_zchi2_regions([corner, np.zeros_like(corner), self.regions[0]])
+        self.assertTrue(np.all(np.isnan(zchi2[:2])))
+        self.assertFalse(np.isnan(zchi2[2]))
+        self.assertTrue(np.all(total_chi2[:2] == 0))
+
+        zchi2, total_chi2 = self.galaxy.calc_zchi2_rects([[0, 1, 0, 2], [4, 4, 1, 6], [0, 9, 0, 11]])
+        self.assertTrue(np.all(np.isnan(zchi2[:2])))
+        self.assertFalse(np.isnan(zchi2[2]))
+        self.assertTrue(np.all(total_chi2[:2] == 0))
+
+    def test_kept_only_on_request(self):
+        _, total_chi2 = self.galaxy.calc_zchi2_regions(self.regions)
+        self.assertIsNone(self.galaxy.chi2_integral)
+
+        self.galaxy.build_chi2_integral()
+        self.assertEqual(self.galaxy.chi2_integral.shape, (self.galaxy.shape[0] + 1, self.galaxy.shape[1] + 1, len(self.galaxy.zgrid)))
+        self.assertTrue(np.allclose(self.galaxy.calc_zchi2_regions(self.regions)[1], total_chi2))
+
+        self.galaxy.clear_chi2_integral()
+        self.assertIsNone(self.galaxy.chi2_integral)
+
+
+class TestPosterior(unittest.TestCase):
+    def setUp(self) -> None:
+        self.zgrid = np.arange(0.005, 6, 0.005)
+
+    def test_log_pz_normalised(self):
+        # large chi2, as summed over many pixels
+        chi2 = 1e5 + np.stack([((self.zgrid - 2.5) / 0.3)**2, ((self.zgrid - 1) / 0.05)**2])
+        pz = np.exp(spare.galaxy.log_pz(chi2, self.zgrid))
+        self.assertTrue(np.allclose(np.sum(0.5 * (pz[:, 1:] + pz[:, :-1]) * np.diff(self.zgrid), axis=1), 1))
+
+        self.assertEqual(spare.galaxy.log_pz(chi2[0], self.zgrid).shape, self.zgrid.shape)
+
+    def test_percentiles_gaussian(self):
+        # p(z) a gaussian of mean 2.5 and sigma 0.3
+        chi2 = ((self.zgrid - 2.5) / 0.3)**2
+        z16, z50, z84 = spare.galaxy.pz_percentiles(chi2, self.zgrid, [15.865, 50, 84.135])[0]
+        self.assertAlmostEqual(z16, 2.2, delta=0.002)
+        self.assertAlmostEqual(z50, 2.5, delta=0.002)
+        self.assertAlmostEqual(z84, 2.8, delta=0.002)
+
+        stats = spare.galaxy.pz_stats(chi2, self.zgrid)
+        self.assertAlmostEqual(stats['z_peak'][0], 2.5, delta=0.005)
+        self.assertAlmostEqual(stats['z50'][0], 2.5, delta=0.002)
+
+    def test_peaks(self):
+        # a second peak at a tenth of the height of the first
+        chi2 = np.minimum(((self.zgrid - 2) / 0.2)**2, 2*np.log(10) + ((self.zgrid - 4) / 0.2)**2)
+        self.assertEqual(spare.galaxy.pz_stats(chi2, self.zgrid, peak_threshold=0.05)['n_peaks'][0], 2)
+        self.assertEqual(spare.galaxy.pz_stats(chi2, self.zgrid, peak_threshold=0.2)['n_peaks'][0], 1)
+        self.assertEqual(spare.galaxy.pz_stats(((self.zgrid - 2) / 0.2)**2, self.zgrid)['n_peaks'][0], 1)
+
+    def test_no_minimum(self):
+        chi2 = np.stack([np.full(len(self.zgrid), np.nan), np.full(len(self.zgrid), np.inf), ((self.zgrid - 2) / 0.2)**2])
+        with warnings.catch_warnings():
+            warnings.simplefilter('error')
+            stats = spare.galaxy.pz_stats(chi2, self.zgrid)
+            log_pz = spare.galaxy.log_pz(chi2, self.zgrid)
+
+        for name in ['z16', 'z50', 'z84', 'z_peak']:
+            self.assertTrue(np.all(np.isnan(stats[name][:2])))
+            self.assertFalse(np.isnan(stats[name][2]))
+        self.assertTrue(np.array_equal(stats['n_peaks'], [0, 0, 1]))
+        self.assertTrue(np.all(np.isnan(log_pz[:2])))
+        self.assertTrue(np.all(np.isfinite(log_pz[2])))
+
+    def test_regions(self):
+        rng = np.random.default_rng(0)
+        galaxy = synthetic_galaxy()
+        zgrid = np.linspace(0.1, 6, 50)
+        chi2 = rng.uniform(0, 20, (galaxy.size, len(zgrid)))
+        phot_galaxy = spare.galaxy.PhotGalaxy.from_galaxy(galaxy, zgrid, np.ones(galaxy.size), chi2)
+
+        regions = rng.uniform(size=(3, *galaxy.shape)) < 0.3
+        summed = np.stack([chi2[region.ravel()].sum(axis=0) for region in regions])
+        self.assertTrue(np.allclose(phot_galaxy.region_log_pz(regions), spare.galaxy.log_pz(summed, zgrid)))
+
+        stats = phot_galaxy.region_pz_stats(regions)
+        expected = spare.galaxy.pz_stats(summed, zgrid)
+        for name in spare.galaxy.PZ_STATS:
+            self.assertTrue(np.allclose(stats[name], expected[name]))
+
+    def test_extract_failed_rows(self):
+        with tempfile.TemporaryDirectory() as folder:
+            config_file = synthetic_config(folder)
+            run_id = synthetic_fit(config_file, [4, 27])
+            fit = spare.photometry.fit_folder(f'{spare.filemanage.RunManager(config_file).run_folder(run_id)}/eazy')
+            fit_data = spare.photometry.load_fit_data(fit, mmap=False)
+            fit_data['zbest'][::3] = -1
+            spare.photometry.save_fit_data(fit, fit_data)
+
+            stats = spare.photometry.Extract(run_id, config_file).pz_stats(chunk_rows=10)
+            spare.filemanage.clear_data_cache()
+
+        failed = (fit_data['zbest'] == -1)
+        self.assertTrue(np.all(np.isnan(stats['z50'][failed])))
+        self.assertTrue(np.all(stats['n_peaks'][failed] == 0))
+        self.assertFalse(np.any(np.isnan(stats['z50'][~failed])))
+        self.assertTrue(np.all(stats['n_peaks'][~failed] == 1))
+
+
+class TestBootstrap(unittest.TestCase):
+    def setUp(self) -> None:
+        rng = np.random.default_rng(0)
+        galaxy = synthetic_galaxy()
+        self.zgrid = np.linspace(0.1, 6, 60)
+        self.chi2 = rng.uniform(0, 20, (galaxy.size, len(self.zgrid))).astype(np.float32)
+        self.galaxy = spare.galaxy.PhotGalaxy.from_galaxy(galaxy, self.zgrid, np.ones(galaxy.size), self.chi2)
+
+    def test_shape(self):
+        zchi2, total_chi2 = self.galaxy.bootstrap_zchi2(250, seed=0)
+        self.assertEqual(zchi2.shape, (250,))
+        self.assertEqual(total_chi2.shape, (250, len(self.zgrid)))
+        self.assertEqual(total_chi2.dtype, self.chi2.dtype)
+        self.assertTrue(np.all(np.isin(zchi2, self.zgrid)))
+
+        # each resample draws as many pixels as are fit
+        _, ones = spare.galaxy.PhotGalaxy.from_galaxy(
+            self.galaxy, self.zgrid, np.ones(self.galaxy.size), np.ones_like(self.chi2)
+        ).bootstrap_zchi2(20, self.galaxy.segmap_mask, seed=0)
+        self.assertTrue(np.all(ones == self.galaxy.segmap_mask.sum()))
+
+    def test_seeded(self):
+        zchi2, total_chi2 = self.galaxy.bootstrap_zchi2(250, seed=3)
+        zchi2_again, total_chi2_again = self.galaxy.bootstrap_zchi2(250, seed=3, block=7)
+        self.assertTrue(np.array_equal(zchi2, zchi2_again))
+        self.assertTrue(np.allclose(total_chi2, total_chi2_again))
+        self.assertFalse(np.allclose(total_chi2, self.galaxy.bootstrap_zchi2(250, seed=4)[1]))
+
+    def test_identical_pixels(self):
+        chi2 = np.tile(((self.zgrid - 2.2) / 0.5)**2, (self.galaxy.size, 1))
+        galaxy = spare.galaxy.PhotGalaxy.from_galaxy(self.galaxy, self.zgrid, np.ones(self.galaxy.size), chi2)
+        zchi2, _ = galaxy.bootstrap_zchi2(100, seed=0)
+        self.assertTrue(np.all(zchi2 == self.zgrid[np.argmin(chi2[0])]))
+
+    def test_no_pixels(self):
+        zchi2, total_chi2 = self.galaxy.bootstrap_zchi2(10, np.zeros(self.galaxy.shape), seed=0)
+        self.assertTrue(np.all(np.isnan(zchi2)))
+        self.assertTrue(np.all(np.isnan(total_chi2)))
+
+
+class _StubParam(dict):
+    """Param of a stub photoz, read both by key and through `params` as eazy's"""
+    @property
+    def params(self) -> dict:
+        return self
+
+
+class TestCoarseToFine(unittest.TestCase):
+    def setUp(self) -> None:
+        # two wells in each object's chi2, the deeper at z_true
+        rng = np.random.default_rng(0)
+        self.n_obj, self.n_temp = 12, 3
+        self.zgrid = np.linspace(0.01, 8, 400)
+        self.z_true = rng.uniform(0.5, 3.5, self.n_obj)
+        z_second = self.z_true + rng.uniform(2, 4, self.n_obj)
+        self.dense = np.minimum(
+            20 + ((self.zgrid - self.z_true[:, np.newaxis]) / 0.4)**2,
+            25 + ((self.zgrid - z_second[:, np.newaxis]) / 0.4)**2
+        )
+
+        self.photoz = unittest.mock.Mock()
+        # each object's flux is its index, so the stub fit knows which rows it was given
+        self.photoz.fnu = np.arange(self.n_obj, dtype=float)[:, np.newaxis] * np.ones((1, 2))
+        self.photoz.efnu = np.ones((self.n_obj, 2))
+        self.photoz.ext_redden = np.ones(2)
+        self.photoz.zp = np.ones(2)
+        self.photoz.param = _StubParam(NOT_OBS_THRESHOLD=-90, FITTER='nnls', RENORM_TEMPLATES='n', HESS_THRESHOLD=1e4, VERBOSITY=0)
+        self.photoz.zgrid = self.zgrid
+        self.photoz.NOBJ = self.n_obj
+        self.photoz.chi2_fit = np.zeros((self.n_obj, len(self.zgrid)))
+        self.photoz.fit_coeffs = np.zeros((self.n_obj, len(self.zgrid), self.n_temp))
+        def fit_at_zbest(**kwargs):
+            self.photoz.zbest = self.zgrid[np.argmin(self.photoz.chi2_fit, axis=1)]
+        self.photoz.fit_at_zbest = fit_at_zbest
+
+        self.evaluated = np.zeros((self.n_obj, len(self.zgrid)), dtype=int)
+
+    def fit_by_redshift(self, iz, z, A, fnu_corr, efnu_corr, TEF, *args):
+        objects = fnu_corr[:, 0].astype(int)
+        self.evaluated[objects, iz] += 1
+        return iz, self.dense[objects, iz], np.zeros((len(objects), self.n_temp))
+
+    def test_coarse_to_fine(self):
+        coarse_step, n_minima = 8, 2
+        with unittest.mock.patch('eazy.photoz.fit_by_redshift', self.fit_by_redshift):
+            windows = spare.photometry.fit_coarse_to_fine(self.photoz, coarse_step, n_minima)
+
+        # same redshifts as a dense fit
+        self.assertTrue(np.array_equal(self.photoz.zbest, self.zgrid[np.argmin(self.dense, axis=1)]))
+        self.assertTrue(np.array_equal(np.argmin(self.photoz.chi2_fit, axis=1), np.argmin(self.dense, axis=1)))
+
+        # each point evaluated once, only at the coarse points and within the windows
+        coarse = np.unique(np.append(np.arange(0, len(self.zgrid), coarse_step), len(self.zgrid) - 1))
+        self.assertEqual(windows.shape, (self.n_obj, n_minima, 2))
+        in_window = np.zeros_like(self.evaluated, dtype=bool)
+        in_window[:, coarse] = True
+        zi = np.arange(len(self.zgrid))
+        for m in range(n_minima):
+            in_window |= (zi >= windows[:, m, 0, np.newaxis]) & (zi <= windows[:, m, 1, np.newaxis])
+        self.assertTrue(np.array_equal(self.evaluated, in_window.astype(int)))
+        self.assertLess(self.evaluated.sum(), self.dense.size / 3)
+
+        # exact where evaluated, linear between the coarse points elsewhere
+        self.assertTrue(np.allclose(self.photoz.chi2_fit[in_window], self.dense[in_window]))
+        for obj in range(self.n_obj):
+            interpolated = np.interp(zi, coarse, self.dense[obj, coarse])
+            self.assertTrue(np.allclose(self.photoz.chi2_fit[obj, ~in_window[obj]], interpolated[~in_window[obj]]))
+
+
+def _tagged_fit_chunk(catalog:Table, coarse_step:int|None=None, n_minima:int=2) -> dict[str, np.ndarray]:
+    """Stand in for `_fit_chunk`, tagging each row with its catalog id and the n_proc its process was given"""
+    ids = np.asarray(catalog['id'], dtype=float)
+    return {
+        'zgrid': np.linspace(0, 1, 3),
+        'zbest': ids,
+        'chi2': ids[:, np.newaxis] + np.arange(3),
+        'n_proc': np.full(len(ids), spare.photometry.run._fit_worker['n_proc']),
+        'pid': np.full(len(ids), os.getpid()),
+    }
+
+
+class TestFitChunks(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        config_file = synthetic_config(self.tmp.name)
+        run_id = spare.prep_for_EAZY('chunks', [4, 27, 11, 8], pixels='segmap', catalog_format='fits', config_file=config_file)
+
+        self.wrapper = spare.photometry.WrapperEAZY(run_id, config_file, cache_tempfilt=False)
+        self.wrapper.set_photoz_params({'Z_STEP': 0.05})
+        self.n_rows = len(spare.photometry.read_eazy_catalog(self.wrapper.run_folder, ['id']))
+
+    def tearDown(self) -> None:
+        spare.filemanage.clear_data_cache()
+        self.tmp.cleanup()
+
+    def assertCatalogOrder(self) -> None:
+        fit_data = self.wrapper.fit_data
+        self.assertTrue(np.array_equal(fit_data['zbest'], np.arange(self.n_rows)))
+        self.assertTrue(np.array_equal(fit_data['chi2'], np.arange(self.n_rows)[:, np.newaxis] + np.arange(3)))
+        self.assertTrue(np.array_equal(fit_data['zgrid'], np.linspace(0, 1, 3)))
+
+    def test_parallel(self):
+        with unittest.mock.patch('spare.photometry.run._fit_chunk', _tagged_fit_chunk):
+            self.wrapper.run_EAZY_fit_parallel(3, chunk_rows=20, checkpoint=True)
+
+        self.assertCatalogOrder()
+        # fit across the pool, each process fitting serially
+        self.assertNotIn(os.getpid(), self.wrapper.fit_data['pid'])
+        self.assertTrue(np.all(self.wrapper.fit_data['n_proc'] == -1))
+
+        progress = self.wrapper.read_progress()
+        self.assertEqual(progress['n_chunks'], -(-self.n_rows // 20))
+        self.assertEqual(progress['done'], list(range(progress['n_chunks'])))
+
+    def test_single_process(self):
+        with unittest.mock.patch('spare.photometry.run._fit_chunk', _tagged_fit_chunk):
+            self.wrapper.run_EAZY_fit_parallel(1, chunk_rows=20)
+
+        self.assertCatalogOrder()
+        self.assertTrue(np.all(self.wrapper.fit_data['pid'] == os.getpid()))
+        self.assertTrue(np.all(self.wrapper.fit_data['n_proc'] == 0))
+        self.assertIsNone(self.wrapper.read_progress())
+
+    def test_resume_skips_done(self):
+        with unittest.mock.patch('spare.photometry.run._fit_chunk', _tagged_fit_chunk):
+            self.wrapper.run_EAZY_fit_parallel(1, chunk_rows=20, checkpoint=True)
+
+        # as if interrupted after all but chunks 1 and 3
+        progress = self.wrapper.read_progress()
+        progress['done'] = [i for i in progress['done'] if i not in [1, 3]]
+        self.wrapper._write_progress(progress)
+
+        fit_chunk = unittest.mock.Mock(side_effect=_tagged_fit_chunk)
+        with unittest.mock.patch('spare.photometry.run._fit_chunk', fit_chunk):
+            self.wrapper.run_EAZY_fit_parallel(1, checkpoint=True)
+
+        refit = [int(call.args[0]['id'][0]) // 20 for call in fit_chunk.call_args_list]
+        self.assertEqual(refit, [1, 3])
+        self.assertCatalogOrder()
+        self.assertEqual(self.wrapper.read_progress()['done'], list(range(progress['n_chunks'])))
+
+
 class TestOverManageAndSave(unittest.TestCase):
     def setUp(self) -> None:
         self.rm = spare.filemanage.RunManager()
-        self.selection = spare.photometry.SelectionGalaxies([spare.extract_galaxy(id, spare.filemanage.Data()) for id in [55733, 74977, 183348]])
+        self.selection = spare.photometry.SelectionGalaxies([spare.extract_galaxy(id, spare.filemanage.get_data()) for id in [55733, 74977, 183348]])
         if self.rm.runs_df.shape[0] == 0:
             self.run_id_to_delete = 0
         else: